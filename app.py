@@ -1,57 +1,137 @@
-from flask import Flask, render_template, request, jsonify, Response, stream_with_context
-import json
+from flask import Flask, render_template, request, jsonify, Response
+import uuid
+from functools import partial
+import server
 from chat import API
-from db.annoy import build_annoy_index, find_similar
-from db.embeddings import get_db, EmbeddingDB
-from strategies.old import generate_response
+from chat.scheduler import get_scheduler
+from db.search import hybrid_search, search_many
+from db.embeddings import get_db
+from db.retention import RetentionWorker
+from strategies.answer_cache import get_answer_cache
+from helpers import parse_similar_request, sse_event
 import logging, sys
 logging.basicConfig(level=logging.DEBUG, stream=sys.stderr)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+server.configure(app.config)
+# Started by the first query, so importing the app spawns no thread
+retention = RetentionWorker(partial(server.apply_retention, app.config), app.config['RETENTION_INTERVAL'])
+
+
+def error(e: server.RequestError):
+    return jsonify({"error": str(e)}), e.status
+
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/scheduler')
+def scheduler():
+    # Queue depth and wait times of the model calls of every session
+    return jsonify(get_scheduler().stats())
+
+@app.route('/strategies')
+def list_strategies():
+    return jsonify(server.strategies_payload())
+
+@app.route('/search')
+def search():
+    # Related items of a text without running the reasoning loop
+    try:
+        params = server.parse_search_request(request.args, app.config['RETRIEVAL_MODE'])
+    except server.RequestError as e:
+        return error(e)
+
+    emb_db = get_db(server.DB_FILE)
+    query_embedding = API(session=params.session_id).embed(params.text)
+    items = hybrid_search(emb_db, params.text, query_embedding, top_k=params.top_k, session_id=params.session_id, mode=params.mode)
+    return jsonify({'mode': params.mode, 'items': server.items_payload(items)})
+
+@app.route('/similar', methods=['POST'])
+def similar():
+    # Related items of many texts, vectors or stored rows in one call
+    try:
+        kind, queries, options = parse_similar_request(request.get_json(silent=True), app.config['SIMILAR_MAX_BATCH'])
+        emb_db = get_db(server.DB_FILE)
+        if kind == 'texts':
+            queries = API(session=options['session_id']).embed(queries)
+        queries, exclude_ids = server.similar_queries(emb_db, kind, queries)
+    except server.RequestError as e:
+        return error(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    results = search_many(emb_db, queries, exclude_ids=exclude_ids, **options)
+    return jsonify({'results': [server.items_payload(items) for items in results]})
+
+@app.route('/neighbors')
+def neighbors():
+    try:
+        params = server.parse_neighbors_request(request.args)
+        query_embedding = API().embed(params.text) if not params.ids else None
+        return jsonify(server.neighbors_payload(get_db(server.DB_FILE), params, query_embedding))
+    except server.RequestError as e:
+        return error(e)
+
+@app.route('/metrics')
+def metrics():
+    return Response(server.render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/query', methods=['GET', 'POST'])
 def query():
     logger.debug(f"query {request}")
-    api = API()
-    if request.method == 'POST':
-        user_query = request.json['query']
-    else:  # GET
-        user_query = request.args.get('query')
-    
-    if not user_query:
-        return jsonify({"error": "No query provided"}), 400
+    try:
+        if request.method == 'POST':
+            params = server.parse_query_request(request.get_json(silent=True), app.config['RETRIEVAL_MODE'])
+        else:  # GET
+            params = server.parse_query_request(request.args, app.config['RETRIEVAL_MODE'], query_string=True)
+    except server.RequestError as e:
+        return error(e)
+    user_query, strategy, delta, branches = params.query, params.strategy, params.delta, params.branches
 
     # conn = create_database()
-    emb_db = get_db('embeddings.db')
-    # Clear the database before processing the new query
-    emb_db.delete_all()
-    # Add user query to database
-    # query_embedding = get_embedding(user_query)
-    query_embedding = api.embed(user_query)
-    # logger.debug(f"embedding {query_embedding}")
-    emb_db.insert_embedding(user_query, query_embedding, True)
+    # Every query gets its own session, so concurrent queries never touch each other's rows
+    session_id = uuid.uuid4().hex
+    api = API(session=session_id)
+    emb_db = get_db(server.DB_FILE, session_id)
+    try:
+        server.check_embedding_model(emb_db, api.embedding_model)
+    except server.RequestError as e:
+        return error(e)
+    retention.start()
+    answer_cache = get_answer_cache(server.DB_FILE)
 
     def generate():
-        logger.debug("generate")
-        yield from generate_response(user_query, emb_db)
+        # Open the stream right away, the client shouldn't wait for the query embedding
+        yield ": stream opened\n\n"
+        # Add user query to database
+        query_embedding = api.embed(user_query)
+        question_id = emb_db.insert_embedding(user_query, query_embedding, True)
 
-        # Rebuild Annoy index after adding new data
-        logger.debug("build_annoy_index")
-        build_annoy_index(emb_db)
+        # A near-duplicate of an answered question replays that run, cache=false forces a new one
+        hit = answer_cache.lookup(emb_db, query_embedding, exclude_id=question_id, strategy=strategy.name,
+                                  branches=branches) if params.use_cache else None
+        if hit:
+            logger.debug(f"replaying the answer to {hit['question']!r} ({hit['similarity']:.3f})")
+            yield from answer_cache.replay(hit, delta=delta)
+        else:
+            logger.debug(f"generate with {strategy.name}")
+            yield from strategy.generate(user_query, emb_db, stream=params.stream, delta=delta, question_id=question_id,
+                                         branches=branches, branch_cutoff=params.branch_cutoff)
+        # Step rows are written behind, make sure they're in before searching
+        emb_db.flush()
 
-        # Find similar questions/answers
+        # Find similar questions/answers, the resident index already holds this session's rows
         logger.debug("similar_items")
-        similar_items = find_similar(emb_db, query_embedding, top_k=5)
+        similar_items = hybrid_search(emb_db, user_query, query_embedding, top_k=5,
+                                      session_id=session_id if params.scope == 'session' else None, mode=params.retrieval)
         logger.debug(similar_items)
-        yield f"data: {json.dumps({'type': 'similar', 'items': similar_items})}\n\n"
+        yield sse_event({'type': 'similar', 'items': similar_items})
 
-    return Response(generate(), mimetype='text/event-stream')
+    # Keep proxies from buffering the stream, partial events are only useful if they arrive right away
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5100, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5100, debug=True)
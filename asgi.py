@@ -0,0 +1,231 @@
+import asyncio
+import os
+import time
+import uuid
+from functools import partial
+from quart import Quart, render_template, request, jsonify, Response
+import server
+from chat import AsyncAPI
+from chat.scheduler import get_scheduler
+from db.search import hybrid_search, search_many
+from db.embeddings import get_db
+from db.retention import RetentionWorker
+from strategies.answer_cache import get_answer_cache
+from helpers import parse_similar_request, sse_event
+import logging, sys
+logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+logger = logging.getLogger(__name__)
+
+# Async serving mode: every /query stream is a coroutine waiting on ollama.AsyncClient
+# instead of a blocked worker thread. Run it with an ASGI server, e.g.
+#   hypercorn asgi:app --bind 0.0.0.0:5100
+app = Quart(__name__)
+server.configure(app.config)
+# Streams served at once by this process, more get a 503 until one ends
+app.config.setdefault('MAX_STREAMS', int(os.environ.get('MAX_STREAMS', 256)))
+# Seconds of silence after which a heartbeat event is sent, so proxies and clients keep the stream open
+app.config.setdefault('HEARTBEAT_INTERVAL', float(os.environ.get('HEARTBEAT_INTERVAL', 15)))
+# A reasoning stream lasts minutes, don't let Quart cut it after the default 60 s
+app.config['RESPONSE_TIMEOUT'] = None
+
+active_streams = 0
+
+
+class CountedStream:
+    """
+    Holds one of the MAX_STREAMS slots for a response body until Quart closes it. Quart
+    closes bodies it never started too, so the slot can't leak on an early disconnect.
+    """
+
+    def __init__(self, events):
+        global active_streams
+        active_streams += 1
+        self.events = events
+        self.released = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.events.__anext__()
+        except StopAsyncIteration:
+            self.release()
+            raise
+
+    async def aclose(self):
+        self.release()
+        await self.events.aclose()
+
+    def release(self):
+        global active_streams
+        if not self.released:
+            self.released = True
+            active_streams -= 1
+
+
+async def with_heartbeats(events, interval: float):
+    """
+    Passes SSE events through, adding a 'heartbeat' event whenever none came for `interval` seconds.
+    Heartbeats are named events, so EventSource.onmessage handlers don't see them.
+    """
+    next_event = asyncio.ensure_future(events.__anext__())
+    try:
+        while True:
+            done, _ = await asyncio.wait({next_event}, timeout=interval)
+            if not done:
+                yield sse_event({'type': 'heartbeat', 'time': time.time()}, event='heartbeat')
+                continue
+            try:
+                event = next_event.result()
+            except StopAsyncIteration:
+                return
+            yield event
+            next_event = asyncio.ensure_future(events.__anext__())
+    finally:
+        if not next_event.done():
+            next_event.cancel()
+            try:
+                await next_event
+            except (asyncio.CancelledError, StopAsyncIteration):
+                pass
+        await events.aclose()
+
+
+# Started by the first query, so importing the app spawns no thread
+retention = RetentionWorker(partial(server.apply_retention, app.config), app.config['RETENTION_INTERVAL'])
+
+
+def error(e: server.RequestError):
+    return jsonify({"error": str(e)}), e.status
+
+
+@app.route('/')
+async def index():
+    return await render_template('index.html')
+
+
+@app.route('/streams')
+async def streams():
+    return jsonify({'active': active_streams, 'max': app.config['MAX_STREAMS']})
+
+
+@app.route('/scheduler')
+async def scheduler():
+    # Queue depth and wait times of the model calls of every session
+    return jsonify(get_scheduler().stats())
+
+
+@app.route('/strategies')
+async def list_strategies():
+    return jsonify(server.strategies_payload())
+
+
+@app.route('/search')
+async def search():
+    # Related items of a text without running the reasoning loop
+    try:
+        params = server.parse_search_request(request.args, app.config['RETRIEVAL_MODE'])
+    except server.RequestError as e:
+        return error(e)
+
+    emb_db = await asyncio.to_thread(get_db, server.DB_FILE)
+    query_embedding = await AsyncAPI(session=params.session_id).embed(params.text)
+    items = await asyncio.to_thread(
+        hybrid_search, emb_db, params.text, query_embedding, top_k=params.top_k, session_id=params.session_id, mode=params.mode)
+    return jsonify({'mode': params.mode, 'items': server.items_payload(items)})
+
+
+@app.route('/similar', methods=['POST'])
+async def similar():
+    # Related items of many texts, vectors or stored rows in one call
+    try:
+        kind, queries, options = parse_similar_request(await request.get_json(silent=True), app.config['SIMILAR_MAX_BATCH'])
+        emb_db = await asyncio.to_thread(get_db, server.DB_FILE)
+        if kind == 'texts':
+            queries = await AsyncAPI(session=options['session_id']).embed(queries)
+        queries, exclude_ids = await asyncio.to_thread(server.similar_queries, emb_db, kind, queries)
+    except server.RequestError as e:
+        return error(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    results = await asyncio.to_thread(search_many, emb_db, queries, exclude_ids=exclude_ids, **options)
+    return jsonify({'results': [server.items_payload(items) for items in results]})
+
+
+@app.route('/neighbors')
+async def neighbors():
+    try:
+        params = server.parse_neighbors_request(request.args)
+        query_embedding = await AsyncAPI().embed(params.text) if not params.ids else None
+        emb_db = await asyncio.to_thread(get_db, server.DB_FILE)
+        return jsonify(await asyncio.to_thread(server.neighbors_payload, emb_db, params, query_embedding))
+    except server.RequestError as e:
+        return error(e)
+
+
+@app.route('/metrics')
+async def metrics():
+    extra = [('active_streams', 'gauge', "Open /query streams.", active_streams)]
+    return Response(server.render_metrics(extra), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/query', methods=['GET', 'POST'])
+async def query():
+    logger.debug(f"query {request}")
+    try:
+        if request.method == 'POST':
+            params = server.parse_query_request(await request.get_json(silent=True), app.config['RETRIEVAL_MODE'])
+        else:  # GET
+            params = server.parse_query_request(request.args, app.config['RETRIEVAL_MODE'], query_string=True)
+    except server.RequestError as e:
+        return error(e)
+    user_query, strategy, delta, branches = params.query, params.strategy, params.delta, params.branches
+    if active_streams >= app.config['MAX_STREAMS']:
+        return jsonify({"error": "Too many streams, try again later"}), 503, {'Retry-After': '5'}
+
+    # Every query gets its own session, so concurrent queries never touch each other's rows
+    session_id = uuid.uuid4().hex
+    api = AsyncAPI(session=session_id)
+    # SQLite work runs on worker threads, the event loop keeps serving the other streams
+    emb_db = await asyncio.to_thread(get_db, server.DB_FILE, session_id)
+    try:
+        await asyncio.to_thread(server.check_embedding_model, emb_db, api.embedding_model)
+    except server.RequestError as e:
+        return error(e)
+    retention.start()
+
+    async def generate():
+        # Open the stream right away, the client shouldn't wait for the query embedding
+        yield ": stream opened\n\n"
+        answer_cache = get_answer_cache(server.DB_FILE)
+
+        # Add user query to database
+        query_embedding = await api.embed(user_query)
+        question_id = await asyncio.to_thread(emb_db.insert_embedding, user_query, query_embedding, True)
+
+        # A near-duplicate of an answered question replays that run, cache=false forces a new one
+        hit = await asyncio.to_thread(answer_cache.lookup, emb_db, query_embedding, question_id,
+                                      strategy.name, branches) if params.use_cache else None
+        if hit:
+            for event in answer_cache.replay(hit, delta=delta):
+                yield event
+        else:
+            async for event in strategy.agenerate(user_query, emb_db, stream=params.stream, delta=delta, question_id=question_id,
+                                                  branches=branches, branch_cutoff=params.branch_cutoff):
+                yield event
+        # Step rows are written behind, make sure they're in before searching
+        await asyncio.to_thread(emb_db.flush)
+
+        similar_items = await asyncio.to_thread(
+            hybrid_search, emb_db, user_query, query_embedding, top_k=5,
+            session_id=session_id if params.scope == 'session' else None, mode=params.retrieval)
+        yield sse_event({'type': 'similar', 'items': similar_items})
+
+    events = CountedStream(with_heartbeats(generate(), app.config['HEARTBEAT_INTERVAL']))
+    # Keep proxies from buffering the stream, partial events are only useful if they arrive right away
+    return Response(events, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5100)
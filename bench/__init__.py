@@ -0,0 +1 @@
+# Benchmarks, see bench/run.py
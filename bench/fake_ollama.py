@@ -0,0 +1,269 @@
+# Deterministic stand-in for the Ollama HTTP API
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+import logging
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CHAT = 'chat'
+TITLE = 'title'
+EMBED = 'embed'
+GENERATE = 'generate'
+
+
+class FakeOllama:
+    """
+    HTTP server answering the Ollama endpoints the app uses (/api/chat, /api/generate,
+    /api/embed and /api/embeddings) with scripted replies, so the real ollama client,
+    its HTTP round trips and the JSON parsing are all part of what's measured.
+
+    Replies only depend on the request: the reasoning loop gets `steps` step JSONs about its
+    question, the last one asking for the final answer (the single-shot strategy gets all of
+    them in one reply), and the same text always gets the same unit-length embedding.
+    Latency is simulated per call and per chunk of reply, streamed or not.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, dim: int = 4096, steps: int = 7,
+                 latency: float = 0.0, token_latency: float = 0.0, embed_latency: float = 0.0,
+                 chunk_size: int = 8):
+        """
+        :param host: Interface to listen on.
+        :param port: Port to listen on, 0 for any free port.
+        :param dim: Size of the embeddings.
+        :param steps: Reasoning steps scripted per question, the session needs more than 5.
+        :param latency: Seconds before the first byte of every chat or generate reply.
+        :param token_latency: Seconds between two streamed chunks.
+        :param embed_latency: Seconds per embed call.
+        :param chunk_size: Characters per streamed chunk.
+        """
+        self.dim = dim
+        self.steps = steps
+        self.latency = latency
+        self.token_latency = token_latency
+        self.embed_latency = embed_latency
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeOllama":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: Per kind of call ('chat', 'title', 'embed', 'generate'): number of calls,
+            texts embedded, prompt tokens (words) received, seconds spent answering, bytes sent.
+        """
+        with self._lock:
+            return {kind: dict(values) for kind, values in self._stats.items()}
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
+
+    def _record(self, kind: str, seconds: float, sent: int, items: int = 1, prompt_tokens: int = 0):
+        with self._lock:
+            stats = self._stats.setdefault(kind, {'calls': 0, 'items': 0, 'prompt_tokens': 0, 'time_s': 0.0, 'bytes': 0})
+            stats['calls'] += 1
+            stats['items'] += items
+            stats['prompt_tokens'] += prompt_tokens
+            stats['time_s'] += seconds
+            stats['bytes'] += sent
+
+    def reply(self, messages: List[dict]) -> Tuple[str, str]:
+        """
+        Scripted reply to a chat.
+
+        :return: (kind of call, reply text).
+        """
+        if messages and messages[0]['role'] == 'system' and 'summarizer' in messages[0]['content']:
+            words = messages[-1]['content'].split()[:3]
+            return TITLE, " ".join(words)[:20] or "Untitled"
+        question = next((m['content'] for m in messages if m['role'] == 'user'), '')
+        last = messages[-1]['content'] if messages else ''
+        if messages and messages[0]['role'] == 'system' and "'steps' array" in messages[0]['content']:
+            # Single-shot strategy: every step and the answer in one reply
+            return CHAT, json.dumps({
+                "steps": [{"title": f"Step {step} analysis", "content": self._step_content(question, step)}
+                          for step in range(1, self.steps + 1)],
+                "final_answer": f"The answer to '{question}' follows from the steps above.",
+            })
+        if 'final evaluation' in last:
+            return CHAT, json.dumps({
+                "title": "Evaluation",
+                "content": "The final answer is correct and complete.",
+                "next_action": "final_answer",
+            })
+        if 'final answer based on' in last:
+            return CHAT, json.dumps({
+                "title": "Final Answer",
+                "content": f"The answer to '{question}' follows from the steps above.",
+                "next_action": "final_answer",
+            })
+        # The prompt opens with an assistant message of its own, only step replies count. Older
+        # steps may be folded out of the prompt, the last step's title still has its number.
+        steps = [m['content'] for m in messages if m['role'] == 'assistant' and 'next_action' in m['content']]
+        numbered = re.match(r'Step (\d+) ', json.loads(steps[-1]).get('title', '')) if steps else None
+        step = (int(numbered.group(1)) if numbered else len(steps)) + 1
+        return CHAT, json.dumps({
+            "title": f"Step {step} analysis",
+            "content": self._step_content(question, step),
+            "next_action": "final_answer" if step >= self.steps else "continue",
+        })
+
+    @staticmethod
+    def _step_content(question: str, step: int) -> str:
+        return (
+            f"Step {step} of the reasoning about '{question}'. It considers the facts gathered "
+            f"so far, checks them against the question and narrows down the possible answers."
+        )
+
+    @lru_cache(maxsize=4096)
+    def embedding(self, text: str) -> List[float]:
+        """
+        :return: A unit vector seeded by the text's hash.
+        """
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+def _prompt_tokens(body: dict) -> int:
+    # Words stand in for tokens
+    return sum(len(m.get('content', '').split()) for m in body.get('messages', [])) or len(body.get('prompt', '').split())
+
+
+def _handler(fake: FakeOllama):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def do_GET(self):
+            if self.path == '/api/tags':
+                self._send_json({'models': [{'name': 'llama3.1:latest', 'model': 'llama3.1:latest'}]})
+            else:
+                self._send_json({'error': f"unknown endpoint {self.path}"}, status=404)
+
+        def do_POST(self):
+            start = time.perf_counter()
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path in ('/api/embed', '/api/embeddings'):
+                texts = body.get('input', body.get('prompt', ''))
+                texts = [texts] if isinstance(texts, str) else texts
+                time.sleep(fake.embed_latency)
+                embeddings = [fake.embedding(text) for text in texts]
+                if self.path == '/api/embed':
+                    sent = self._send_json({'model': body.get('model'), 'embeddings': embeddings})
+                else:
+                    sent = self._send_json({'embedding': embeddings[0]})
+                fake._record(EMBED, time.perf_counter() - start, sent, len(texts))
+            elif self.path in ('/api/chat', '/api/generate'):
+                if self.path == '/api/chat':
+                    kind, text = fake.reply(body.get('messages', []))
+                else:
+                    kind, text = GENERATE, f"Generated reply to: {body.get('prompt', '')[:80]}"
+                time.sleep(fake.latency)
+                sent = self._reply(body, text, chat=self.path == '/api/chat')
+                fake._record(kind, time.perf_counter() - start, sent, prompt_tokens=_prompt_tokens(body))
+            else:
+                self._send_json({'error': f"unknown endpoint {self.path}"}, status=404)
+
+        def _reply(self, body: dict, text: str, chat: bool) -> int:
+            def message(content: str, done: bool) -> dict:
+                payload = {'model': body.get('model'), 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ'), 'done': done}
+                if chat:
+                    payload['message'] = {'role': 'assistant', 'content': content}
+                else:
+                    payload['response'] = content
+                if done:
+                    # Token counts are words, durations are in nanoseconds like Ollama's
+                    payload.update({
+                        'done_reason': 'stop',
+                        'prompt_eval_count': _prompt_tokens(body),
+                        'eval_count': len(text.split()),
+                        'total_duration': 0,
+                        'eval_duration': int(fake.token_latency * 1e9 * len(text) / fake.chunk_size),
+                    })
+                return payload
+
+            if not body.get('stream', True):
+                # Generated at the same speed as a streamed reply, only sent at once
+                time.sleep(fake.token_latency * ((len(text) + fake.chunk_size - 1) // fake.chunk_size))
+                return self._send_json(message(text, True))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            sent = 0
+            for i in range(0, len(text), fake.chunk_size):
+                sent += self._chunk(message(text[i:i + fake.chunk_size], False))
+                time.sleep(fake.token_latency)
+            sent += self._chunk(message('', True))
+            self.wfile.write(b"0\r\n\r\n")
+            return sent
+
+        def _chunk(self, payload: dict) -> int:
+            line = json.dumps(payload).encode('utf-8') + b"\n"
+            self.wfile.write(f"{len(line):x}\r\n".encode('ascii') + line + b"\r\n")
+            self.wfile.flush()
+            return len(line)
+
+        def _send_json(self, payload: dict, status: int = 200) -> int:
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return len(data)
+
+    return Handler
+
+
+if __name__ == '__main__':
+    # Stand-alone, e.g. to run app.py without a model: OLLAMA_HOST=127.0.0.1:11435 python app.py
+    parser = argparse.ArgumentParser(description="Deterministic fake Ollama server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--dim', type=int, default=4096)
+    parser.add_argument('--steps', type=int, default=7)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--token-latency', type=float, default=0.0)
+    parser.add_argument('--embed-latency', type=float, default=0.0)
+    args = parser.parse_args()
+    fake = FakeOllama(args.host, args.port, args.dim, args.steps, args.latency, args.token_latency, args.embed_latency)
+    print(f"Fake Ollama listening on {fake.url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,342 @@
+"""
+Benchmarks of the reasoning pipeline, run against a fake Ollama server so they need no model.
+
+    python -m bench.run                                   # every suite
+    python -m bench.run --suite pipeline --suite query    # some of them
+    python -m bench.run --suite index --sizes 1000,100000,1000000
+    python -m bench.run --save bench/baselines/local.json
+    python -m bench.run --compare bench/baselines/local.json
+    python -m bench.run --suite query --strategy single_shot --compare bench/baselines/local.json
+
+Results are a flat dict of metrics, saved as JSON. --compare reports every metric that got
+worse than the baseline by more than --tolerance and exits with status 1 if there's any.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from bench.fake_ollama import FakeOllama
+
+logger = logging.getLogger(__name__)
+
+SUITES = ('pipeline', 'query', 'concurrency', 'index')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentiles(name: str, values: Iterable[float]) -> Dict[str, float]:
+    values = list(values)
+    if not values:
+        return {}
+    return {
+        f"{name}.p50": float(np.percentile(values, 50)),
+        f"{name}.p95": float(np.percentile(values, 95)),
+    }
+
+
+class SessionTimer:
+    """
+    Times the stages of one reasoning stream from its SSE events, as a client would see them.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.bytes = 0
+        self.events: Dict[str, int] = {}
+        self.first_event: Optional[float] = None
+        self.steps: List[float] = []
+        self.final: Optional[float] = None
+        self.done: Optional[float] = None
+        self.similar: Optional[float] = None
+        self._buffer = ""
+
+    def feed(self, chunk):
+        # Chunks may split or join events, only complete ones are counted
+        now = time.perf_counter() - self.start
+        text = chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+        self.bytes += len(text.encode('utf-8'))
+        self._buffer += text
+        while "\n\n" in self._buffer:
+            event, self._buffer = self._buffer.split("\n\n", 1)
+            data = next((line[6:] for line in event.splitlines() if line.startswith('data: ')), None)
+            if data is None:
+                continue
+            if self.first_event is None:
+                self.first_event = now
+            kind = json.loads(data).get('type', 'unknown')
+            self.events[kind] = self.events.get(kind, 0) + 1
+            if kind == 'step':
+                self.steps.append(now)
+            elif kind == 'final':
+                self.final = now
+            elif kind == 'done':
+                self.done = now
+            elif kind == 'similar':
+                self.similar = now
+
+    @property
+    def total(self) -> float:
+        return self.similar or self.done or time.perf_counter() - self.start
+
+
+def stage_metrics(prefix: str, timers: List[SessionTimer]) -> Dict[str, float]:
+    metrics = {}
+    metrics.update(percentiles(f"{prefix}.session_s", [t.total for t in timers]))
+    metrics.update(percentiles(f"{prefix}.first_event_s", [t.first_event for t in timers if t.first_event is not None]))
+    metrics.update(percentiles(f"{prefix}.first_step_s", [t.steps[0] for t in timers if t.steps]))
+    metrics.update(percentiles(f"{prefix}.step_interval_s", [b - a for t in timers for a, b in zip(t.steps, t.steps[1:])]))
+    metrics.update(percentiles(f"{prefix}.final_s", [t.final - t.steps[-1] for t in timers if t.final and t.steps]))
+    metrics.update(percentiles(f"{prefix}.similar_s", [t.similar - t.done for t in timers if t.similar and t.done]))
+    metrics[f"{prefix}.sse_bytes_per_session"] = float(np.mean([t.bytes for t in timers]))
+    metrics[f"{prefix}.events_per_session"] = float(np.mean([sum(t.events.values()) for t in timers]))
+    return metrics
+
+
+def model_metrics(prefix: str, fake: FakeOllama, sessions: int) -> Dict[str, float]:
+    # What the fake server saw: calls and time spent answering, per kind of call
+    metrics = {}
+    for kind, stats in fake.stats().items():
+        metrics[f"{prefix}.model.{kind}_calls_per_session"] = stats['calls'] / sessions
+        metrics[f"{prefix}.model.{kind}_time_s_per_session"] = stats['time_s'] / sessions
+        if stats['prompt_tokens']:
+            metrics[f"{prefix}.model.{kind}_prompt_tokens_per_session"] = stats['prompt_tokens'] / sessions
+    return metrics
+
+
+def bench_pipeline(fake: FakeOllama, sessions: int, strategy: str) -> Dict[str, float]:
+    """
+    A strategy on its own (generate_response by default): the reasoning loop, its
+    embedding and titling pipeline and the graph updates, without Flask.
+    """
+    from db.embeddings import get_db
+    from strategies.registry import get_strategy
+    generate_response = get_strategy(strategy).generate
+
+    fake.reset_stats()
+    timers = []
+    for i in range(sessions):
+        emb_db = get_db('embeddings.db', f"bench-pipeline-{i}")
+        timer = SessionTimer()
+        for event in generate_response(f"Pipeline benchmark question number {i}?", emb_db):
+            timer.feed(event)
+        timers.append(timer)
+        emb_db.flush()
+    return {**stage_metrics('pipeline', timers), **model_metrics('pipeline', fake, sessions)}
+
+
+def run_query(client, question: str, strategy: str) -> SessionTimer:
+    timer = SessionTimer()
+    response = client.get('/query', query_string={'query': question, 'cache': 'false', 'strategy': strategy},
+                          buffered=False)
+    try:
+        for chunk in response.response:
+            timer.feed(chunk)
+    finally:
+        response.close()
+    return timer
+
+
+def bench_query(fake: FakeOllama, sessions: int, strategy: str) -> Dict[str, float]:
+    """
+    /query end to end through the Flask app: question embedding, reasoning, answer cache
+    bookkeeping and the 'similar' search.
+    """
+    from app import app
+
+    fake.reset_stats()
+    client = app.test_client()
+    timers = [run_query(client, f"Query benchmark question number {i}?", strategy) for i in range(sessions)]
+    return {**stage_metrics('query', timers), **model_metrics('query', fake, sessions)}
+
+
+def bench_concurrency(fake: FakeOllama, sessions: int, workers: int, strategy: str) -> Dict[str, float]:
+    """
+    Sessions/s of the Flask app with `workers` /query streams open at once. The fake model's
+    latency makes the streams overlap like they would against a real one.
+    """
+    from app import app
+
+    def one(i):
+        return run_query(app.test_client(), f"Concurrency benchmark question number {i}?", strategy)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        timers = list(executor.map(one, range(sessions)))
+    elapsed = time.perf_counter() - start
+    metrics = {
+        'concurrency.sessions_per_s': sessions / elapsed,
+        'concurrency.workers': float(workers),
+    }
+    metrics.update(percentiles('concurrency.session_s', [t.total for t in timers]))
+    return metrics
+
+
+def bench_index(sizes: List[int], dim: int, queries: int, dtype: str) -> Dict[str, float]:
+    """
+    Vector segment ingestion, Annoy index build, ANN and exact query times and ANN recall
+    over synthetic unit vectors.
+    """
+    from db.index import VectorIndex
+    from db.segment import VectorSegment
+
+    metrics = {}
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        prefix = f"index.{size}"
+        with tempfile.TemporaryDirectory() as directory:
+            segment = VectorSegment(os.path.join(directory, 'bench.vectors'), dim, dtype=dtype)
+            start = time.perf_counter()
+            for offset in range(0, size, 10_000):
+                count = min(10_000, size - offset)
+                vectors = rng.standard_normal((count, dim), dtype=np.float32)
+                segment.append_many(range(offset + 1, offset + count + 1), vectors)
+            metrics[f"{prefix}.ingest_s"] = time.perf_counter() - start
+
+            index = VectorIndex(vector_size=dim, segment=segment)
+            start = time.perf_counter()
+            index.load_segment((id, None) for id in range(1, size + 1))
+            metrics[f"{prefix}.build_s"] = time.perf_counter() - start
+
+            probes = rng.standard_normal((queries, dim), dtype=np.float32)
+            ann, found = [], []
+            for probe in probes:
+                start = time.perf_counter()
+                found.append([id for id, _ in index.query(probe, 10)])
+                ann.append(time.perf_counter() - start)
+            metrics.update(percentiles(f"{prefix}.query_s", ann))
+
+            # Exact scans are slow on big segments, a few are enough for the timing and the recall
+            exact, recall = [], []
+            for probe, ann_ids in list(zip(probes, found))[:10]:
+                start = time.perf_counter()
+                truth = [id for id, _ in segment.scan(probe, 10)]
+                exact.append(time.perf_counter() - start)
+                recall.append(len(set(truth) & set(ann_ids)) / len(truth))
+            metrics.update(percentiles(f"{prefix}.scan_s", exact))
+            metrics[f"{prefix}.recall_at_10"] = float(np.mean(recall))
+            metrics[f"{prefix}.segment_bytes_per_vector"] = sum(
+                os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+                if name.startswith('bench.vectors.') and not name.endswith('.ann')
+            ) / size
+            segment.close()
+    return metrics
+
+
+def higher_is_better(metric: str) -> bool:
+    return metric.endswith('_per_s') or 'recall' in metric
+
+
+def compare(metrics: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    """
+    Prints every metric next to its baseline.
+
+    :return: The metrics that got worse than the baseline by more than tolerance (a fraction).
+    """
+    regressions = []
+    print(f"{'metric':<55} {'baseline':>12} {'current':>12} {'change':>8}")
+    for metric in sorted(set(metrics) & set(baseline)):
+        old, new = baseline[metric], metrics[metric]
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_is_better(metric) else change
+        flag = ""
+        if worse > tolerance and metric not in ('concurrency.workers',):
+            regressions.append(metric)
+            flag = "  REGRESSION"
+        print(f"{metric:<55} {old:>12.6g} {new:>12.6g} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks of the reasoning pipeline against a fake Ollama server")
+    parser.add_argument('--suite', action='append', choices=SUITES, help="Suite to run, repeatable (default: all)")
+    parser.add_argument('--sessions', type=int, default=5, help="Sessions per pipeline/query suite")
+    parser.add_argument('--concurrent-sessions', type=int, default=32, help="Sessions of the concurrency suite")
+    parser.add_argument('--workers', type=int, default=8, help="Streams open at once in the concurrency suite")
+    parser.add_argument('--sizes', default='1000,100000', help="Index sizes, comma separated (1000000 needs ~8 GB of disk at 4096 dims)")
+    parser.add_argument('--dim', type=int, default=4096, help="Embedding size")
+    parser.add_argument('--queries', type=int, default=100, help="Queries per index size")
+    parser.add_argument('--dtype', default='float16', help="Vector segment storage type of the index suite")
+    parser.add_argument('--strategy', default='stepwise', help="Reasoning strategy of the pipeline, query and concurrency suites")
+    parser.add_argument('--steps', type=int, default=7, help="Reasoning steps the fake model takes per question")
+    parser.add_argument('--latency', type=float, default=0.01, help="Fake model seconds per chat call")
+    parser.add_argument('--token-latency', type=float, default=0.0, help="Fake model seconds per streamed chunk")
+    parser.add_argument('--embed-latency', type=float, default=0.0, help="Fake model seconds per embed call")
+    parser.add_argument('--save', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="Baseline JSON file to compare the results with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed slowdown before a metric counts as a regression")
+    parser.add_argument('--verbose', action='store_true', help="Keep the app's logging")
+    args = parser.parse_args(argv)
+    suites = args.suite or list(SUITES)
+    config = {key: value for key, value in vars(args).items() if key not in ('save', 'compare', 'verbose')}
+
+    with FakeOllama(dim=args.dim, steps=args.steps, latency=args.latency, token_latency=args.token_latency,
+                    embed_latency=args.embed_latency) as fake, tempfile.TemporaryDirectory() as workdir:
+        # The ollama client reads its host once, when it's imported with the app
+        os.environ['OLLAMA_HOST'] = fake.url
+        os.environ.setdefault('NO_PROXY', '127.0.0.1,localhost')
+        os.environ['EMBEDDING_CACHE_DB'] = ''
+        sys.path.insert(0, ROOT)
+        cwd = os.getcwd()
+        os.chdir(workdir)  # embeddings.db and its vector files
+        if not args.verbose:
+            import app  # noqa: F401, configures logging on import
+            logging.disable(logging.WARNING)
+        metrics: Dict[str, float] = {}
+        try:
+            if 'pipeline' in suites:
+                metrics.update(bench_pipeline(fake, args.sessions, args.strategy))
+            if 'query' in suites:
+                metrics.update(bench_query(fake, args.sessions, args.strategy))
+            if 'concurrency' in suites:
+                metrics.update(bench_concurrency(fake, args.concurrent_sessions, args.workers, args.strategy))
+            if 'index' in suites:
+                sizes = [int(size) for size in args.sizes.split(',') if size]
+                metrics.update(bench_index(sizes, args.dim, args.queries, args.dtype))
+        finally:
+            os.chdir(cwd)
+
+    result = {
+        'meta': {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'config': config,
+        'metrics': metrics,
+    }
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print("Warning: the baseline was run with a different configuration", file=sys.stderr)
+        return 1 if compare(metrics, baseline['metrics'], args.tolerance) else 0
+    for metric in sorted(metrics):
+        print(f"{metric:<55} {metrics[metric]:>12.6g}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,2 +1,3 @@
 from .api import API as API
+from .api import AsyncAPI as AsyncAPI
 from .get_short_title import get_short_title as get_short_title
\ No newline at end of file
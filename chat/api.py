@@ -1,38 +1,129 @@
+import asyncio
 import requests
 import json
+import os
 import numpy as np
 import ollama
 import logging
+from .embedding_cache import EmbeddingCache, get_embedding_cache
+from .scheduler import EMBED, REASONING, LLMScheduler, get_scheduler
+from tracing import Tracer, get_tracer
 logger = logging.getLogger(__name__)
 
+# Model computing the embeddings, separate from the chat model so a small, fast one can be
+# used (e.g. nomic-embed-text). Stored vectors must be re-embedded when it changes, see db.reembed.
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'llama3.1')
+
 class API:
-    def __init__(self, model: str = "llama3.1", options: ollama.Options = []):
+    def __init__(self, model: str = "llama3.1", options: ollama.Options = [], cache: bool = True, session: str = None,
+                 embedding_model: str = None):
         """
-        Initializes the SQLiteDB object by creating a connection to the SQLite database.
+        Initializes the API client.
 
-        :param db_file: Path to the SQLite database file.
+        :param model: Name of the ollama model.
+        :param options: ollama options passed with every call.
+        :param embedding_model: Name of the ollama model for embed, defaults to EMBEDDING_MODEL.
+        :param cache: Serve repeated embeddings from the shared embedding cache.
+        :param session: Session the calls are made for, the scheduler lets sessions take turns.
         """
         self.model = model
+        self.embedding_model = embedding_model or EMBEDDING_MODEL
         self.options = options
+        self.cache: EmbeddingCache = get_embedding_cache() if cache else None
+        self.session = session
+        # Every call waits for its turn on the process-wide scheduler
+        self.scheduler: LLMScheduler = get_scheduler()
+        # Model calls are timed and their token counts kept, see /metrics
+        self.tracer: Tracer = get_tracer()
+
+    def chat(self, messages, stream: bool = False, kind: str = REASONING, format=''):
+        """
+        Sends a chat request.
 
-    def chat(self, messages):
+        :param messages: The conversation so far.
+        :param stream: Return an iterator of response chunks as tokens are generated.
+        :param kind: Scheduling priority of the call, REASONING or TITLE.
+        :param format: Constrains the reply: 'json' for any JSON, a JSON schema dict for
+            replies matching it (Ollama 0.5+), '' for free text.
+        :return: The response, or an iterator of chunks when streaming.
+        """
         logger.debug(f"chat: {messages[-1]}")
-        response = ollama.chat(model=self.model, messages=messages, options=self.options)
+        if stream:
+            return self._chat_stream(messages, kind, format)
+        with self.scheduler.slot(kind, self.session), self.tracer.span('chat', self.session):
+            response = ollama.chat(model=self.model, messages=messages, options=self.options, format=format)
+        self.tracer.record_response(kind, response, self.session)
         logger.debug(f"chat log:\nresponse:\n{response}\nrequest:\n{messages}")
         return response
 
-    def generate(self, prompt):
-        response = ollama.generate(model=self.model, prompt=prompt, options=self.options)
+    def _chat_stream(self, messages, kind, format=''):
+        content = ""
+        # The slot is held until the last token, the model is busy until then
+        with self.scheduler.slot(kind, self.session), self.tracer.span('chat', self.session):
+            for chunk in ollama.chat(model=self.model, messages=messages, options=self.options, format=format, stream=True):
+                content += chunk['message']['content']
+                if chunk.get('done'):
+                    # Only the last chunk carries the token counts
+                    self.tracer.record_response(kind, chunk, self.session)
+                yield chunk
+        logger.debug(f"chat log:\nresponse:\n{content}\nrequest:\n{messages}")
+
+    def generate(self, prompt, kind: str = REASONING):
+        with self.scheduler.slot(kind, self.session), self.tracer.span('generate', self.session):
+            response = ollama.generate(model=self.model, prompt=prompt, options=self.options)
+        self.tracer.record_response(kind, response, self.session)
         print(response)
         return response
     
     def embed(self, input):
-        response_data = ollama.embed(model=self.model, input=input, options=self.options)
+        """
+        Embeds a text, or a list of texts in one batch, going to the model only for
+        texts that aren't cached yet.
+
+        :param input: A text or a list of texts.
+        :return: A vector for a single text, a matrix with one row per text for a list.
+        """
+        lookup = self._cache_lookup(input)
+        if lookup is None:
+            return self._embed(input)
+        texts, keys, embeddings, missing = lookup
+        if missing:
+            self._cache_store(keys, embeddings, missing, self._embed([texts[i] for i in missing]))
+        if isinstance(input, str):
+            return embeddings[0]
+        return np.stack(embeddings)
+
+    def _cache_lookup(self, input):
+        # (texts, keys, cached embeddings or None, indexes of the missing ones), None if the cache doesn't apply
+        if self.cache is None or str(input) == "" or (not isinstance(input, str) and not input):
+            return None
+        texts = [input] if isinstance(input, str) else list(input)
+        keys = [EmbeddingCache.key(self.embedding_model, self.options, text) for text in texts]
+        embeddings = [self.cache.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        return texts, keys, embeddings, missing
+
+    def _cache_store(self, keys, embeddings, missing, computed):
+        for i, embedding in zip(missing, computed):
+            self.cache.put(keys[i], embedding)
+            embeddings[i] = embedding
+
+    def _embed(self, input):
+        with self.scheduler.slot(EMBED, self.session), self.tracer.span('embed', self.session):
+            response_data = ollama.embed(model=self.embedding_model, input=input, options=self.options)
+        self.tracer.record_response(EMBED, response_data, self.session)
+        return self._embedding_from_response(response_data, input)
+
+    @staticmethod
+    def _embedding_from_response(response_data, input):
         if 'embedding' in response_data:
             return np.array(response_data['embedding'], dtype=np.float32)
         elif 'embeddings' in response_data:
             if (response_data['embeddings']):
                 # logger.debug(f"embedding tail: {np.array(response_data['embeddings'][1::], dtype=np.float32).shape}") if response_data['embeddings'][1::] else None
+                if isinstance(input, str):
+                    # A single text gets a single vector, not a batch of one
+                    return np.array(response_data['embeddings'][0], dtype=np.float32)
                 return np.array(response_data['embeddings'], dtype=np.float32)
             elif str(input) == "":
                 return np.array([], dtype=np.float32)
@@ -42,49 +133,86 @@ class API:
             raise KeyError(f"No embedding found in API response. Response: {response_data}, Input: {input}")
 
 
-# def stream_api_call(messages, max_tokens):
-#     prompt = json.dumps(messages)
-#     data = {
-#         "model": "llama3.1",
-#         "prompt": prompt,
-#         "max_tokens": max_tokens,
-#         "temperature": 0.2,
-#         "stream": True
-#     }
-#     try:
-#         response = requests.post('http://localhost:11434/api/generate', 
-#                                  headers={'Content-Type': 'application/json'}, 
-#                                  data=json.dumps(data),
-#                                  stream=True)
-#         response.raise_for_status()
-#         full_response = ""
-#         for line in response.iter_lines():
-#             if line:
-#                 chunk = json.loads(line.decode('utf-8'))
-#                 if 'response' in chunk:
-#                     full_response += chunk['response'].replace("'",'')
-#                     yield chunk['response'].replace("'",'')
-#         if full_response:
-#             return json.loads(full_response.replace("'",''))
-#         else:
-#             raise ValueError("Empty response from API")
-#     except Exception as e:
-#         error_message = f"Failed to generate response. Error: {str(e)}"
-#         return {"title": "Error", "content": error_message, "next_action": "final_answer"}
-
-# def get_embedding(text):
-#     headers = {'Content-Type': 'application/json'}
-#     data = json.dumps({"model": "llama3.1", "input": text})
-#     response = requests.post('http://localhost:11434/api/embed', headers=headers, data=data)
-    
-#     if response.status_code != 200:
-#         raise Exception(f"API request failed with status code {response.status_code}: {response.text}")
-    
-#     response_data = response.json()
-    
-#     if 'embedding' in response_data:
-#         return np.array(response_data['embedding'], dtype=np.float32)
-#     elif 'embeddings' in response_data and response_data['embeddings']:
-#         return np.array(response_data['embeddings'][0], dtype=np.float32)
-#     else:
-#         raise KeyError(f"No embedding found in API response. Response: {response_data}")
\ No newline at end of file
+class AsyncAPI(API):
+    """
+    The same calls as API, as coroutines on ollama.AsyncClient. Meant for the ASGI app,
+    where waiting on the model must not hold a thread.
+    """
+
+    def __init__(self, model: str = "llama3.1", options: ollama.Options = [], cache: bool = True, session: str = None, host: str = None,
+                 embedding_model: str = None):
+        """
+        :param model: Name of the ollama model.
+        :param options: ollama options passed with every call.
+        :param embedding_model: Name of the ollama model for embed, defaults to EMBEDDING_MODEL.
+        :param cache: Serve repeated embeddings from the shared embedding cache.
+        :param session: Session the calls are made for, the scheduler lets sessions take turns.
+        :param host: ollama server, defaults to OLLAMA_HOST like the synchronous client.
+        """
+        super().__init__(model=model, options=options, cache=cache, session=session, embedding_model=embedding_model)
+        self.client = ollama.AsyncClient(host=host)
+
+    async def chat(self, messages, stream: bool = False, kind: str = REASONING, format=''):
+        """
+        Sends a chat request.
+
+        :param messages: The conversation so far.
+        :param stream: Return an async iterator of response chunks as tokens are generated.
+        :param kind: Scheduling priority of the call, REASONING or TITLE.
+        :param format: Constrains the reply, see API.chat.
+        :return: The response, or an async iterator of chunks when streaming.
+        """
+        logger.debug(f"chat: {messages[-1]}")
+        if stream:
+            return self._chat_stream(messages, kind, format)
+        async with self.scheduler.aslot(kind, self.session):
+            with self.tracer.span('chat', self.session):
+                response = await self.client.chat(model=self.model, messages=messages, options=self.options, format=format)
+        self.tracer.record_response(kind, response, self.session)
+        logger.debug(f"chat log:\nresponse:\n{response}\nrequest:\n{messages}")
+        return response
+
+    async def _chat_stream(self, messages, kind, format=''):
+        content = ""
+        async with self.scheduler.aslot(kind, self.session):
+            with self.tracer.span('chat', self.session):
+                async for chunk in await self.client.chat(model=self.model, messages=messages, options=self.options, format=format, stream=True):
+                    content += chunk['message']['content']
+                    if chunk.get('done'):
+                        self.tracer.record_response(kind, chunk, self.session)
+                    yield chunk
+        logger.debug(f"chat log:\nresponse:\n{content}\nrequest:\n{messages}")
+
+    async def generate(self, prompt, kind: str = REASONING):
+        async with self.scheduler.aslot(kind, self.session):
+            with self.tracer.span('generate', self.session):
+                response = await self.client.generate(model=self.model, prompt=prompt, options=self.options)
+        self.tracer.record_response(kind, response, self.session)
+        logger.debug(f"generate log:\nresponse:\n{response}\nrequest:\n{prompt}")
+        return response
+
+    async def embed(self, input):
+        """
+        Embeds a text, or a list of texts in one batch, going to the model only for
+        texts that aren't cached yet.
+
+        :param input: A text or a list of texts.
+        :return: A vector for a single text, a matrix with one row per text for a list.
+        """
+        # Misses in memory go to the cache's SQLite tier, off the event loop
+        lookup = await asyncio.to_thread(self._cache_lookup, input)
+        if lookup is None:
+            return await self._embed(input)
+        texts, keys, embeddings, missing = lookup
+        if missing:
+            self._cache_store(keys, embeddings, missing, await self._embed([texts[i] for i in missing]))
+        if isinstance(input, str):
+            return embeddings[0]
+        return np.stack(embeddings)
+
+    async def _embed(self, input):
+        async with self.scheduler.aslot(EMBED, self.session):
+            with self.tracer.span('embed', self.session):
+                response_data = await self.client.embed(model=self.embedding_model, input=input, options=self.options)
+        self.tracer.record_response(EMBED, response_data, self.session)
+        return self._embedding_from_response(response_data, input)
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import numpy as np
+
+from db.embedding_cache import EmbeddingCacheDB
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache: a bounded in-process LRU in front of a persistent SQLite store.
+
+    Entries are keyed by a hash of (model, options, text), so the same text embedded with
+    another model or other options is a different entry.
+    """
+
+    def __init__(self, db_file: Optional[str] = 'embedding_cache.db', max_entries: int = 4096,
+                 max_rows: int = 200_000, evict_every: int = 1000):
+        """
+        :param db_file: Path to the persistent store, None to keep the cache in memory only.
+        :param max_entries: Size limit of the in-process LRU.
+        :param max_rows: Size limit of the persistent store, oldest entries are evicted first.
+        :param evict_every: Number of stores between two evictions on the persistent store.
+        """
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.evict_every = evict_every
+        self.db = EmbeddingCacheDB(db_file) if db_file else None
+        self._lru: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stores = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, options, text: str) -> str:
+        """
+        :return: The cache key of a text embedded with the given model and options.
+        """
+        payload = json.dumps([model, options or {}, text], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        Looks an embedding up in memory, then on disk.
+
+        :param key: The cache key.
+        :return: The embedding if cached, otherwise None.
+        """
+        with self._lock:
+            embedding = self._lru.get(key)
+            if embedding is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return embedding
+        blob = self.db.get(key) if self.db else None
+        with self._lock:
+            if blob is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            embedding = np.frombuffer(blob, dtype=np.float32)
+            self._remember(key, embedding)
+            return embedding
+
+    def put(self, key: str, embedding: np.ndarray):
+        """
+        Stores an embedding in both tiers. The disk write is queued behind the caller.
+
+        :param key: The cache key.
+        :param embedding: The embedding.
+        """
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.setflags(write=False)  # shared by every caller that hits this entry
+        with self._lock:
+            self._remember(key, embedding)
+            self._stores += 1
+            evict = self._stores % self.evict_every == 0
+        if self.db:
+            self.db.defer(self.db.put, key, embedding.tobytes())
+            if evict:
+                self.db.defer(self.db.evict, self.max_rows)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: Hit/miss counters and the in-memory size.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self._lru),
+            }
+
+    def clear(self):
+        """
+        Empties the in-process tier and resets the counters.
+        """
+        with self._lock:
+            self._lru.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def _remember(self, key: str, embedding: np.ndarray):
+        # Caller holds the lock
+        self._lru[key] = embedding
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """
+    Returns the process-wide embedding cache. The persistent store lives in
+    EMBEDDING_CACHE_DB (default 'embedding_cache.db'), an empty value keeps it in memory only.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache(
+                db_file=os.environ.get('EMBEDDING_CACHE_DB', 'embedding_cache.db') or None,
+                max_entries=int(os.environ.get('EMBEDDING_CACHE_SIZE', 4096)),
+            )
+        return _cache
@@ -1,22 +1,116 @@
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
 from .api import API
+from .scheduler import TITLE
+from tracing import get_tracer
 
+# Use the model when the local titler can't find enough keywords (TITLE_LLM_FALLBACK=1)
+LLM_FALLBACK = os.environ.get('TITLE_LLM_FALLBACK', '') == '1'
+MAX_LENGTH = 20
+CACHE_SIZE = 2048
 
-def get_short_title(content):
+STOPWORDS = frozenset("""
+a about above after again against all also am an and any are as at be because been before being
+below between both but by can could did do does doing down during each few first for from further
+had has have having he her here hers herself him himself his how i if in into is it its itself
+just let lets let's me more most my myself need needs next no nor not now of off on once only or
+other our ours ourselves out over own same she should so some step such than that the their theirs
+them themselves then there these they this those through to too under until up very was we were
+what when where which while who whom why will with would you your yours yourself yourselves
+consider considering look looking think thinking start starting begin beginning well okay
+""".split())
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_stats = {'local': 0, 'cached': 0, 'llm_fallback': 0}
+
+
+def llm_short_title(content, session=None):
     api = API(
         options={
             "num_ctx": 50
-    })
+    }, session=session)
     messages = [
         {"role": "system", "content": "You are a concise summarizer. Provide a very short title (under 20 characters) for the given content."},
         {"role": "user", "content": f"Summarize this in under 20 characters: \n{content}"}
     ]
-    
-    # title_data = ""
-    # for chunk in stream_api_call(messages, 50):
-    #     title_data += chunk
 
-    response = api.chat(messages=messages)
-    
-    short_title = response['message']['content'].strip()[:20]
+    response = api.chat(messages=messages, kind=TITLE)
+
+    short_title = response['message']['content'].strip()[:MAX_LENGTH]
+
+    return short_title
+
+
+def local_short_title(content, max_length=MAX_LENGTH):
+    """
+    Builds a title from the leading keywords of the content's first sentence, without a model call.
+
+    :param content: The text to title.
+    :param max_length: Maximum title length.
+    :return: A (title, number of keywords) tuple; the title is empty if no keyword was found.
+    """
+    text = re.sub(r'[`*_#>\[\]()]', ' ', content)
+    keywords = []
+    # First sentence that has any keyword, a leading "Step 1:" alone doesn't count
+    for sentence in re.split(r'(?<=[.!?:;])\s+|\n+', text):
+        words = re.findall(r"[\w][\w'\-+]*", sentence)
+        keywords = [w for w in words if w.lower() not in STOPWORDS and len(w) > 1 and not w.isdigit()]
+        if keywords:
+            break
+    if not keywords:
+        return "", 0
+
+    title, used = keywords[0][:max_length], 1
+    for word in keywords[1:]:
+        if len(title) + 1 + len(word) > max_length:
+            break
+        title += " " + word
+        used += 1
+    return title[0].upper() + title[1:], used
+
+
+def get_short_title(content, llm_fallback=None, session=None):
+    """
+    Returns a short title (at most 20 characters) for a step's content. Titles are built
+    locally and cached; the model is only asked when the fallback is enabled and the
+    local titler found fewer than two keywords.
+
+    :param content: The text to title.
+    :param llm_fallback: Override for the TITLE_LLM_FALLBACK setting.
+    :param session: Session the model fallback is called for.
+    :return: The title.
+    """
+    key = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            _stats['cached'] += 1
+            return _cache[key]
+
+    with get_tracer().span('title', session):
+        short_title, keywords = local_short_title(content)
+        if keywords < 2 and (LLM_FALLBACK if llm_fallback is None else llm_fallback):
+            short_title = llm_short_title(content, session)
+            source = 'llm_fallback'
+        else:
+            source = 'local'
+    short_title = short_title or content.strip()[:MAX_LENGTH] or "Untitled"
+
+    with _lock:
+        _stats[source] += 1
+        _cache[key] = short_title
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return short_title
+
 
-    return short_title
\ No newline at end of file
+def title_stats():
+    """
+    :return: How many titles came from the local titler, the cache and the model fallback.
+    """
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,179 @@
+import asyncio
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Kinds of model calls, from the most to the least urgent
+REASONING = 'reasoning'
+EMBED = 'embed'
+TITLE = 'title'
+PRIORITIES = (REASONING, EMBED, TITLE)
+
+
+class _Ticket:
+    __slots__ = ('kind', 'session', 'enqueued', 'granted', 'notify')
+
+    def __init__(self, kind, session, notify):
+        self.kind = kind
+        self.session = session
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.notify = notify
+
+
+class LLMScheduler:
+    """
+    Orders the model calls of every session in the process and caps how many run at once.
+
+    Waiting calls are served by kind first (reasoning, then embed, then title), so the
+    interactive path keeps its latency while background work waits. Within a kind,
+    sessions take turns, so one busy session can't starve the others. Threads and asyncio
+    tasks wait in the same queue.
+    """
+
+    def __init__(self, max_concurrent: int = 4):
+        """
+        :param max_concurrent: Number of calls running at once, best set to the model server's parallelism.
+        """
+        self.max_concurrent = max_concurrent
+        self._lock = threading.Lock()
+        self._running = 0
+        # kind -> session -> waiting tickets, sessions in turn order
+        self._queues: Dict[str, "OrderedDict[Optional[str], deque]"] = {kind: OrderedDict() for kind in PRIORITIES}
+        self._stats = {kind: {'calls': 0, 'waiting': 0, 'running': 0, 'wait_total': 0.0, 'wait_max': 0.0} for kind in PRIORITIES}
+
+    @contextmanager
+    def slot(self, kind: str, session: Optional[str] = None):
+        """
+        Blocks until the call may run and holds its slot for the duration of the block.
+
+        :param kind: REASONING, EMBED or TITLE.
+        :param session: Session the call belongs to, for fair queuing.
+        """
+        granted = threading.Event()
+        ticket = self._enqueue(kind, session, granted.set)
+        granted.wait()
+        try:
+            yield
+        finally:
+            self._release(ticket)
+
+    @asynccontextmanager
+    async def aslot(self, kind: str, session: Optional[str] = None):
+        """
+        asyncio version of slot.
+        """
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        ticket = self._enqueue(kind, session, notify)
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if not self._withdraw(ticket):
+                self._release(ticket)  # Granted while being cancelled
+            raise
+        try:
+            yield
+        finally:
+            self._release(ticket)
+
+    def stats(self) -> dict:
+        """
+        :return: Per kind: calls started, calls waiting and running, total and longest wait in seconds.
+        """
+        with self._lock:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'running': self._running,
+                'kinds': {kind: dict(stats) for kind, stats in self._stats.items()},
+            }
+
+    def _enqueue(self, kind: str, session: Optional[str], notify) -> _Ticket:
+        if kind not in self._queues:
+            raise ValueError(f"Unknown call kind: {kind}")
+        ticket = _Ticket(kind, session, notify)
+        with self._lock:
+            self._queues[kind].setdefault(session, deque()).append(ticket)
+            self._stats[kind]['waiting'] += 1
+            granted = self._dispatch()
+        for ticket_ in granted:
+            ticket_.notify()
+        return ticket
+
+    def _withdraw(self, ticket: _Ticket) -> bool:
+        # Drops a ticket that is still waiting, False if it was granted already
+        with self._lock:
+            if ticket.granted:
+                return False
+            sessions = self._queues[ticket.kind]
+            tickets = sessions[ticket.session]
+            tickets.remove(ticket)
+            if not tickets:
+                del sessions[ticket.session]
+            self._stats[ticket.kind]['waiting'] -= 1
+            return True
+
+    def _release(self, ticket: _Ticket):
+        with self._lock:
+            self._running -= 1
+            self._stats[ticket.kind]['running'] -= 1
+            granted = self._dispatch()
+        for ticket_ in granted:
+            ticket_.notify()
+
+    def _dispatch(self):
+        # Caller holds the lock. Grants free slots to the next tickets in line.
+        granted = []
+        while self._running < self.max_concurrent:
+            sessions = next((queue for queue in self._queues.values() if queue), None)
+            if sessions is None:
+                break
+            session, tickets = next(iter(sessions.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                sessions.move_to_end(session)  # Next call of this session waits for the others' turn
+            else:
+                del sessions[session]
+
+            wait = time.monotonic() - ticket.enqueued
+            stats = self._stats[ticket.kind]
+            stats['waiting'] -= 1
+            stats['running'] += 1
+            stats['calls'] += 1
+            stats['wait_total'] += wait
+            stats['wait_max'] = max(stats['wait_max'], wait)
+            if wait > 1:
+                logger.debug(f"{ticket.kind} call of session {ticket.session} waited {wait:.2f} s")
+
+            ticket.granted = True
+            self._running += 1
+            granted.append(ticket)
+        return granted
+
+
+_scheduler: Optional[LLMScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> LLMScheduler:
+    """
+    Returns the process-wide scheduler. Its cap is LLM_CONCURRENCY, or the model server's
+    OLLAMA_NUM_PARALLEL when that's set in the same environment (default 4).
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LLMScheduler(
+                max_concurrent=int(os.environ.get('LLM_CONCURRENCY') or os.environ.get('OLLAMA_NUM_PARALLEL') or 4),
+            )
+        return _scheduler
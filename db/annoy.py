@@ -2,36 +2,43 @@
 from annoy import AnnoyIndex
 import numpy as np
 from db.embeddings import EmbeddingDB
+from db.search import search_many
 
 
-def build_annoy_index(conn: EmbeddingDB, vector_size=4096, n_trees=10):
-    
-    total_vectors = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
-    
+def build_annoy_index(conn: EmbeddingDB, vector_size=None, n_trees=10, filename='embeddings.ann'):
+    """
+    Builds a standalone Annoy index over every stored embedding and saves it to disk.
+    Queries don't need this, they go through the resident index (see db.index).
+
+    :param vector_size: Expected dimension, defaults to the one recorded in the database.
+    :raises ValueError: If the stored vectors have another dimension.
+    """
+    dim = conn.embedding_dim
+    vector_size = vector_size or dim
+    if vector_size is None:
+        print("Nothing to index.")
+        return
+    if dim is not None and dim != vector_size:
+        raise ValueError(f"Embedding size mismatch. Expected {vector_size}, the database holds {dim}-dimension vectors.")
     annoy_index = AnnoyIndex(vector_size, 'angular')
-    
-    for i, (id, embedding_blob) in enumerate(conn.execute("SELECT id, embedding FROM embeddings").fetchall()):
-        embedding = np.frombuffer(embedding_blob, dtype=np.float32)
-        if len(embedding) != vector_size:
-            print(f"Warning: Embedding size mismatch. Expected {vector_size}, got {len(embedding)}. Skipping this vector.")
-            continue
-        annoy_index.add_item(id - 1, embedding)
+
+    # Decoded from the memory-mapped segment a chunk at a time
+    ids = [row[0] for row in conn.fetch_all("SELECT id FROM embeddings")]
+    for chunk_ids, matrix in conn.segment.iter_chunks(ids):
+        for id, embedding in zip(chunk_ids, matrix):
+            annoy_index.add_item(int(id) - 1, embedding)
     
     print("Building index...")
     annoy_index.build(n_trees)
-    annoy_index.save('embeddings.ann')
+    annoy_index.save(filename)
     print("Index built and saved")
 
-def find_similar(conn: EmbeddingDB, query_embedding, top_k=5):
-    annoy_index = AnnoyIndex(4096, 'angular')
-    annoy_index.load('embeddings.ann')
-    
-    similar_ids, distances = annoy_index.get_nns_by_vector(query_embedding, top_k, include_distances=True)
-    
-    results = []
-    for id, distance in zip(similar_ids, distances):
-        text, is_question = conn.execute("SELECT text, is_question FROM embeddings WHERE id = ?", (id + 1,)).fetchone()
-        similarity = 1 - distance
-        results.append((id + 1, text, similarity, bool(is_question)))
-    
-    return results
\ No newline at end of file
+def find_similar(conn: EmbeddingDB, query_embedding, top_k=5, session_id=None):
+    """
+    Finds the stored texts closest to the query embedding.
+    See db.search.search_many for many queries at once and filters.
+
+    :param session_id: Only search rows of this session, None to search all history.
+    :return: A list of (id, text, similarity, is_question) tuples, best first.
+    """
+    return search_many(conn, query_embedding, top_k, session_id)[0]
@@ -0,0 +1,114 @@
+import time
+from db.sqlite import SQLiteDB
+from typing import List, Optional, Tuple
+
+
+class AnswerCacheDB(SQLiteDB):
+    """
+    Completed reasoning traces, keyed by the id of their question's row in the 'embeddings'
+    table, with the strategy and branch count that produced them. Lives in the same database
+    file as the embeddings it refers to.
+    """
+
+    def _create_table(self):
+        """
+        Creates the 'answer_cache' table if it doesn't exist already.
+        """
+        create_table_query = """
+        CREATE TABLE IF NOT EXISTS answer_cache (
+            question_id INTEGER PRIMARY KEY,
+            question TEXT,
+            trace TEXT,
+            total_time REAL,
+            created_at REAL,
+            hits INTEGER DEFAULT 0,
+            last_hit REAL,
+            strategy TEXT,
+            branches INTEGER
+        )
+        """
+        self.execute_query(create_table_query)
+        columns = [row[1] for row in self.fetch_all("PRAGMA table_info(answer_cache)")]
+        # Traces stored before these existed keep NULLs, they match no lookup and age out
+        if 'strategy' not in columns:
+            self.execute_query("ALTER TABLE answer_cache ADD COLUMN strategy TEXT")
+        if 'branches' not in columns:
+            self.execute_query("ALTER TABLE answer_cache ADD COLUMN branches INTEGER")
+        self.execute_query("CREATE INDEX IF NOT EXISTS idx_answer_cache_created_at ON answer_cache (created_at)")
+
+    def get_many(self, question_ids: List[int], strategy: str, branches: int = 1,
+                 min_created_at: float = 0) -> List[Tuple[int, str, str, float, float]]:
+        """
+        Retrieves the traces of several questions in one query.
+
+        :param question_ids: Ids of the questions' rows in 'embeddings'.
+        :param strategy: Only traces of this strategy.
+        :param branches: Only traces of runs with this many branches.
+        :param min_created_at: Ignore traces stored before this time.
+        :return: A list of (question_id, question, trace, total_time, created_at) tuples.
+        """
+        if not question_ids:
+            return []
+        placeholders = ",".join("?" * len(question_ids))
+        return self.fetch_all(
+            f"SELECT question_id, question, trace, total_time, created_at FROM answer_cache "
+            f"WHERE question_id IN ({placeholders}) AND strategy = ? AND branches = ? AND created_at >= ?",
+            (*question_ids, strategy, branches, min_created_at)
+        )
+
+    def put(self, question_id: int, question: str, trace: str, total_time: float, strategy: str, branches: int = 1):
+        """
+        Stores a trace, replacing any previous one for the question.
+
+        :param question_id: Id of the question's row in 'embeddings'.
+        :param question: The question's text.
+        :param trace: The trace, as JSON.
+        :param total_time: Seconds the original run took.
+        :param strategy: Name of the strategy of the run.
+        :param branches: Number of branches of the run.
+        """
+        self.execute_query(
+            "INSERT OR REPLACE INTO answer_cache (question_id, question, trace, total_time, created_at, strategy, branches) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (question_id, question, trace, total_time, time.time(), strategy, branches)
+        )
+
+    def hit(self, question_id: int):
+        """
+        Counts a replay of a trace.
+
+        :param question_id: Id of the question's row in 'embeddings'.
+        """
+        self.execute_query(
+            "UPDATE answer_cache SET hits = hits + 1, last_hit = ? WHERE question_id = ?",
+            (time.time(), question_id)
+        )
+
+    def evict(self, max_age: Optional[float] = None, max_rows: Optional[int] = None) -> int:
+        """
+        Drops traces whose question was deleted, traces older than max_age seconds, then
+        the oldest traces beyond max_rows.
+
+        :param max_age: Maximum age of a trace in seconds, None to keep traces regardless of age.
+        :param max_rows: Maximum number of traces to keep, None for no limit.
+        :return: The number of deleted traces.
+        """
+        deleted = 0
+        with self.transaction():
+            deleted += self.execute_query(
+                "DELETE FROM answer_cache WHERE question_id NOT IN (SELECT id FROM embeddings)"
+            ).rowcount
+            if max_age is not None:
+                deleted += self.execute_query(
+                    "DELETE FROM answer_cache WHERE created_at < ?", (time.time() - max_age,)
+                ).rowcount
+            if max_rows is not None:
+                deleted += self.execute_query(
+                    """
+                    DELETE FROM answer_cache WHERE question_id IN (
+                        SELECT question_id FROM answer_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (max_rows,)
+                ).rowcount
+        return deleted
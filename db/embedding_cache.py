@@ -0,0 +1,68 @@
+import time
+from db.sqlite import SQLiteDB
+from typing import Optional
+
+
+class EmbeddingCacheDB(SQLiteDB):
+    """
+    Persistent store of computed embeddings keyed by a content hash.
+    """
+
+    def _create_table(self):
+        """
+        Creates the 'embedding_cache' table if it doesn't exist already.
+        """
+        create_table_query = """
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            key TEXT PRIMARY KEY,
+            embedding BLOB,
+            created_at REAL
+        )
+        """
+        self.execute_query(create_table_query)
+        self.execute_query("CREATE INDEX IF NOT EXISTS idx_embedding_cache_created_at ON embedding_cache (created_at)")
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Retrieves a cached embedding.
+
+        :param key: The cache key.
+        :return: The embedding as a binary object (BLOB) if found, otherwise None.
+        """
+        row = self.fetch_one("SELECT embedding FROM embedding_cache WHERE key = ?", (key,))
+        return row[0] if row else None
+
+    def put(self, key: str, embedding: bytes):
+        """
+        Stores an embedding, replacing any previous value for the key.
+
+        :param key: The cache key.
+        :param embedding: The embedding as a binary object (BLOB).
+        """
+        self.execute_query(
+            "INSERT OR REPLACE INTO embedding_cache (key, embedding, created_at) VALUES (?, ?, ?)",
+            (key, embedding, time.time())
+        )
+
+    def count(self) -> int:
+        """
+        :return: The number of cached embeddings.
+        """
+        return self.fetch_one("SELECT COUNT(*) FROM embedding_cache")[0]
+
+    def evict(self, max_rows: int) -> int:
+        """
+        Drops the oldest entries beyond max_rows.
+
+        :param max_rows: Maximum number of entries to keep.
+        :return: The number of deleted entries.
+        """
+        result = self.execute_query(
+            """
+            DELETE FROM embedding_cache WHERE key IN (
+                SELECT key FROM embedding_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (max_rows,)
+        )
+        return result.rowcount
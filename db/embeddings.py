@@ -1,55 +1,371 @@
+import json
+import sqlite3
+import threading
+import time
+import logging
+from concurrent.futures import Future
+import numpy as np
 from db.sqlite import SQLiteDB
-from typing import List, Tuple, Optional
+from db.index import VectorIndex, get_index
+from db.knn import KNN_GRAPH_K, KnnGraphDB, get_knn_graph
+from db.segment import VectorSegment, get_segment
+from typing import Dict, List, Tuple, Optional
+from tracing import get_tracer
+logger = logging.getLogger(__name__)
+
+# Earlier versions embedded everything with the chat model and recorded no model
+LEGACY_EMBEDDING_MODEL = 'llama3.1'
+
+# Whether each database file has full-text search, once its schema was set up by this process
+_schemas: Dict[str, bool] = {}
+_schemas_lock = threading.Lock()
 
 class EmbeddingDB(SQLiteDB):
+    def __init__(self, db_file: str, session_id: Optional[str] = None):
+        """
+        Initializes the EmbeddingDB object.
+
+        :param db_file: Path to the SQLite database file.
+        :param session_id: Session that new rows are recorded under, None for rows outside any session.
+        """
+        self.session_id = session_id
+        self._dim: Optional[int] = None  # Dimension of the stored vectors, once known
+        # Vectors live in a memory-mapped segment next to the database, the table keeps text and metadata
+        self.segment: VectorSegment = get_segment(db_file)
+        super().__init__(db_file)
+
+    @property
+    def index(self) -> VectorIndex:
+        """
+        The resident vector index kept in sync with the 'embeddings' table.
+        """
+        return get_index(self)
+
+    @property
+    def graph(self) -> KnnGraphDB:
+        """
+        The persistent kNN graph linking every new row to its nearest rows of all history.
+        """
+        return get_knn_graph(self.db_file)
+
     def _create_table(self):
         """
-        Creates the 'embeddings' table if it doesn't exist already.
+        Sets the database file up the first time this process opens it, see _create_schema.
+        Every request opens an EmbeddingDB, later ones skip the schema checks and their
+        write lock.
+        """
+        with _schemas_lock:
+            fts = _schemas.get(self.db_file)
+            if fts is None:
+                fts = _schemas[self.db_file] = self._create_schema()
+        self.fts = fts
+
+    def _create_schema(self) -> bool:
+        """
+        Creates the 'embeddings' table if it doesn't exist already, adds the columns that
+        tables created by earlier versions lack, and moves their vectors to the segment.
+
+        :return: False if SQLite was built without FTS5, see _create_fts.
         """
         create_table_query = """
         CREATE TABLE IF NOT EXISTS embeddings (
             id INTEGER PRIMARY KEY,
             text TEXT,
             embedding BLOB,
-            is_question INTEGER
+            is_question INTEGER,
+            session_id TEXT,
+            created_at REAL,
+            pinned INTEGER DEFAULT 0
         )
         """
         self.execute_query(create_table_query)
+        columns = [row[1] for row in self.fetch_all("PRAGMA table_info(embeddings)")]
+        if 'session_id' not in columns:
+            self.execute_query("ALTER TABLE embeddings ADD COLUMN session_id TEXT")
+        if 'created_at' not in columns:
+            self.execute_query("ALTER TABLE embeddings ADD COLUMN created_at REAL")
+        if 'pinned' not in columns:
+            # Rows the retention policy never evicts, e.g. a corpus loaded by db.ingest
+            self.execute_query("ALTER TABLE embeddings ADD COLUMN pinned INTEGER DEFAULT 0")
+        self.execute_query("CREATE INDEX IF NOT EXISTS idx_embeddings_session ON embeddings (session_id, created_at)")
+        self.execute_query("CREATE INDEX IF NOT EXISTS idx_embeddings_created_at ON embeddings (created_at)")
+        # Settings of the stored data, e.g. the embedding model and dimension
+        self.execute_query("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._migrate_vectors()
+        if self.segment.dim is not None and self.get_meta('embedding_dim') is None:
+            self.set_meta('embedding_dim', self.segment.dim)  # Databases from before the meta table
+        return self._create_fts()
+
+    def _create_fts(self) -> bool:
+        """
+        Creates the 'embeddings_fts' full-text index over embeddings.text, kept in sync by
+        triggers, and fills it from the existing rows the first time.
+
+        :return: False if SQLite was built without FTS5.
+        """
+        exists = self.fetch_one("SELECT 1 FROM sqlite_master WHERE name = 'embeddings_fts'")
+        try:
+            with self.transaction():
+                self.execute_query("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS embeddings_fts
+                USING fts5(text, content='embeddings', content_rowid='id', tokenize='porter unicode61')
+                """)
+                self.execute_query("""
+                CREATE TRIGGER IF NOT EXISTS embeddings_fts_insert AFTER INSERT ON embeddings BEGIN
+                    INSERT INTO embeddings_fts (rowid, text) VALUES (new.id, new.text);
+                END
+                """)
+                self.execute_query("""
+                CREATE TRIGGER IF NOT EXISTS embeddings_fts_delete AFTER DELETE ON embeddings BEGIN
+                    INSERT INTO embeddings_fts (embeddings_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                END
+                """)
+                self.execute_query("""
+                CREATE TRIGGER IF NOT EXISTS embeddings_fts_update AFTER UPDATE OF text ON embeddings BEGIN
+                    INSERT INTO embeddings_fts (embeddings_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                    INSERT INTO embeddings_fts (rowid, text) VALUES (new.id, new.text);
+                END
+                """)
+                if not exists:
+                    self.execute_query("INSERT INTO embeddings_fts (embeddings_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            logger.warning(f"No full-text index on {self.db_file}, lexical search is disabled: {e}")
+            return False
+        return True
+
+    def _migrate_vectors(self, batch_size: int = 1024):
+        """
+        Moves embeddings stored as BLOBs by earlier versions into the vector segment.
+
+        A BLOB is only cleared once the segment holds the exact vector on disk: a new
+        quantized segment keeps float32 copies of the migrated vectors, and an existing
+        quantized segment without them leaves the BLOBs where they are.
+        """
+        if self.fetch_one("SELECT 1 FROM embeddings WHERE embedding IS NOT NULL LIMIT 1") is None:
+            return
+        if self.segment.dim is None:
+            self.segment.keep_full_precision()
+        if not self.segment.lossless:
+            logger.warning(f"{self.segment.path} keeps no float32 copies, the original embeddings "
+                           f"stay in {self.db_file} next to their quantized ones")
+        moved = 0
+        last_id = 0
+        while True:
+            rows = self.fetch_all("SELECT id, embedding FROM embeddings WHERE embedding IS NOT NULL AND id > ? ORDER BY id LIMIT ?",
+                                  (last_id, batch_size))
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            # Rows appended before an interruption are in already
+            new = [(id, blob) for id, blob in rows if id not in self.segment]
+            self.segment.append_many([id for id, _ in new], [blob for _, blob in new])
+            moved += len(new)
+            if self.segment.lossless:
+                self.segment.flush()
+                self.execute_many("UPDATE embeddings SET embedding = NULL WHERE id = ?", [(id,) for id, _ in rows])
+        if moved:
+            logger.info(f"moved {moved} embeddings from {self.db_file} to {self.segment.path}")
+
+    def get_meta(self, key: str) -> Optional[str]:
+        """
+        :param key: Name of the setting.
+        :return: Its value, None if it isn't set.
+        """
+        row = self.fetch_one("SELECT value FROM meta WHERE key = ?", (key,))
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value):
+        """
+        :param key: Name of the setting.
+        :param value: Its new value, None to unset it.
+        """
+        if value is None:
+            self.execute_query("DELETE FROM meta WHERE key = ?", (key,))
+        else:
+            self.execute_query("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    @property
+    def embedding_dim(self) -> Optional[int]:
+        """
+        Dimension of the stored vectors, recorded with the first one. None while the database is empty.
+        """
+        value = self.get_meta('embedding_dim')
+        return int(value) if value is not None else self.segment.dim
+
+    @property
+    def embedding_model(self) -> Optional[str]:
+        """
+        Model the stored vectors were computed with, see check_embedding_model.
+        """
+        return self.get_meta('embedding_model')
+
+    def check_embedding_model(self, model: str) -> bool:
+        """
+        Records the embedding model of a new database, or checks that new vectors come from
+        the model the stored ones were computed with. Vectors stored before the model was
+        recorded are taken to be LEGACY_EMBEDDING_MODEL's.
+
+        :param model: The configured embedding model.
+        :return: False if the database holds vectors of another model, they need re-embedding
+            (python -m db.reembed) before they can be compared with the new ones.
+        """
+        recorded = self.embedding_model
+        if recorded is None:
+            recorded = model if self.embedding_dim is None else LEGACY_EMBEDDING_MODEL
+            self.set_meta('embedding_model', recorded)
+        if recorded != model:
+            logger.warning(f"{self.db_file} holds embeddings of {recorded}, not {model}. "
+                           f"Run python -m db.reembed --model {model} to migrate them.")
+            return False
+        return True
+
+    def _check_dim(self, embedding):
+        # Every vector of the database has the same size, fixed by the first one
+        size = len(embedding) // 4 if isinstance(embedding, (bytes, bytearray, memoryview)) else np.asarray(embedding).size
+        if self._dim is None:
+            self._dim = self.embedding_dim
+            if self._dim is None:
+                self.set_meta('embedding_dim', size)
+                self._dim = size
+        if size != self._dim:
+            raise ValueError(f"Embedding has {size} dimensions, {self.db_file} holds {self._dim}-dimension vectors. "
+                             f"Was the embedding model changed? See python -m db.reembed.")
 
     def insert_embedding(self, text: str, embedding: bytes, is_question: int) -> int:
         """
-        Inserts a new embedding into the database.
+        Inserts a new embedding into the database under the current session.
 
         :param text: The text associated with the embedding.
         :param embedding: The embedding as a binary object (BLOB).
         :param is_question: 1 if the text is a question, 0 otherwise.
         :return: The id of the newly inserted row.
+        :raises ValueError: If the embedding's size differs from the stored vectors'.
         """
+        self._check_dim(embedding)
         insert_query = """
-        INSERT INTO embeddings (text, embedding, is_question)
-        VALUES (?, ?, ?)
+        INSERT INTO embeddings (text, is_question, session_id, created_at)
+        VALUES (?, ?, ?, ?)
         """
-        cursor = self.execute_query(insert_query, (text, embedding, is_question))
-        return cursor.lastrowid
+        with get_tracer().span('db_write', self.session_id):
+            result = self.execute_query(insert_query, (text, is_question, self.session_id, time.time()))
+            self.segment.append(result.lastrowid, embedding)
+            self.index.add(result.lastrowid, embedding, self.session_id)
+        if KNN_GRAPH_K:
+            self.graph.link(result.lastrowid, embedding, self.index, self.session_id, is_question)
+        return result.lastrowid
 
-    def get_embedding(self, id: int) -> Optional[Tuple[int, str, bytes, int]]:
+    def insert_embeddings_many(self, rows: List[Tuple[str, bytes, int]]) -> List[int]:
+        """
+        Inserts several embeddings in a single transaction.
+
+        :param rows: A list of (text, embedding, is_question) tuples.
+        :return: The ids of the newly inserted rows, in order.
+        """
+        with self.transaction():
+            return [self.insert_embedding(text, embedding, is_question) for text, embedding, is_question in rows]
+
+    def insert_embeddings_bulk(self, rows: List[Tuple[str, bytes, int]], meta: Optional[Dict[str, str]] = None,
+                               pinned: bool = False) -> List[int]:
+        """
+        Inserts a batch of rows in one transaction, with one write per vector file and
+        without touching the resident index or the kNN graph. For bulk loads, which build
+        the index once at the end (see db.ingest) and link the rows later (see db.knn).
+
+        :param rows: A list of (text, embedding, is_question) tuples.
+        :param meta: Settings written in the same transaction, e.g. a resume checkpoint.
+        :param pinned: Keep the rows out of the retention policy, see evict.
+        :return: The ids of the new rows, in order.
+        :raises ValueError: If an embedding's size differs from the stored vectors'.
+        """
+        for _, embedding, _ in rows:
+            self._check_dim(embedding)
+        insert_query = """
+        INSERT INTO embeddings (text, is_question, session_id, created_at, pinned)
+        VALUES (?, ?, ?, ?, ?)
+        """
+        now = time.time()
+        with get_tracer().span('db_write', self.session_id), self.transaction() as conn:
+            ids = [conn.execute(insert_query, (text, is_question, self.session_id, now, int(pinned))).lastrowid
+                   for text, _, is_question in rows]
+            # Written before the commit: vectors of a rolled back batch are superseded when the ids are reused
+            self.segment.append_many(ids, [embedding for _, embedding, _ in rows])
+            for key, value in (meta or {}).items():
+                self.set_meta(key, value)
+        return ids
+
+    def insert_embedding_deferred(self, text: str, embedding: bytes, is_question: int) -> Future:
+        """
+        Queues an insert on the write-behind queue, where it is committed together with
+        other queued writes. Call flush() before reading the row back.
+
+        :param text: The text associated with the embedding.
+        :param embedding: The embedding as a binary object (BLOB).
+        :param is_question: 1 if the text is a question, 0 otherwise.
+        :return: A Future resolved with the id of the new row.
+        """
+        return self.defer(self.insert_embedding, text, embedding, is_question)
+
+    def get_embedding(self, id: int) -> Optional[Tuple[int, str, bytes, int, str, float]]:
         """
         Retrieves an embedding by its ID.
 
         :param id: The ID of the embedding.
-        :return: A tuple containing (id, text, embedding, is_question) if found, otherwise None.
+        :return: A tuple containing (id, text, embedding, is_question, session_id, created_at) if found, otherwise None.
         """
-        select_query = "SELECT * FROM embeddings WHERE id = ?"
-        return self.fetch_one(select_query, (id,))
+        select_query = "SELECT id, text, embedding, is_question, session_id, created_at FROM embeddings WHERE id = ?"
+        row = self.fetch_one(select_query, (id,))
+        return self._with_vector(row) if row else None
 
-    def get_all_embeddings(self) -> List[Tuple[int, str, bytes, int]]:
+    def get_all_embeddings(self) -> List[Tuple[int, str, bytes, int, str, float]]:
         """
         Retrieves all embeddings from the database.
 
-        :return: A list of tuples, each containing (id, text, embedding, is_question).
+        :return: A list of tuples, each containing (id, text, embedding, is_question, session_id, created_at).
         """
-        select_query = "SELECT * FROM embeddings"
-        return self.fetch_all(select_query)
+        select_query = "SELECT id, text, embedding, is_question, session_id, created_at FROM embeddings"
+        return [self._with_vector(row) for row in self.fetch_all(select_query)]
+
+    def get_session_embeddings(self, session_id: str) -> List[Tuple[int, str, bytes, int, str, float]]:
+        """
+        Retrieves the embeddings of one session in insertion order.
+
+        :param session_id: The session to fetch.
+        :return: A list of tuples, each containing (id, text, embedding, is_question, session_id, created_at).
+        """
+        select_query = "SELECT id, text, embedding, is_question, session_id, created_at FROM embeddings WHERE session_id = ? ORDER BY created_at, id"
+        return [self._with_vector(row) for row in self.fetch_all(select_query, (session_id,))]
+
+    def get_texts(self, ids: List[int], is_question: Optional[bool] = None,
+                  created_after: Optional[float] = None, created_before: Optional[float] = None) -> Dict[int, Tuple[str, bool]]:
+        """
+        Retrieves the texts of many rows in one query, keeping only the rows matching the filters.
+
+        :param ids: The IDs of the rows.
+        :param is_question: Only keep questions (True) or steps and answers (False), None for both.
+        :param created_after: Only keep rows created at or after this time.
+        :param created_before: Only keep rows created before this time.
+        :return: A dict mapping each matching id to its (text, is_question).
+        """
+        if not ids:
+            return {}
+        # The ids go in as one JSON array, so there's no limit on the number of variables
+        query = "SELECT id, text, is_question FROM embeddings WHERE id IN (SELECT value FROM json_each(?))"
+        params = (json.dumps([int(id) for id in ids]),)
+        if is_question is not None:
+            query += " AND is_question = ?"
+            params += (int(is_question),)
+        if created_after is not None:
+            query += " AND created_at >= ?"
+            params += (created_after,)
+        if created_before is not None:
+            query += " AND created_at < ?"
+            params += (created_before,)
+        return {id: (text, bool(question)) for id, text, question in self.fetch_all(query, params)}
+
+    def _with_vector(self, row: Tuple) -> Tuple:
+        # Rows keep their (id, text, embedding, ...) shape, the embedding read back from the segment
+        vector = self.segment.get(row[0])
+        return (row[0], row[1], vector.tobytes() if vector is not None else row[2], *row[3:])
 
     def update_embedding(self, id: int, text: str, embedding: bytes, is_question: int) -> bool:
         """
@@ -61,13 +377,20 @@ class EmbeddingDB(SQLiteDB):
         :param is_question: 1 if the text is a question, 0 otherwise.
         :return: True if the update was successful, False otherwise.
         """
+        self._check_dim(embedding)
         update_query = """
         UPDATE embeddings
-        SET text = ?, embedding = ?, is_question = ?
+        SET text = ?, is_question = ?
         WHERE id = ?
         """
-        cursor = self.execute_query(update_query, (text, embedding, is_question, id))
-        return cursor.rowcount > 0
+        result = self.execute_query(update_query, (text, is_question, id))
+        if result.rowcount > 0:
+            session_id = self.fetch_one("SELECT session_id FROM embeddings WHERE id = ?", (id,))[0]
+            self.segment.append(id, embedding)
+            self.index.add(id, embedding, session_id)
+            if KNN_GRAPH_K:
+                self.graph.link(id, embedding, self.index, session_id, is_question)
+        return result.rowcount > 0
 
     def delete_embedding(self, id: int) -> bool:
         """
@@ -77,26 +400,89 @@ class EmbeddingDB(SQLiteDB):
         :return: True if the deletion was successful, False otherwise.
         """
         delete_query = "DELETE FROM embeddings WHERE id = ?"
-        cursor = self.execute_query(delete_query, (id,))
-        return cursor.rowcount > 0
-    
+        result = self.execute_query(delete_query, (id,))
+        self.index.remove(id)
+        self.segment.remove(id)
+        return result.rowcount > 0
+
+    def delete_session(self, session_id: str) -> int:
+        """
+        Deletes every embedding recorded under a session.
+
+        :param session_id: The session to delete.
+        :return: The number of deleted rows.
+        """
+        return self._delete_ids("SELECT id FROM embeddings WHERE session_id = ?", (session_id,))
+
+    def evict(self, max_age: Optional[float] = None, max_rows: Optional[int] = None) -> int:
+        """
+        Applies the retention policy: drops rows older than max_age seconds, then the
+        oldest rows beyond max_rows. Pinned rows are never dropped and don't count
+        towards max_rows.
+
+        :param max_age: Maximum age of a row in seconds, None to keep rows regardless of age.
+        :param max_rows: Maximum number of rows to keep, None for no limit.
+        :return: The number of deleted rows.
+        """
+        deleted = 0
+        if max_age is not None:
+            deleted += self._delete_ids("SELECT id FROM embeddings WHERE created_at < ? AND NOT pinned", (time.time() - max_age,))
+        if max_rows is not None:
+            deleted += self._delete_ids(
+                "SELECT id FROM embeddings WHERE NOT pinned ORDER BY created_at DESC, id DESC LIMIT -1 OFFSET ?", (max_rows,)
+            )
+        if deleted:
+            self.compact_vectors()
+        return deleted
+
+    def compact_vectors(self, min_dead: int = 1024) -> bool:
+        """
+        Rewrites the vector segment without deleted and superseded vectors, once they're
+        both more than min_dead and more than the live ones.
+
+        :param min_dead: Minimum number of dead vectors worth a rewrite.
+        :return: True if the segment was rewritten.
+        """
+        dead = self.segment.dead_rows
+        if dead < min_dead or dead < len(self.segment):
+            return False
+        # Deletes are mirrored in the segment, so its own live ids are the ones to keep
+        self.segment.compact()
+        return True
+
     def delete_all(self) -> bool:
         """
-        Deletes an embedding from the database by ID.
+        Deletes all embeddings from the database.
 
-        :param id: The ID of the embedding to delete.
         :return: True if the deletion was successful, False otherwise.
         """
         delete_query = "DELETE FROM embeddings"
-        cursor = self.execute_query(delete_query)
-        return cursor.rowcount > 0
+        result = self.execute_query(delete_query)
+        self.index.reset()
+        self.segment.compact([])
+        return result.rowcount > 0
+
+    def _delete_ids(self, select_query: str, params: Tuple = ()) -> int:
+        # Selected and deleted in one write transaction, by the ids fetched: running the query
+        # again could match other rows once a concurrent insert shifted the OFFSET window,
+        # and the index and segment below only drop the fetched ones
+        with self.transaction():
+            ids = [row[0] for row in self.fetch_all(select_query, params)]
+            if not ids:
+                return 0
+            self.execute_many("DELETE FROM embeddings WHERE id = ?", [(id,) for id in ids])
+        for id in ids:
+            self.index.remove(id)
+            self.segment.remove(id)
+        return len(ids)
 
 
-def get_db(filename: str) -> EmbeddingDB:
+def get_db(filename: str, session_id: Optional[str] = None) -> EmbeddingDB:
     """
     Returns an instance of the EmbeddingDB class initialized with the provided filename.
 
     :param filename: Path to the SQLite database file.
+    :param session_id: Session that new rows are recorded under.
     :return: An EmbeddingDB instance.
     """
-    return EmbeddingDB(filename)
\ No newline at end of file
+    return EmbeddingDB(filename, session_id)
@@ -0,0 +1,360 @@
+# Incremental in-memory vector index
+import os
+import threading
+import time
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from annoy import AnnoyIndex
+
+from db.segment import VectorSegment
+from tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+
+class VectorIndex:
+    """
+    Resident ANN index that accepts appends without a full rebuild.
+
+    Vectors covered by the last Annoy build are searched through Annoy; vectors appended
+    since then sit in a small pending buffer that is searched exactly. Once the buffer
+    grows past ``rebuild_threshold`` or gets older than ``max_staleness`` seconds, a new
+    Annoy index is built in a background thread and swapped in.
+
+    With a segment, the index keeps no vectors of its own beyond the pending buffer: exact
+    scans and builds read the segment, the Annoy index is saved next to it and memory
+    mapped, and results are rescored against the segment's full-precision vectors if it
+    keeps them.
+    """
+
+    def __init__(self, vector_size: Optional[int] = None, n_trees: int = 10,
+                 rebuild_threshold: int = 256, max_staleness: float = 60.0,
+                 segment: Optional[VectorSegment] = None):
+        """
+        :param vector_size: Dimension of the indexed vectors, taken from the first vector if None.
+        :param n_trees: Number of Annoy trees per build.
+        :param rebuild_threshold: Pending vectors that trigger a background rebuild.
+        :param max_staleness: Seconds after which any pending vectors trigger a rebuild.
+        :param segment: Segment the vectors are stored in, None to keep them in memory.
+        """
+        self.vector_size = vector_size
+        self.n_trees = n_trees
+        self.rebuild_threshold = rebuild_threshold
+        self.max_staleness = max_staleness
+        self.segment = segment
+        self._lock = threading.Lock()
+        self._vectors: Dict[int, np.ndarray] = {}  # every vector without a segment, pending ones with it
+        self._sessions: Dict[Optional[str], List[int]] = {}
+        self._session_of: Dict[int, Optional[str]] = {}  # every indexed id
+        self._annoy: Optional[AnnoyIndex] = None
+        self._annoy_ids: List[int] = []
+        self._pending: List[int] = []
+        self._pending_since: Optional[float] = None
+        self._rebuilding = False
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._session_of)
+
+    def add(self, id: int, embedding, session_id: Optional[str] = None) -> bool:
+        """
+        Appends a vector to the index.
+
+        :param id: Row id of the embedding.
+        :param embedding: The embedding vector.
+        :param session_id: Session the row belongs to.
+        :return: True if the vector was added, False if its size doesn't match the index.
+        """
+        added = self._append(id, embedding, session_id)
+        if added:
+            self._maybe_rebuild()
+        return added
+
+    def load(self, rows):
+        """
+        Bulk loads (id, embedding_blob, session_id) rows and builds the index synchronously.
+
+        :param rows: Iterable of (id, embedding_blob, session_id) tuples.
+        """
+        for id, embedding_blob, session_id in rows:
+            if embedding_blob is not None:
+                self._append(id, np.frombuffer(embedding_blob, dtype=np.float32), session_id)
+        self.rebuild()
+
+    def load_segment(self, rows):
+        """
+        Bulk loads rows whose vectors are already in the segment and builds the index synchronously.
+
+        :param rows: Iterable of (id, session_id) tuples.
+        """
+        with self._lock:
+            for id, session_id in rows:
+                if id in self.segment:
+                    self._sessions.setdefault(session_id, []).append(id)
+                    self._session_of[id] = session_id
+        self.rebuild()
+
+    def remove(self, id: int):
+        """
+        Removes a vector from the index. Annoy keeps the stale item until the next
+        rebuild, but it is filtered out of query results.
+
+        :param id: Row id of the embedding.
+        """
+        with self._lock:
+            self._discard(id)
+
+    def reset(self):
+        """
+        Drops every vector from the index.
+        """
+        with self._lock:
+            self._vectors = {}
+            self._sessions = {}
+            self._session_of = {}
+            self._annoy = None
+            self._annoy_ids = []
+            self._pending = []
+            self._pending_since = None
+            self._generation += 1
+
+    def query(self, embedding, top_k: int = 5, session_id: Optional[str] = None) -> List[Tuple[int, float]]:
+        """
+        Finds the nearest vectors to the given embedding.
+
+        :param embedding: The query vector.
+        :param top_k: Number of results to return.
+        :param session_id: Only search rows of this session, None to search all history.
+        :return: A list of (id, cosine similarity) tuples, best first.
+        """
+        with get_tracer().span('ann_query'):
+            return self._query(embedding, top_k, session_id)
+
+    def _query(self, embedding, top_k: int, session_id: Optional[str]) -> List[Tuple[int, float]]:
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        rescore = self.segment is not None and self.segment.full_precision
+        if session_id is not None:
+            # Sessions are small, an exact scan beats filtering Annoy results
+            with self._lock:
+                ids = list(self._sessions.get(session_id, []))
+            return self._exact(vector, ids, full_precision=rescore)[:top_k]
+
+        with self._lock:
+            annoy, annoy_ids = self._annoy, self._annoy_ids
+            pending = list(self._pending)
+            pending_ids = set(pending)
+            removed = max(0, len(annoy_ids) - (len(self._session_of) - len(pending)))
+
+        results = []
+        if annoy is not None:
+            # Quantized distances are close, not exact: fetch extra candidates for the rescoring to reorder
+            candidates = (2 * top_k if rescore else top_k) + removed
+            positions, distances = annoy.get_nns_by_vector(vector, candidates, include_distances=True)
+            # Annoy's angular distance is sqrt(2 - 2 * cos)
+            found = [
+                (annoy_ids[p], 1 - d * d / 2) for p, d in zip(positions, distances)
+                if annoy_ids[p] in self._session_of and annoy_ids[p] not in pending_ids
+            ]
+            if rescore:
+                found = self.segment.rescore(vector, [id for id, _ in found])
+            results.extend(found)
+        results.extend(self._exact(vector, pending, full_precision=rescore))
+
+        self._maybe_rebuild()
+        results.sort(key=lambda x: x[1], reverse=True)
+        return results[:top_k]
+
+    def query_many(self, embeddings, top_k: int = 5, session_id: Optional[str] = None) -> List[List[Tuple[int, float]]]:
+        """
+        Finds the nearest vectors to several embeddings at once.
+
+        :param embeddings: A matrix with one query vector per row.
+        :param top_k: Number of results to return per query.
+        :param session_id: Only search rows of this session, None to search all history.
+        :return: One list of (id, cosine similarity) tuples per query, best first.
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        if session_id is None:
+            return [self.query(vector, top_k) for vector in vectors]
+        with get_tracer().span('ann_query'):
+            return self._query_session(vectors, top_k, session_id)
+
+    def _query_session(self, vectors: np.ndarray, top_k: int, session_id: str) -> List[List[Tuple[int, float]]]:
+        # Session rows are scanned exactly, one matrix product covers every query
+        with self._lock:
+            ids = list(self._sessions.get(session_id, []))
+        rescore = self.segment is not None and self.segment.full_precision
+        ids, matrix = self._matrix(ids, full_precision=rescore)
+        if not ids:
+            return [[] for _ in vectors]
+        norms = np.linalg.norm(matrix, axis=1)
+        query_norms = np.linalg.norm(vectors, axis=1)
+        similarities = (vectors @ matrix.T) / np.outer(np.where(query_norms == 0, 1.0, query_norms), np.where(norms == 0, 1.0, norms))
+        results = []
+        for row in similarities:
+            best = np.argsort(-row, kind='stable')[:top_k]
+            results.append([(ids[i], float(row[i])) for i in best])
+        return results
+
+    def _matrix(self, ids: List[int], full_precision: bool = False) -> Tuple[List[int], np.ndarray]:
+        # Vectors of the ids still indexed: pending ones are the float32 originals, the rest come from the segment
+        with self._lock:
+            ids = [id for id in ids if id in self._session_of]
+            vectors = {id: self._vectors[id] for id in ids if id in self._vectors}
+        missing = [id for id in ids if id not in vectors and self.segment is not None and id in self.segment]
+        if missing:
+            vectors.update(zip(missing, self.segment.get_many(missing, full_precision=full_precision)))
+        ids = [id for id in ids if id in vectors]
+        if not ids:
+            return ids, np.empty((0, self.vector_size or 0), dtype=np.float32)
+        return ids, np.stack([vectors[id] for id in ids])
+
+    def _exact(self, vector: np.ndarray, ids: List[int], full_precision: bool = False) -> List[Tuple[int, float]]:
+        if not ids:
+            return []
+        ids, matrix = self._matrix(ids, full_precision)
+        if not ids:
+            return []
+        norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(vector) or 1.0)
+        similarities = matrix @ vector / np.where(norms == 0, 1.0, norms)
+        results = [(id, float(s)) for id, s in zip(ids, similarities)]
+        results.sort(key=lambda x: x[1], reverse=True)
+        return results
+
+    def rebuild(self):
+        """
+        Builds a fresh Annoy index over every vector and swaps it in.
+        """
+        with get_tracer().span('index_build'):
+            self._rebuild()
+
+    def _rebuild(self):
+        with self._lock:
+            generation = self._generation
+            ids = list(self._session_of)
+            in_memory = {id: self._vectors[id] for id in ids if id in self._vectors}
+            built = set(ids)
+
+        if self.vector_size is None:
+            self.vector_size = self.segment.dim if self.segment is not None else None
+        if self.vector_size is None:
+            with self._lock:
+                self._rebuilding = False
+            return  # Nothing was ever added
+        annoy = AnnoyIndex(self.vector_size, 'angular')
+        if self.segment is None:
+            for position, id in enumerate(ids):
+                annoy.add_item(position, in_memory[id])
+        else:
+            # Segment rows are decoded a chunk at a time, only pending rows live in memory
+            positions = {id: position for position, id in enumerate(ids)}
+            for chunk_ids, matrix in self.segment.iter_chunks([id for id in ids if id not in in_memory]):
+                for id, vector in zip(chunk_ids, matrix):
+                    annoy.add_item(positions[int(id)], vector)
+            for id, vector in in_memory.items():
+                annoy.add_item(positions[id], vector)
+        if ids:
+            annoy.build(self.n_trees)
+            annoy = self._map(annoy)
+        logger.debug(f"Annoy index built over {len(ids)} vectors")
+
+        with self._lock:
+            self._rebuilding = False
+            if generation != self._generation:
+                return  # reset while building, the result is stale
+            self._annoy = annoy if ids else None
+            self._annoy_ids = ids
+            self._pending = [id for id in self._pending if id not in built]
+            self._pending_since = time.time() if self._pending else None
+            if self.segment is not None:
+                # Built vectors are read back from the segment from now on
+                pending = set(self._pending)
+                self._vectors = {id: v for id, v in self._vectors.items() if id in pending}
+
+    def _map(self, annoy: AnnoyIndex) -> AnnoyIndex:
+        # Saves the index next to the segment and memory maps it, so it lives in the page cache
+        if self.segment is None:
+            return annoy
+        file = f"{self.segment.path}.ann"
+        tmp = f"{file}.{threading.get_ident()}.tmp"
+        try:
+            # Annoy maps the file it saves to, the rename keeps that mapping valid
+            annoy.save(tmp)
+            os.replace(tmp, file)
+            return annoy
+        except OSError as e:
+            logger.warning(f"Couldn't save the Annoy index next to {self.segment.path}, keeping it in memory: {e}")
+            return annoy
+
+    def _append(self, id: int, embedding, session_id: Optional[str] = None) -> bool:
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        with self._lock:
+            if self.vector_size is None:
+                self.vector_size = len(vector)
+        if len(vector) != self.vector_size:
+            logger.warning(f"Embedding size mismatch. Expected {self.vector_size}, got {len(vector)}. Skipping id {id}.")
+            return False
+        with self._lock:
+            self._discard(id)
+            self._vectors[id] = vector
+            self._sessions.setdefault(session_id, []).append(id)
+            self._session_of[id] = session_id
+            self._pending.append(id)
+            if self._pending_since is None:
+                self._pending_since = time.time()
+        return True
+
+    def _discard(self, id: int):
+        # Caller holds the lock
+        if id in self._session_of:
+            self._vectors.pop(id, None)
+            self._pending = [p for p in self._pending if p != id]
+            session_ids = self._sessions.get(self._session_of.pop(id))
+            if session_ids is not None:
+                session_ids.remove(id)
+
+    def _maybe_rebuild(self):
+        with self._lock:
+            if self._rebuilding or not self._pending:
+                return
+            stale = time.time() - self._pending_since > self.max_staleness
+            if len(self._pending) < self.rebuild_threshold and not stale:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self.rebuild, daemon=True).start()
+
+
+_indexes: Dict[str, VectorIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(conn) -> VectorIndex:
+    """
+    Returns the process-wide index for the database behind the given connection,
+    loading it from the connection's vector segment the first time it is requested.
+
+    :param conn: An EmbeddingDB instance.
+    :return: The shared VectorIndex.
+    """
+    with _indexes_lock:
+        index = _indexes.get(conn.db_file)
+        if index is None:
+            segment = conn.segment
+            rows = conn.fetch_all("SELECT id, session_id FROM embeddings")
+            segment.retain(id for id, _ in rows)  # Rows deleted by another process
+            # The dimension recorded with the data, an empty database takes it from its first vector
+            index = VectorIndex(vector_size=conn.embedding_dim, segment=segment)
+            index.load_segment(rows)
+            _indexes[conn.db_file] = index
+        return index
+
+
+def drop_index(db_file: str):
+    """
+    Forgets the process-wide index of a database file, e.g. after its vectors were
+    replaced. The next get_index loads and builds it again.
+    """
+    with _indexes_lock:
+        _indexes.pop(db_file, None)
@@ -0,0 +1,265 @@
+# Bulk loads a text corpus into the embeddings database
+import argparse
+import json
+import os
+import sys
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from db.embeddings import EmbeddingDB, get_db
+from db.index import drop_index, get_index
+
+logger = logging.getLogger(__name__)
+
+
+class Chunk(NamedTuple):
+    text: str
+    is_question: int
+    file: str
+    line_start: int  # Byte offset of the line the chunk comes from
+    line_end: int
+    part: int  # Index of the chunk within its line
+    last: bool  # Last chunk of its line
+
+
+def chunk_text(text: str, size: int = 1000, overlap: int = 100) -> List[str]:
+    """
+    Splits a text into chunks of at most size characters, cut at sentence ends or else
+    at whitespace, each starting with the last overlap characters of the previous one.
+
+    :param text: The text.
+    :param size: Longest chunk, in characters.
+    :param overlap: Characters repeated from the end of the previous chunk.
+    :return: The chunks, a single one if the text is short enough.
+    """
+    text = " ".join(text.split())
+    if len(text) <= size:
+        return [text] if text else []
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            window = text[start:end]
+            cut = max(window.rfind(". "), window.rfind("? "), window.rfind("! "))
+            if cut > size // 2:
+                end = start + cut + 1
+            else:
+                space = window.rfind(" ")
+                if space > size // 2:
+                    end = start + space
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        # Back up to a word start for the overlap, never past the chunk's own start
+        next_start = max(end - overlap, start + 1)
+        space = text.rfind(" ", start + 1, next_start + 1)
+        start = space + 1 if overlap and space > start else end
+    return [chunk for chunk in chunks if chunk]
+
+
+def _records(line: str, jsonl: bool, text_field: str) -> List[Tuple[str, int]]:
+    # (text, is_question) pairs of one input line
+    if not jsonl:
+        return [(line, 0)]
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError("not a JSON object")
+    # Q&A records become a question row and an answer row
+    if 'question' in record or 'answer' in record:
+        return [(str(record[key]), int(key == 'question')) for key in ('question', 'answer') if record.get(key)]
+    if text_field not in record:
+        raise ValueError(f"no '{text_field}' field")
+    return [(str(record[text_field]), int(bool(record.get('is_question', False))))]
+
+
+def read_chunks(file: str, offset: int = 0, skip: int = 0, chunk_size: int = 1000, overlap: int = 100,
+                text_field: str = 'text', stats: Optional[dict] = None) -> Iterator[Chunk]:
+    """
+    Streams the chunks of an input file, line by line. Files ending in .jsonl or .json
+    hold one JSON object per line: its 'question' and 'answer' fields, or else its
+    text_field (with an optional 'is_question'). Other files hold one text per line.
+
+    :param file: The input file.
+    :param offset: Byte offset to start at, from a checkpoint.
+    :param skip: Chunks of the first line already ingested.
+    :param stats: Counters updated as lines are read: 'lines', 'skipped'.
+    """
+    jsonl = file.endswith(('.jsonl', '.json'))
+    stats = stats if stats is not None else {}
+    with open(file, 'rb') as f:
+        f.seek(offset)
+        position = offset
+        for raw in f:
+            line_start, position = position, position + len(raw)
+            line = raw.decode('utf-8', errors='replace').strip()
+            if not line:
+                continue
+            stats['lines'] = stats.get('lines', 0) + 1
+            try:
+                records = _records(line, jsonl, text_field)
+            except ValueError as e:  # json.JSONDecodeError included
+                stats['skipped'] = stats.get('skipped', 0) + 1
+                logger.warning(f"{file}: skipped the line at byte {line_start}: {e}")
+                continue
+            parts = [(chunk, is_question) for text, is_question in records for chunk in chunk_text(text, chunk_size, overlap)]
+            for part, (chunk, is_question) in enumerate(parts):
+                if line_start == offset and part < skip:
+                    continue
+                yield Chunk(chunk, is_question, file, line_start, position, part, part == len(parts) - 1)
+
+
+def _batches(chunks: Iterable[Chunk], batch_size: int) -> Iterator[List[Chunk]]:
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def checkpoint_key(file: str) -> str:
+    return f"ingest:{os.path.abspath(file)}"
+
+
+def _checkpoint(chunk: Chunk) -> str:
+    # Where to resume after this chunk: the next line, or the rest of this one
+    if chunk.last:
+        return json.dumps({'offset': chunk.line_end, 'skip': 0})
+    return json.dumps({'offset': chunk.line_start, 'skip': chunk.part + 1})
+
+
+def ingest(files: List[str], db_file: str = 'embeddings.db', batch_size: int = 64, workers: int = 4,
+           chunk_size: int = 1000, overlap: int = 100, text_field: str = 'text', session_id: Optional[str] = None,
+           restart: bool = False, pinned: bool = True, api=None, report_every: float = 5.0) -> dict:
+    """
+    Embeds and stores every chunk of the input files.
+
+    Chunks are embedded a batch per model call, with up to `workers` batches in flight,
+    and each batch is stored in one transaction together with the checkpoint of its
+    file, so an interrupted run picks up after the last stored batch. Rows skip the
+    resident index while they're loaded; it is built once at the end.
+
+    :param files: Input files, see read_chunks.
+    :param db_file: Path to the SQLite database file.
+    :param batch_size: Chunks per embedding call and per transaction.
+    :param workers: Embedding calls running at once.
+    :param chunk_size: Longest chunk, in characters.
+    :param overlap: Characters shared by consecutive chunks of a long text.
+    :param text_field: Field of the JSONL records holding the text.
+    :param session_id: Session the rows are recorded under, None for rows outside any session.
+    :param restart: Ignore the checkpoints and ingest the files from the start.
+    :param pinned: Keep the rows out of the retention policy, which would otherwise evict
+        all but the newest RETENTION_MAX_ROWS rows of a large corpus on the next query.
+    :param api: chat.API instance computing the embeddings.
+    :param report_every: Seconds between two progress reports.
+    :return: Totals: 'rows', 'batches', 'lines', 'skipped', 'seconds', 'rows_per_s'.
+    """
+    if api is None:
+        from chat.api import API
+        api = API(cache=False)  # A corpus would only flush the cache
+    conn = get_db(db_file, session_id)
+    if not conn.check_embedding_model(api.embedding_model):
+        raise ValueError(f"{db_file} holds embeddings of {conn.embedding_model}, re-embed it first (python -m db.reembed)")
+
+    total_bytes = sum(os.path.getsize(file) for file in files)
+    stats = {'lines': 0, 'skipped': 0}
+    totals = {'rows': 0, 'batches': 0}
+    start = time.time()
+    last_report = start
+    done_bytes = 0  # Of the files finished before the current one
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+    try:
+        for file in files:
+            key = checkpoint_key(file)
+            saved = None if restart else conn.get_meta(key)
+            checkpoint = json.loads(saved) if saved else {'offset': 0, 'skip': 0}
+            if checkpoint['offset'] >= os.path.getsize(file):
+                logger.info(f"{file}: already ingested")
+                done_bytes += os.path.getsize(file)
+                continue
+            if checkpoint['offset']:
+                logger.info(f"{file}: resuming at byte {checkpoint['offset']}")
+
+            # Batches are stored in input order, so the checkpoint only ever moves forward
+            in_flight = deque()
+            batches = _batches(read_chunks(file, checkpoint['offset'], checkpoint['skip'], chunk_size, overlap,
+                                           text_field, stats), batch_size)
+            for batch in batches:
+                in_flight.append((batch, executor.submit(api.embed, [chunk.text for chunk in batch])))
+                while len(in_flight) > workers:
+                    _store(conn, key, *in_flight.popleft(), totals, pinned)
+                if time.time() - last_report >= report_every:
+                    last_report = time.time()
+                    _report(totals, stats, start, done_bytes + batch[-1].line_end, total_bytes)
+            while in_flight:
+                _store(conn, key, *in_flight.popleft(), totals, pinned)
+            conn.set_meta(key, json.dumps({'offset': os.path.getsize(file), 'skip': 0}))
+            done_bytes += os.path.getsize(file)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    _report(totals, stats, start, total_bytes, total_bytes)
+    if totals['rows']:
+        # One build over everything, this process's index never saw the new rows
+        build_start = time.time()
+        drop_index(db_file)
+        index = get_index(conn)
+        logger.info(f"index built over {len(index)} vectors in {time.time() - build_start:.1f} s")
+    seconds = time.time() - start
+    return {**totals, **stats, 'seconds': seconds, 'rows_per_s': totals['rows'] / seconds if seconds else 0.0}
+
+
+def _store(conn: EmbeddingDB, key: str, batch: List[Chunk], future, totals: dict, pinned: bool):
+    embeddings = future.result()
+    conn.insert_embeddings_bulk(
+        [(chunk.text, embedding, chunk.is_question) for chunk, embedding in zip(batch, embeddings)],
+        meta={key: _checkpoint(batch[-1])},
+        pinned=pinned,
+    )
+    totals['rows'] += len(batch)
+    totals['batches'] += 1
+
+
+def _report(totals: dict, stats: dict, start: float, position: int, total_bytes: int):
+    elapsed = time.time() - start
+    rate = totals['rows'] / elapsed if elapsed else 0.0
+    share = position / total_bytes if total_bytes else 1.0
+    eta = elapsed * (1 - share) / share if share else float('inf')
+    logger.info(f"{share:.1%} of the input, {totals['rows']} rows from {stats.get('lines', 0)} lines "
+                f"({stats.get('skipped', 0)} skipped), {rate:.1f} rows/s, ~{eta:.0f} s left")
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Embed and store a text corpus (JSONL or one text per line)")
+    parser.add_argument('files', nargs='+', help="Input files, .jsonl/.json for JSON records")
+    parser.add_argument('--db', default='embeddings.db', help="Database file")
+    parser.add_argument('--batch-size', type=int, default=64, help="Chunks per embedding call and per transaction")
+    parser.add_argument('--workers', type=int, default=4, help="Embedding calls running at once")
+    parser.add_argument('--chunk-size', type=int, default=1000, help="Longest chunk, in characters")
+    parser.add_argument('--overlap', type=int, default=100, help="Characters shared by consecutive chunks")
+    parser.add_argument('--text-field', default='text', help="Text field of JSON records without question/answer")
+    parser.add_argument('--session', help="Session the rows are recorded under")
+    parser.add_argument('--restart', action='store_true', help="Ignore the checkpoints of earlier runs")
+    parser.add_argument('--evictable', action='store_true', help="Let the retention policy evict the rows like query rows")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    try:
+        result = ingest(args.files, args.db, args.batch_size, args.workers, args.chunk_size, args.overlap,
+                        args.text_field, args.session, args.restart, pinned=not args.evictable)
+    except (OSError, ValueError) as e:
+        print(f"Ingestion failed: {e}", file=sys.stderr)
+        return 1
+    print(f"Stored {result['rows']} rows from {result['lines']} lines in {result['seconds']:.1f} s "
+          f"({result['rows_per_s']:.1f} rows/s), {result['skipped']} lines skipped")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+# Persistent k-nearest-neighbor graph over every stored row, across sessions
+import argparse
+import json
+import os
+import threading
+import time
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from db.sqlite import SQLiteDB
+from tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+# Neighbors linked to each new row, 0 to maintain no graph
+KNN_GRAPH_K = int(os.environ.get('KNN_GRAPH_K', 8))
+# Weakest similarity worth an edge
+KNN_MIN_SIMILARITY = float(os.environ.get('KNN_MIN_SIMILARITY', 0.0))
+
+
+class KnnGraphDB(SQLiteDB):
+    """
+    Global kNN graph of the rows of the 'embeddings' table, in the same database file.
+
+    'nodes' holds the rows that were linked, 'edges' the directed edges from each node to
+    its nearest rows (found through the resident ANN index) weighted by cosine similarity.
+    A new node also offers itself to its neighbors, which keep their k best edges, so the
+    lists improve as history grows without recomputing any similarity. Reads go through
+    the (src, dst) primary key and the (dst) index, in both directions.
+    """
+
+    def __init__(self, db_file: str, k: Optional[int] = None, min_similarity: Optional[float] = None):
+        """
+        :param db_file: Path to the SQLite database file.
+        :param k: Edges kept per node, defaults to KNN_GRAPH_K.
+        :param min_similarity: Weakest edge kept, defaults to KNN_MIN_SIMILARITY.
+        """
+        self.k = KNN_GRAPH_K if k is None else k
+        self.min_similarity = KNN_MIN_SIMILARITY if min_similarity is None else min_similarity
+        super().__init__(db_file)
+
+    def _create_table(self):
+        """
+        Creates the 'nodes' and 'edges' tables if they don't exist already, and the trigger
+        removing a deleted row from the graph.
+        """
+        with self.transaction():
+            self.execute_query("""
+            CREATE TABLE IF NOT EXISTS nodes (
+                id INTEGER PRIMARY KEY,
+                session_id TEXT,
+                is_question INTEGER,
+                linked_at REAL
+            )
+            """)
+            self.execute_query("""
+            CREATE TABLE IF NOT EXISTS edges (
+                src INTEGER,
+                dst INTEGER,
+                weight REAL,
+                PRIMARY KEY (src, dst)
+            ) WITHOUT ROWID
+            """)
+            self.execute_query("CREATE INDEX IF NOT EXISTS idx_edges_dst ON edges (dst, weight)")
+            # Edges to a deleted row go with it. Its neighbors are one edge short until they're relinked.
+            self.execute_query("""
+            CREATE TRIGGER IF NOT EXISTS embeddings_knn_delete AFTER DELETE ON embeddings BEGIN
+                DELETE FROM edges WHERE src = old.id;
+                DELETE FROM edges WHERE dst = old.id;
+                DELETE FROM nodes WHERE id = old.id;
+            END
+            """)
+
+    def link(self, id: int, embedding, index, session_id: Optional[str] = None, is_question: int = 0) -> int:
+        """
+        Links a row to its nearest rows of the whole history, replacing its previous edges.
+
+        :param id: Row id, already in the index.
+        :param embedding: The row's embedding.
+        :param index: The database's VectorIndex.
+        :param session_id: Session of the row.
+        :param is_question: 1 if the row is a question.
+        :return: The number of edges of the row.
+        """
+        with get_tracer().span('knn_link', session_id):
+            neighbors = self._neighbors(id, index.query(embedding, self.k + 1))
+            with self.transaction():
+                self._store([(id, session_id, is_question, neighbors)], replace=True)
+        return len(neighbors)
+
+    def link_missing(self, conn, rebuild: bool = False, batch_size: int = 256) -> int:
+        """
+        Links every row that isn't a node yet, e.g. rows stored before the graph existed or
+        loaded by db.ingest. Nodes linked earlier keep their edges and gain new ones.
+
+        :param conn: EmbeddingDB of the same file.
+        :param rebuild: Drop the whole graph first and link every row again.
+        :param batch_size: Rows queried and stored per transaction.
+        :return: The number of rows linked.
+        """
+        if rebuild:
+            self.reset()
+        index = conn.index
+        linked = 0
+        last_id = 0
+        start = time.time()
+        while True:
+            rows = conn.fetch_all(
+                "SELECT id, session_id, is_question FROM embeddings "
+                "WHERE id > ? AND id NOT IN (SELECT id FROM nodes) ORDER BY id LIMIT ?",
+                (last_id, batch_size)
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            rows = [row for row in rows if row[0] in conn.segment]
+            if not rows:
+                continue
+            vectors = conn.segment.get_many([id for id, _, _ in rows], full_precision=True)
+            results = index.query_many(vectors, self.k + 1)
+            with self.transaction():
+                self._store([(id, session_id, is_question, self._neighbors(id, found))
+                             for (id, session_id, is_question), found in zip(rows, results)])
+            linked += len(rows)
+            logger.info(f"linked {linked} rows, {linked / (time.time() - start):.1f} rows/s")
+        return linked
+
+    def _neighbors(self, id: int, found: List[Tuple[int, float]]) -> List[Tuple[int, float]]:
+        return [(neighbor, similarity) for neighbor, similarity in found
+                if neighbor != id and similarity >= self.min_similarity][:self.k]
+
+    def _store(self, linked: List[Tuple[int, Optional[str], int, List[Tuple[int, float]]]], replace: bool = False):
+        # Caller holds a transaction
+        now = time.time()
+        if replace:
+            # The row's vector changed, so did every similarity it's part of
+            for id, _, _, _ in linked:
+                self.execute_query("DELETE FROM edges WHERE src = ?", (id,))
+                self.execute_query("DELETE FROM edges WHERE dst = ?", (id,))
+        self.execute_many("INSERT OR REPLACE INTO nodes (id, session_id, is_question, linked_at) VALUES (?, ?, ?, ?)",
+                          [(id, session_id, int(bool(is_question)), now) for id, session_id, is_question, _ in linked])
+        self.execute_many("INSERT OR REPLACE INTO edges (src, dst, weight) VALUES (?, ?, ?)",
+                          [(id, neighbor, weight) for id, _, _, neighbors in linked for neighbor, weight in neighbors])
+        # Each neighbor gets the reverse edge, every list touched keeps its k strongest
+        self.execute_many("INSERT OR REPLACE INTO edges (src, dst, weight) VALUES (?, ?, ?)",
+                          [(neighbor, id, weight) for id, _, _, neighbors in linked for neighbor, weight in neighbors])
+        touched = {neighbor for _, _, _, neighbors in linked for neighbor, _ in neighbors}
+        touched.update(id for id, _, _, _ in linked)  # Reverse edges it got before it was linked
+        self.execute_many(
+            "DELETE FROM edges WHERE src = ? AND dst NOT IN "
+            "(SELECT dst FROM edges WHERE src = ? ORDER BY weight DESC LIMIT ?)",
+            [(neighbor, neighbor, self.k) for neighbor in touched]
+        )
+
+    def reset(self):
+        """
+        Drops every node and edge.
+        """
+        with self.transaction():
+            self.execute_query("DELETE FROM edges")
+            self.execute_query("DELETE FROM nodes")
+
+    def neighborhood(self, ids: Iterable[int], hops: int = 2, min_weight: float = 0.0,
+                     per_node: Optional[int] = None, max_nodes: int = 200) -> Tuple[Dict[int, int], List[Tuple[int, int, float]]]:
+        """
+        Expands a set of rows hop by hop along the stored edges, in both directions.
+
+        :param ids: The rows to start from.
+        :param hops: Number of expansions.
+        :param min_weight: Weakest edge followed.
+        :param per_node: Strongest edges followed from each node, None for all of them.
+        :param max_nodes: Stop adding nodes beyond this many.
+        :return: (hop at which each node was reached, the seeds at 0; (a, b, weight) edges
+            between the returned nodes, each pair once with a < b).
+        """
+        hop_of = {int(id): 0 for id in ids}
+        frontier = list(hop_of)
+        for hop in range(1, hops + 1):
+            if not frontier or len(hop_of) >= max_nodes:
+                break
+            adjacent: Dict[int, Dict[int, float]] = {}
+            for node, neighbor, weight in self._adjacent(frontier, min_weight):
+                weights = adjacent.setdefault(node, {})
+                weights[neighbor] = max(weight, weights.get(neighbor, weight))
+            next_frontier = []
+            for node in frontier:
+                best = sorted(adjacent.get(node, {}).items(), key=lambda x: x[1], reverse=True)[:per_node]
+                for neighbor, _ in best:
+                    if neighbor not in hop_of and len(hop_of) < max_nodes:
+                        hop_of[neighbor] = hop
+                        next_frontier.append(neighbor)
+            frontier = next_frontier
+        return hop_of, self._edges_between(list(hop_of), min_weight)
+
+    def _adjacent(self, ids: List[int], min_weight: float) -> List[Tuple[int, int, float]]:
+        # (node, neighbor, weight) of the edges leaving or entering the nodes, one query per hop
+        ids_json = json.dumps(ids)
+        return self.fetch_all(
+            """
+            SELECT src, dst, weight FROM edges WHERE src IN (SELECT value FROM json_each(?)) AND weight >= ?
+            UNION ALL
+            SELECT dst, src, weight FROM edges WHERE dst IN (SELECT value FROM json_each(?)) AND weight >= ?
+            """,
+            (ids_json, min_weight, ids_json, min_weight)
+        )
+
+    def _edges_between(self, ids: List[int], min_weight: float) -> List[Tuple[int, int, float]]:
+        if len(ids) < 2:
+            return []
+        ids_json = json.dumps(ids)
+        edges: Dict[Tuple[int, int], float] = {}
+        for src, dst, weight in self.fetch_all(
+            "SELECT src, dst, weight FROM edges WHERE src IN (SELECT value FROM json_each(?)) "
+            "AND dst IN (SELECT value FROM json_each(?)) AND weight >= ?",
+            (ids_json, ids_json, min_weight)
+        ):
+            key = (min(src, dst), max(src, dst))
+            edges[key] = max(weight, edges.get(key, weight))
+        return [(a, b, weight) for (a, b), weight in edges.items()]
+
+    def stats(self) -> dict:
+        """
+        :return: 'nodes' and 'edges' counts.
+        """
+        return {
+            'nodes': self.fetch_one("SELECT COUNT(*) FROM nodes")[0],
+            'edges': self.fetch_one("SELECT COUNT(*) FROM edges")[0],
+        }
+
+
+_graphs: Dict[str, KnnGraphDB] = {}
+_graphs_lock = threading.Lock()
+
+
+def get_knn_graph(db_file: str) -> KnnGraphDB:
+    """
+    Returns the process-wide kNN graph of a database file.
+
+    :param db_file: Path to the SQLite database file.
+    :return: The shared KnnGraphDB.
+    """
+    with _graphs_lock:
+        graph = _graphs.get(db_file)
+        if graph is None:
+            graph = _graphs[db_file] = KnnGraphDB(db_file)
+        return graph
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Link the stored rows that aren't in the kNN graph yet")
+    parser.add_argument('--db', default='embeddings.db', help="Database file")
+    parser.add_argument('--rebuild', action='store_true', help="Drop the graph and link every row again")
+    parser.add_argument('--batch-size', type=int, default=256, help="Rows per transaction")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if not KNN_GRAPH_K:
+        parser.error("KNN_GRAPH_K is 0, there is no graph to build")
+    from db.embeddings import get_db
+    conn = get_db(args.db)  # Creates the embeddings table the graph's trigger is on
+    graph = get_knn_graph(args.db)
+    linked = graph.link_missing(conn, rebuild=args.rebuild, batch_size=args.batch_size)
+    stats = graph.stats()
+    print(f"Linked {linked} rows, the graph has {stats['nodes']} nodes and {stats['edges']} edges")
+
+
+if __name__ == '__main__':
+    main()
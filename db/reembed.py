@@ -0,0 +1,115 @@
+# Re-embeds every stored text with another embedding model
+import argparse
+import glob
+import os
+import time
+import logging
+from typing import Optional
+
+from db.embeddings import EmbeddingDB, get_db
+from db.index import drop_index
+from db.segment import VectorSegment, drop_segment
+
+logger = logging.getLogger(__name__)
+
+
+def reembed(db_file: str, model: str, batch_size: int = 64, api=None) -> int:
+    """
+    Recomputes the vector of every row with a new embedding model and swaps the results in.
+
+    The new vectors are written to a separate segment next to the live one, a batch at a
+    time, so the job can be interrupted and started again: rows already re-embedded are
+    skipped. Once every row is done the new segment replaces the old one, the database
+    records the new model and dimension, and the resident index is rebuilt on its next use.
+    Run it while the app is stopped, rows it adds meanwhile would keep their old vectors.
+
+    :param db_file: Path to the SQLite database file.
+    :param model: The new embedding model.
+    :param batch_size: Texts per embedding call.
+    :param api: chat.API instance computing the embeddings, defaults to one for model.
+    :return: The number of rows re-embedded by this run.
+    """
+    if api is None:
+        from chat.api import API  # Not needed to import the database modules
+        api = API(embedding_model=model)
+    conn = get_db(db_file)
+    live = conn.segment
+    path = f"{live.path}.reembed"
+    if conn.get_meta('reembed_model') != model:
+        # A different migration was interrupted, its vectors are of no use
+        _remove_files(path)
+        conn.set_meta('reembed_model', model)
+    target = VectorSegment(path, dtype=live.dtype.name, full_precision=live.full_precision)
+
+    total = conn.fetch_one("SELECT COUNT(*) FROM embeddings")[0]
+    done = len(target)
+    logger.info(f"re-embedding {total} rows of {db_file} with {model}, {done} done before")
+    embedded = 0
+    last_id = 0
+    start = time.time()
+    while True:
+        rows = conn.fetch_all("SELECT id, text FROM embeddings WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size))
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        rows = [(id, text or "") for id, text in rows if id not in target]
+        if not rows:
+            continue
+        vectors = api.embed([text for _, text in rows])
+        target.append_many([id for id, _ in rows], vectors)
+        embedded += len(rows)
+        done += len(rows)
+        rate = embedded / (time.time() - start)
+        logger.info(f"{done}/{total} rows, {rate:.1f} rows/s, ~{(total - done) / rate:.0f} s left")
+
+    _swap(conn, target, model)
+    return embedded
+
+
+def _swap(conn: EmbeddingDB, target: VectorSegment, model: str):
+    # Rows deleted during the job are left out, the live segment's files are replaced by the new ones
+    target.compact([row[0] for row in conn.fetch_all("SELECT id FROM embeddings")])
+    dim = target.dim
+    target.close()
+    live_path = conn.segment.path
+    drop_index(conn.db_file)
+    drop_segment(conn.db_file)
+    _remove_files(live_path, keep_lock=True)
+    for file in glob.glob(f"{glob.escape(target.path)}.*"):
+        if file.endswith('.lock'):
+            os.remove(file)
+        else:
+            os.replace(file, live_path + file[len(target.path):])
+    with conn.transaction():
+        conn.set_meta('embedding_model', model)
+        conn.set_meta('embedding_dim', dim)
+        conn.set_meta('reembed_model', None)
+        # Its similarities were those of the old vectors
+        conn.graph.reset()
+    logger.info(f"{live_path} now holds {model} embeddings of {dim} dimensions, "
+                f"run python -m db.knn to link the rows of the kNN graph again")
+
+
+def _remove_files(path: str, keep_lock: bool = False):
+    # Every file of a segment, its saved Annoy index included
+    for file in glob.glob(f"{glob.escape(path)}.*"):
+        if file.endswith('.reembed') or '.reembed.' in file[len(path):]:
+            continue  # A migration's segment next to the live one
+        if keep_lock and file.endswith('.lock'):
+            continue
+        os.remove(file)
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Re-embed the stored texts with another embedding model")
+    parser.add_argument('--model', required=True, help="New embedding model, e.g. nomic-embed-text")
+    parser.add_argument('--db', default='embeddings.db', help="Database file")
+    parser.add_argument('--batch-size', type=int, default=64, help="Texts per embedding call")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    reembedded = reembed(args.db, args.model, args.batch_size)
+    print(f"Re-embedded {reembedded} rows with {args.model}")
+
+
+if __name__ == '__main__':
+    main()
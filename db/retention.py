@@ -0,0 +1,56 @@
+# Retention policies applied on a background thread instead of before each query
+import threading
+import logging
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionWorker:
+    """
+    Runs a retention function every interval seconds on a daemon thread, so eviction and
+    compaction never hold up a request. Only this thread runs it, one pass at a time.
+    """
+
+    def __init__(self, apply: Callable[[], None], interval: float = 60.0):
+        """
+        :param apply: Applies the retention policies, e.g. EmbeddingDB.evict and AnswerCache.evict.
+        :param interval: Seconds between two passes, counted from the end of the previous one.
+        """
+        self.apply = apply
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the thread unless it's running already. The first pass runs right away.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        Stops the thread after its current pass.
+
+        :param timeout: Seconds to wait for the thread, None to wait as long as it takes.
+        """
+        self._stop.set()
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.apply()
+            except Exception:
+                # A failed pass is retried at the next interval
+                logger.exception("retention pass failed")
+            self._stop.wait(self.interval)
@@ -0,0 +1,204 @@
+# Hybrid lexical + vector retrieval
+import re
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from db.embeddings import EmbeddingDB
+
+logger = logging.getLogger(__name__)
+
+MODES = ('hybrid', 'vector', 'lexical', 'prefilter')
+
+
+def _match_query(text: str) -> Optional[str]:
+    # Every word quoted, so FTS5 operators and punctuation in user text can't break the query
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return None
+    return " OR ".join(f'"{word}"' for word in dict.fromkeys(words))
+
+
+def lexical_search(conn: EmbeddingDB, text: str, top_k: int = 5, session_id: Optional[str] = None) -> List[Tuple[int, float]]:
+    """
+    Ranks the stored texts by BM25 against the words of the query.
+
+    :param conn: Database holding the texts.
+    :param text: The query text.
+    :param top_k: Number of results to return.
+    :param session_id: Only search rows of this session, None to search all history.
+    :return: A list of (id, BM25 score) tuples, best first. Lower scores are better, as in FTS5.
+    """
+    match = _match_query(text)
+    if match is None or not conn.fts:
+        return []
+    query = """
+    SELECT embeddings_fts.rowid, bm25(embeddings_fts) AS score FROM embeddings_fts
+    JOIN embeddings ON embeddings.id = embeddings_fts.rowid
+    WHERE embeddings_fts MATCH ?
+    """
+    params = (match,)
+    if session_id is not None:
+        query += " AND embeddings.session_id = ?"
+        params += (session_id,)
+    query += " ORDER BY score LIMIT ?"
+    return conn.fetch_all(query, params + (top_k,))
+
+
+def _fuse(rankings: List[List[int]], rrf_k: int) -> List[int]:
+    # Reciprocal-rank fusion: the ranks matter, BM25 and cosine scores aren't comparable
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking, start=1):
+            scores[id] = scores.get(id, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def hybrid_search(conn: EmbeddingDB, text: str, query_embedding, top_k: int = 5, session_id: Optional[str] = None,
+                  mode: str = 'hybrid', rrf_k: int = 60, candidates: Optional[int] = None,
+                  prefilter_threshold: int = 50_000) -> List[Tuple[int, str, float, bool]]:
+    """
+    Finds the stored texts closest to a query by combining keyword and embedding matches.
+
+    In 'hybrid' mode the BM25 ranking and the nearest neighbours from the vector index are
+    merged with reciprocal-rank fusion. Once the index holds prefilter_threshold vectors or
+    more, hybrid mode switches to 'prefilter' as long as the keywords match enough rows: the
+    FTS matches alone are rescored against the query embedding and fused with their BM25
+    ranks, without an ANN search.
+
+    :param conn: Database holding the texts.
+    :param text: The query text.
+    :param query_embedding: Embedding of the query text.
+    :param top_k: Number of results to return.
+    :param session_id: Only search rows of this session, None to search all history.
+    :param mode: 'hybrid', 'prefilter', 'vector' (find_similar) or 'lexical' (BM25 only).
+    :param rrf_k: Rank offset of the fusion, higher values flatten the difference between ranks.
+    :param candidates: Results taken from each ranking before fusion, defaults to 4 * top_k.
+    :param prefilter_threshold: Index size from which hybrid mode prefilters with FTS.
+    :return: A list of (id, text, similarity, is_question) tuples, best first, like find_similar.
+    """
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+    candidates = candidates or 4 * top_k
+    if not conn.fts and mode != 'vector':
+        mode = 'vector'
+
+    if mode == 'vector':
+        similar = conn.index.query(query_embedding, top_k, session_id)
+        return _with_rows(conn, [id for id, _ in similar], dict(similar))
+
+    lexical = [id for id, _ in lexical_search(conn, text, candidates, session_id)]
+    if mode == 'lexical':
+        ranked = lexical[:top_k]
+        return _with_rows(conn, ranked, dict(conn.segment.rescore(query_embedding, ranked)))
+
+    if mode == 'hybrid' and len(conn.index) >= prefilter_threshold and len(lexical) >= top_k:
+        mode = 'prefilter'
+    if mode == 'prefilter':
+        vector = conn.segment.rescore(query_embedding, lexical)
+    else:
+        vector = conn.index.query(query_embedding, candidates, session_id)
+    similarities = dict(vector)
+    ranked = _fuse([lexical, [id for id, _ in vector]], rrf_k)[:top_k]
+    missing = [id for id in ranked if id not in similarities]
+    if missing:
+        # Keyword matches outside the nearest neighbours still show their cosine similarity
+        similarities.update(conn.segment.rescore(query_embedding, missing))
+    return _with_rows(conn, ranked, similarities)
+
+
+def _with_rows(conn: EmbeddingDB, ids: List[int], similarities: Dict[int, float]) -> List[Tuple[int, str, float, bool]]:
+    rows = conn.get_texts(ids)
+    return [(id, rows[id][0], similarities.get(id, 0.0), rows[id][1]) for id in ids if id in rows]
+
+
+def search_many(conn: EmbeddingDB, query_embeddings, top_k: int = 5, session_id: Optional[str] = None,
+                is_question: Optional[bool] = None, created_after: Optional[float] = None,
+                created_before: Optional[float] = None, min_similarity: Optional[float] = None,
+                mmr: Optional[float] = None, exclude_ids: Optional[Sequence[Optional[int]]] = None,
+                candidates: Optional[int] = None) -> List[List[Tuple[int, str, float, bool]]]:
+    """
+    Finds the stored texts closest to each of many query embeddings.
+
+    The hits of every query are resolved with one query on the 'embeddings' table, which
+    also applies the metadata filters. Queries left with fewer than top_k results by the
+    filters are searched again with more candidates, until the index runs out.
+
+    :param conn: Database holding the texts.
+    :param query_embeddings: A matrix with one query vector per row, or a single vector.
+    :param top_k: Number of results to return per query.
+    :param session_id: Only search rows of this session, None to search all history.
+    :param is_question: Only return questions (True) or steps and answers (False), None for both.
+    :param created_after: Only return rows created at or after this time.
+    :param created_before: Only return rows created before this time.
+    :param min_similarity: Drop results less similar than this.
+    :param mmr: Rerank with maximal marginal relevance: 1.0 ranks by similarity alone, lower
+        values trade similarity to the query for dissimilarity to the results picked before.
+        None to skip the reranking.
+    :param exclude_ids: One row id per query left out of its results, typically the row the
+        query vector came from. None entries exclude nothing.
+    :param candidates: Nearest rows looked at per query, defaults to top_k, or 4 * top_k with
+        filters or MMR.
+    :return: One list of (id, text, similarity, is_question) tuples per query, best first.
+    """
+    vectors = np.asarray(query_embeddings, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[np.newaxis]
+    exclude_ids = list(exclude_ids) if exclude_ids is not None else [None] * len(vectors)
+    filtered = any(f is not None for f in (is_question, created_after, created_before, min_similarity)) or any(
+        id is not None for id in exclude_ids)
+    need = candidates or (4 * top_k if filtered or mmr is not None else top_k)
+    size = len(conn.index)
+
+    hits: List[List[Tuple[int, float]]] = [[] for _ in vectors]
+    rows: Dict[int, Tuple[str, bool]] = {}
+    todo = list(range(len(vectors)))
+    while todo:
+        found = conn.index.query_many(vectors[todo], need, session_id)
+        new_ids = {id for query in found for id, _ in query if id not in rows}
+        rows.update(conn.get_texts(list(new_ids), is_question, created_after, created_before))
+        retry = []
+        for i, query in zip(todo, found):
+            hits[i] = [
+                (id, similarity) for id, similarity in query
+                if id in rows and id != exclude_ids[i] and (min_similarity is None or similarity >= min_similarity)
+            ]
+            # The index returns hits best first: past min_similarity more candidates can't help
+            exhausted = len(query) < need or need >= size or (
+                min_similarity is not None and query and query[-1][1] < min_similarity)
+            if len(hits[i]) < top_k and not exhausted:
+                retry.append(i)
+        todo, need = retry, need * 4
+
+    if mmr is not None:
+        hits = _mmr(conn, vectors, hits, top_k, mmr)
+    return [[(id, rows[id][0], similarity, rows[id][1]) for id, similarity in query[:top_k]] for query in hits]
+
+
+def _mmr(conn: EmbeddingDB, vectors: np.ndarray, hits: List[List[Tuple[int, float]]], top_k: int,
+         weight: float) -> List[List[Tuple[int, float]]]:
+    # Greedy maximal marginal relevance over each query's candidates, one segment read for all of them
+    ids = list({id for query in hits for id, _ in query if id in conn.segment})
+    if not ids:
+        return hits
+    matrix = conn.segment.get_many(ids, full_precision=True)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    unit = dict(zip(ids, matrix / np.where(norms == 0, 1.0, norms)))
+    reranked = []
+    for query in hits:
+        pool = [(id, similarity) for id, similarity in query if id in unit]
+        picked: List[Tuple[int, float]] = []
+        redundancy = np.full(len(pool), -np.inf)
+        while pool and len(picked) < top_k:
+            relevance = np.array([similarity for _, similarity in pool])
+            penalty = np.where(np.isinf(redundancy), 0.0, redundancy)
+            best = int(np.argmax(weight * relevance - (1 - weight) * penalty))
+            id, similarity = pool.pop(best)
+            redundancy = np.delete(redundancy, best)
+            picked.append((id, similarity))
+            if pool:
+                others = np.stack([unit[other] for other, _ in pool])
+                redundancy = np.maximum(redundancy, others @ unit[id])
+        reranked.append(picked)
+    return reranked
@@ -0,0 +1,466 @@
+# Append-only, memory-mapped vector storage
+import json
+import os
+import tempfile
+import threading
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # no cross-process append lock, one writer process only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DTYPES = ('float32', 'float16', 'int8')
+
+
+class VectorSegment:
+    """
+    Append-only vector file with optional scalar quantization.
+
+    A segment at `path` is a set of flat files read through np.memmap:
+
+    - `path.vec`: one row per vector, stored as float32, float16 or int8
+    - `path.norms`: float32 L2 norm of each original vector
+    - `path.scale`: float32 per-row scale of int8 rows (int8 only)
+    - `path.f32`: the original float32 vectors, for rescoring (only with full_precision)
+    - `path.ids`: int64 id of each row, written last, so a row counts once its id is on disk
+    - `path.meta.json`: dimension, dtype and full_precision, fixed when the segment is created
+
+    float16 halves the size of a vector and int8 quarters it. With full_precision the
+    float32 copy stays on disk and is only paged in for the rows that get rescored.
+
+    Rows are never rewritten: storing an id again appends a new row that supersedes the
+    old one, and removing an id only forgets it in memory. compact() drops dead rows.
+    Appends from several processes are serialized with a file lock, and a process notices
+    when another one compacted the segment and reloads it.
+    """
+
+    def __init__(self, path: str, dim: Optional[int] = None, dtype: str = 'float32', full_precision: bool = False):
+        """
+        :param path: Base path of the segment's files.
+        :param dim: Vector dimension, taken from the first vector if None.
+        :param dtype: Storage type of the rows: 'float32', 'float16' or 'int8'.
+        :param full_precision: Also keep the float32 vectors for rescoring (ignored for float32 rows).
+        """
+        self.path = path
+        meta_file = f"{path}.meta.json"
+        if os.path.exists(meta_file):
+            # The layout of an existing segment wins over the arguments
+            with open(meta_file) as f:
+                meta = json.load(f)
+            dim, dtype, full_precision = meta['dim'], meta['dtype'], meta['full_precision']
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported vector dtype: {dtype}")
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.full_precision = bool(full_precision) and dtype != 'float32'
+        self._lock = threading.RLock()
+        self._files = {}
+        self._views = None
+        self._rows: Dict[int, int] = {}  # id -> row of its latest vector
+        self._count = 0
+        self._inode = None
+        self._open()
+
+    # Layout
+
+    def _parts(self) -> Dict[str, Tuple[np.dtype, int]]:
+        # file suffix -> (dtype, values per row)
+        parts = {'vec': (self.dtype, self.dim), 'norms': (np.dtype(np.float32), 1)}
+        if self.dtype == np.int8:
+            parts['scale'] = (np.dtype(np.float32), 1)
+        if self.full_precision:
+            parts['f32'] = (np.dtype(np.float32), self.dim)
+        parts['ids'] = (np.dtype(np.int64), 1)
+        return parts
+
+    def _open(self):
+        if self.dim is None:
+            return  # Nothing written yet
+        # Rows cut short by a crash are ignored, every file must hold the row
+        counts = []
+        for suffix, (dtype, width) in self._parts().items():
+            file = f"{self.path}.{suffix}"
+            size = os.path.getsize(file) if os.path.exists(file) else 0
+            counts.append(size // (dtype.itemsize * width))
+        self._count = min(counts)
+        ids_file = f"{self.path}.ids"
+        self._inode = os.stat(ids_file).st_ino if os.path.exists(ids_file) else None
+        if self._count:
+            ids = np.fromfile(f"{self.path}.ids", dtype=np.int64, count=self._count)
+            self._rows = {int(id): row for row, id in enumerate(ids)}
+        self._views = None
+
+    def _create(self, dim: int):
+        self.dim = dim
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Written aside and renamed, a crash never leaves a half-written meta file behind
+        tmp = f"{self.path}.meta.json.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'dim': dim, 'dtype': self.dtype.name, 'full_precision': self.full_precision}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, f"{self.path}.meta.json")
+
+    def _sync(self):
+        # Caller holds the lock. Reloads the segment if another process compacted it.
+        if self.dim is None:
+            return
+        try:
+            inode = os.stat(f"{self.path}.ids").st_ino
+        except FileNotFoundError:
+            inode = None
+        if inode != self._inode:
+            self._close_files()
+            self._rows = {}
+            self._count = 0
+            self._open()
+
+    @contextmanager
+    def _locked(self):
+        # Cross-process lock on a file that compaction never replaces
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(f"{self.path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _file(self, suffix: str):
+        file = self._files.get(suffix)
+        if file is None:
+            file = self._files[suffix] = open(f"{self.path}.{suffix}", 'ab', buffering=0)
+        return file
+
+    # Writing
+
+    def keep_full_precision(self):
+        """
+        Keeps float32 copies of quantized rows, e.g. for vectors that exist nowhere else.
+        Only possible before the first row is written, the layout is fixed from then on.
+        """
+        with self._lock:
+            if self.dim is not None:
+                raise ValueError(f"{self.path} already exists, its layout can't change")
+            self.full_precision = self.dtype != np.float32
+
+    @property
+    def lossless(self) -> bool:
+        """
+        True if the segment keeps every vector exactly as it was appended.
+        """
+        return self.dtype == np.float32 or self.full_precision
+
+    def flush(self):
+        """
+        Forces the rows appended so far to disk.
+        """
+        with self._lock:
+            for file in self._files.values():
+                os.fsync(file.fileno())
+
+    def append(self, id: int, vector) -> int:
+        """
+        Stores a vector under an id, superseding any earlier vector of the id.
+
+        :param id: Row id of the embedding.
+        :param vector: The vector, as an array or float32 bytes.
+        :return: The row the vector was written to.
+        """
+        return self.append_many([id], [vector])[0]
+
+    def append_many(self, ids: Iterable[int], vectors) -> List[int]:
+        """
+        Stores several vectors with one write per file.
+
+        :param ids: Row ids of the embeddings.
+        :param vectors: The vectors, as arrays or float32 bytes.
+        :return: The rows the vectors were written to.
+        """
+        ids = list(ids)
+        if not ids:
+            return []
+        matrix = np.stack([
+            np.frombuffer(v, dtype=np.float32) if isinstance(v, (bytes, bytearray, memoryview))
+            else np.asarray(v, dtype=np.float32).ravel()
+            for v in vectors
+        ])
+        with self._lock, self._locked():
+            if self.dim is None:
+                self._create(matrix.shape[1])
+            if matrix.shape[1] != self.dim:
+                raise ValueError(f"Vector size mismatch. Expected {self.dim}, got {matrix.shape[1]}.")
+            self._sync()
+            norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+            data = {'norms': norms, 'ids': np.asarray(ids, dtype=np.int64)}
+            if self.dtype == np.int8:
+                scale = np.abs(matrix).max(axis=1) / 127
+                scale[scale == 0] = 1.0
+                data['vec'] = np.round(matrix / scale[:, None]).astype(np.int8)
+                data['scale'] = scale.astype(np.float32)
+            else:
+                data['vec'] = matrix.astype(self.dtype)
+            if self.full_precision:
+                data['f32'] = matrix
+            for suffix in self._parts():
+                self._file(suffix).write(np.ascontiguousarray(data[suffix]).tobytes())
+            if self._inode is None:
+                self._inode = os.fstat(self._file('ids').fileno()).st_ino
+            # Other processes may have appended too, the new rows end where the ids file ends
+            self._count = os.fstat(self._file('ids').fileno()).st_size // 8
+            first = self._count - len(ids)
+            for offset, id in enumerate(ids):
+                self._rows[int(id)] = first + offset
+            self._views = None
+            return list(range(first, self._count))
+
+    def remove(self, id: int):
+        """
+        Forgets an id. Its rows stay on disk until the next compact().
+        """
+        with self._lock:
+            self._rows.pop(int(id), None)
+
+    def retain(self, ids: Iterable[int]):
+        """
+        Forgets every id not in ids, e.g. rows deleted while the segment wasn't open.
+        """
+        keep = set(map(int, ids))
+        with self._lock:
+            self._rows = {id: row for id, row in self._rows.items() if id in keep}
+
+    def compact(self, keep_ids: Optional[Iterable[int]] = None):
+        """
+        Rewrites the segment with one row per live id.
+
+        :param keep_ids: Ids to keep, None to keep every id that wasn't removed.
+        """
+        with self._lock, self._locked():
+            if self.dim is None:
+                return
+            self._sync()
+            rows = self._rows if keep_ids is None else {id: self._rows[id] for id in map(int, keep_ids) if id in self._rows}
+            order = sorted(rows.values())
+            views = self._load_views() if self._count else None
+            self._close_files()
+            self._views = None
+            for suffix, (dtype, width) in self._parts().items():
+                tmp = f"{self.path}.{suffix}.tmp"
+                if views is not None and order:
+                    np.ascontiguousarray(views[suffix][order]).tofile(tmp)
+                else:
+                    open(tmp, 'wb').close()
+                os.replace(tmp, f"{self.path}.{suffix}")
+            self._rows = {}
+            self._count = 0
+            self._open()
+            logger.debug(f"compacted {self.path}: {self._count} rows")
+
+    # Reading
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, id):
+        return int(id) in self._rows
+
+    @property
+    def dead_rows(self) -> int:
+        """
+        Rows superseded or removed, reclaimed by compact().
+        """
+        return self._count - len(self._rows)
+
+    def _load_views(self) -> Dict[str, np.ndarray]:
+        # Caller holds the lock
+        if self._views is None:
+            self._sync()
+            self._views = {
+                suffix: np.memmap(f"{self.path}.{suffix}", dtype=dtype, mode='r',
+                                  shape=(self._count, width) if width > 1 else (self._count,))
+                for suffix, (dtype, width) in self._parts().items()
+            }
+        return self._views
+
+    def views(self) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Zero-copy views over every row on disk, superseded ones included.
+
+        :return: The arrays keyed by file suffix ('vec', 'norms', 'ids', ...), None if the segment is empty.
+        """
+        with self._lock:
+            return self._load_views() if self._count else None
+
+    def rows(self, ids: Iterable[int]) -> np.ndarray:
+        """
+        :return: The rows holding the latest vectors of the ids, KeyError for an unknown id.
+        """
+        with self._lock:
+            return np.fromiter((self._rows[int(id)] for id in ids), dtype=np.int64)
+
+    def get(self, id: int, full_precision: bool = True) -> Optional[np.ndarray]:
+        """
+        :param id: Row id of the embedding.
+        :param full_precision: Return the float32 original if the segment keeps it.
+        :return: The vector as float32, None if the id isn't stored.
+        """
+        if int(id) not in self._rows:
+            return None
+        return self.get_many([id], full_precision)[0]
+
+    def get_many(self, ids: Iterable[int], full_precision: bool = False) -> np.ndarray:
+        """
+        :param ids: Row ids of the embeddings.
+        :param full_precision: Read the float32 originals if the segment keeps them.
+        :return: A float32 matrix with one vector per id.
+        """
+        with self._lock:
+            # Rows and views must come from the same files, compact() renumbers the rows
+            rows = self.rows(ids)
+            if len(rows) == 0:
+                return np.empty((0, self.dim or 0), dtype=np.float32)
+            views = self._load_views()
+        return self._decode(views, rows, full_precision)
+
+    def _decode(self, views, rows, full_precision: bool = False) -> np.ndarray:
+        if full_precision and self.full_precision:
+            return np.array(views['f32'][rows])
+        matrix = views['vec'][rows].astype(np.float32)
+        if self.dtype == np.int8:
+            matrix *= views['scale'][rows][:, None]
+        return matrix
+
+    def iter_chunks(self, ids: Optional[Iterable[int]] = None, chunk_size: int = 4096) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Decodes vectors a chunk at a time, so a full pass never holds more than one chunk as float32.
+
+        :param ids: Ids to read, None for every stored id.
+        :param chunk_size: Number of vectors per chunk.
+        :return: An iterator of (ids, float32 matrix) pairs.
+        """
+        with self._lock:
+            ids = list(self._rows) if ids is None else [id for id in map(int, ids) if id in self._rows]
+            views = self._load_views() if self._count else None
+            rows = self.rows(ids)
+        ids = np.asarray(ids, dtype=np.int64)
+        if views is None or len(ids) == 0:
+            return
+        order = np.argsort(rows)  # sequential reads through the map
+        ids, rows = ids[order], rows[order]
+        for start in range(0, len(ids), chunk_size):
+            yield ids[start:start + chunk_size], self._decode(views, rows[start:start + chunk_size])
+
+    def scan(self, query, top_k: int = 5, ids: Optional[Iterable[int]] = None, rescore: bool = True) -> List[Tuple[int, float]]:
+        """
+        Exact cosine search over the stored vectors.
+
+        :param query: The query vector.
+        :param top_k: Number of results to return.
+        :param ids: Only search these ids, None to search everything.
+        :param rescore: Rerank the best quantized matches against the float32 originals, if kept.
+        :return: A list of (id, cosine similarity) tuples, best first.
+        """
+        query = np.asarray(query, dtype=np.float32).ravel()
+        query_norm = np.linalg.norm(query) or 1.0
+        with self._lock:
+            ids = list(self._rows) if ids is None else [id for id in map(int, ids) if id in self._rows]
+            if not ids or not self._count:
+                return []
+            views = self._load_views()
+            rows = self.rows(ids)
+        ids = np.asarray(ids, dtype=np.int64)
+        best_ids, best_scores = [], []
+        for start in range(0, len(rows), 4096):
+            chunk = rows[start:start + 4096]
+            # Precomputed norms of the originals, the quantized rows are only decoded for the dot product
+            norms = views['norms'][chunk]
+            scores = self._decode(views, chunk) @ query / (np.where(norms == 0, 1.0, norms) * query_norm)
+            best_ids.append(ids[start:start + 4096])
+            best_scores.append(scores)
+        all_ids, all_scores = np.concatenate(best_ids), np.concatenate(best_scores)
+        keep = top_k * 4 if rescore and self.full_precision else top_k
+        if keep < len(all_scores):
+            top = np.argpartition(all_scores, -keep)[-keep:]
+            all_ids, all_scores = all_ids[top], all_scores[top]
+        if rescore and self.full_precision:
+            return self.rescore(query, all_ids.tolist())[:top_k]
+        order = np.argsort(all_scores)[::-1][:top_k]
+        return [(int(all_ids[i]), float(all_scores[i])) for i in order]
+
+    def rescore(self, query, ids: List[int]) -> List[Tuple[int, float]]:
+        """
+        Exact cosine similarity of the query to a few stored vectors, full precision when kept.
+
+        :return: A list of (id, cosine similarity) tuples, best first.
+        """
+        ids = [id for id in ids if int(id) in self._rows]
+        if not ids:
+            return []
+        query = np.asarray(query, dtype=np.float32).ravel()
+        matrix = self.get_many(ids, full_precision=True)
+        norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1.0)
+        scores = matrix @ query / np.where(norms == 0, 1.0, norms)
+        results = [(int(id), float(s)) for id, s in zip(ids, scores)]
+        results.sort(key=lambda x: x[1], reverse=True)
+        return results
+
+    def _close_files(self):
+        for file in self._files.values():
+            file.close()
+        self._files = {}
+
+    def close(self):
+        """
+        Closes the segment's files.
+        """
+        with self._lock:
+            self._close_files()
+            self._views = None
+
+
+_segments: Dict[str, VectorSegment] = {}
+_segments_lock = threading.Lock()
+
+
+def get_segment(db_file: str) -> VectorSegment:
+    """
+    Returns the process-wide vector segment of a database file, stored next to it as
+    `<db_file>.vectors.*`. New segments use VECTOR_DTYPE ('float32' by default, 'float16'
+    or 'int8' to quantize) and keep float32 originals for rescoring if VECTOR_FULL_PRECISION=1.
+
+    :param db_file: Path to the SQLite database file.
+    """
+    with _segments_lock:
+        segment = _segments.get(db_file)
+        if segment is None:
+            if db_file == ':memory:':
+                path = os.path.join(tempfile.mkdtemp(prefix='vectors-'), 'memory.vectors')
+            else:
+                path = f"{db_file}.vectors"
+            segment = _segments[db_file] = VectorSegment(
+                path,
+                dtype=os.environ.get('VECTOR_DTYPE', 'float32'),
+                full_precision=os.environ.get('VECTOR_FULL_PRECISION', '') == '1',
+            )
+        return segment
+
+
+def drop_segment(db_file: str):
+    """
+    Closes and forgets the process-wide segment of a database file, e.g. after its files
+    were replaced. The next get_segment opens them again.
+    """
+    with _segments_lock:
+        segment = _segments.pop(db_file, None)
+    if segment is not None:
+        segment.close()
@@ -1,16 +1,270 @@
 import sqlite3
+import queue
+import threading
+import logging
 from abc import ABC, abstractmethod
-from typing import List, Tuple, Optional
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Applied to every pooled connection. WAL lets readers run alongside a writer, and with
+# synchronous=NORMAL a commit no longer waits for an fsync (only checkpoints do).
+PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("busy_timeout", 5000),
+    ("temp_store", "MEMORY"),
+    ("cache_size", -16000),  # KiB
+    ("mmap_size", 256 * 1024 * 1024),
+)
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of SQLite connections to one database file.
+
+    Connections are opened lazily up to max_size and handed out one thread at a time.
+    A thread inside transaction() keeps its connection, so every query it runs on the
+    same file (through any SQLiteDB instance) joins that transaction.
+    """
+
+    def __init__(self, db_file: str, max_size: int = 8, timeout: float = 30.0):
+        """
+        :param db_file: Path to the SQLite database file.
+        :param max_size: Maximum number of open connections.
+        :param timeout: Seconds to wait for a free connection before giving up.
+        """
+        self.db_file = db_file
+        # Every connection to ':memory:' would be a separate database
+        self.max_size = 1 if db_file == ':memory:' else max_size
+        self.timeout = timeout
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._all: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._writer: Optional[WriteBehindQueue] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit mode, transactions are opened explicitly by transaction()
+        conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+        for name, value in PRAGMAS:
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """
+        Takes a connection out of the pool, opening a new one if the pool isn't full.
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._all) < self.max_size:
+                conn = self._connect()
+                self._all.append(conn)
+                return conn
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No free SQLite connection to {self.db_file} after {self.timeout}s")
+
+    def release(self, conn: sqlite3.Connection):
+        """
+        Returns a connection to the pool.
+        """
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        Yields the current thread's transaction connection, or a pooled one for the
+        duration of the block.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Runs the block in a single write transaction, committed on success and rolled
+        back on error. Nested calls join the outer transaction.
+        """
+        if getattr(self._local, 'conn', None) is not None:
+            yield self._local.conn
+            return
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.conn = conn
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+            finally:
+                self._local.conn = None
+
+    @property
+    def writer(self) -> "WriteBehindQueue":
+        """
+        The write-behind queue of this database, started on first use.
+        """
+        with self._lock:
+            if self._writer is None:
+                self._writer = WriteBehindQueue(self)
+            return self._writer
+
+    def flush(self):
+        """
+        Blocks until every write queued on the write-behind queue has been committed.
+        """
+        if self._writer is not None:
+            self._writer.flush()
+
+    def close(self):
+        """
+        Flushes pending writes and closes every connection.
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all = []
+            self._idle = queue.LifoQueue()
+
+
+class WriteBehindQueue:
+    """
+    Background writer that groups queued writes into one transaction per batch.
+
+    Each submitted callable runs on the writer thread inside the batch transaction,
+    and its result (or exception) is delivered through the returned Future once the
+    batch has been committed.
+    """
+
+    def __init__(self, pool: ConnectionPool, batch_size: int = 64, linger: float = 0.02):
+        """
+        :param pool: Pool of the database to write to.
+        :param batch_size: Maximum number of writes per transaction.
+        :param linger: Seconds to wait for more writes before committing a partial batch.
+        """
+        self.pool = pool
+        self.batch_size = batch_size
+        self.linger = linger
+        self._queue: "queue.Queue[Optional[Tuple[Callable, Tuple, Future]]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=f"write-behind:{pool.db_file}", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable, *args) -> Future:
+        """
+        Queues a write.
+
+        :param fn: Callable performing the write through an SQLiteDB on the same file.
+        :return: A Future resolved with fn's return value after commit.
+        """
+        future = Future()
+        self._queue.put((fn, args, future))
+        return future
+
+    def flush(self):
+        """
+        Blocks until every write queued so far has been committed.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Flushes pending writes and stops the writer thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=self.linger)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)  # stop after this batch
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+            self._write(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write(self, batch):
+        results = []
+        try:
+            with self.pool.transaction():
+                for fn, args, _ in batch:
+                    results.append(fn(*args))
+        except Exception as e:
+            logger.exception(f"write-behind batch of {len(batch)} failed")
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+class ExecuteResult(NamedTuple):
+    """
+    What's left of a write once its connection is back in the pool. The cursor itself
+    isn't handed out: another thread may be using its connection by then.
+    """
+    lastrowid: Optional[int]
+    rowcount: int
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_file: str) -> ConnectionPool:
+    """
+    Returns the process-wide connection pool for a database file.
+
+    :param db_file: Path to the SQLite database file.
+    :return: The shared ConnectionPool.
+    """
+    with _pools_lock:
+        pool = _pools.get(db_file)
+        if pool is None:
+            pool = _pools[db_file] = ConnectionPool(db_file)
+        return pool
+
 
 # Abstract class that handles general SQLite logic
 class SQLiteDB(ABC):
     def __init__(self, db_file: str):
         """
-        Initializes the SQLiteDB object by creating a connection to the SQLite database.
+        Initializes the SQLiteDB object on top of the shared connection pool for the database file.
 
         :param db_file: Path to the SQLite database file.
         """
-        self.conn = sqlite3.connect(db_file)
+        self.db_file = db_file
+        self.pool = get_pool(db_file)
         self._create_table()
 
     @abstractmethod
@@ -19,21 +273,41 @@ class SQLiteDB(ABC):
         Abstract method for creating a specific table. Must be implemented in subclass.
         """
         pass
-    
-    def execute_query(self, query: str, params: Tuple = ()) -> sqlite3.Cursor:
+
+    def execute_query(self, query: str, params: Tuple = ()) -> ExecuteResult:
         return self.execute(query, params)
-    
-    def execute(self, query: str, params: Tuple = ()) -> sqlite3.Cursor:
+
+    def execute(self, query: str, params: Tuple = ()) -> ExecuteResult:
         """
-        Executes a given SQL query with optional parameters and returns a cursor.
+        Executes a given SQL query with optional parameters.
+        Outside a transaction the statement is committed on its own.
+        Rows of a SELECT are read with fetch_one or fetch_all instead.
 
         :param query: The SQL query to execute.
         :param params: Optional parameters to bind to the query.
-        :return: sqlite3.Cursor object after executing the query.
+        :return: The last inserted row id and the number of changed rows, read before the connection is released.
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.execute(query, params)
+            return ExecuteResult(cursor.lastrowid, cursor.rowcount)
+
+    def execute_many(self, query: str, params: Iterable[Tuple]) -> ExecuteResult:
         """
-        cursor = self.conn.execute(query, params)
-        self.conn.commit()
-        return cursor
+        Executes a query once per parameter tuple in a single transaction.
+
+        :param query: The SQL query to execute.
+        :param params: Parameter tuples to bind to the query.
+        :return: The last inserted row id and the number of changed rows, read before the connection is released.
+        """
+        with self.pool.transaction() as conn:
+            cursor = conn.executemany(query, params)
+            return ExecuteResult(cursor.lastrowid, cursor.rowcount)
+
+    def transaction(self):
+        """
+        Context manager grouping every query of the block into one commit.
+        """
+        return self.pool.transaction()
 
     def fetch_one(self, query: str, params: Tuple = ()) -> Optional[Tuple]:
         """
@@ -43,8 +317,8 @@ class SQLiteDB(ABC):
         :param params: Optional parameters to bind to the query.
         :return: A tuple containing the result if found, otherwise None.
         """
-        cursor = self.conn.execute(query, params)
-        return cursor.fetchone()
+        with self.pool.connection() as conn:
+            return conn.execute(query, params).fetchone()
 
     def fetch_all(self, query: str, params: Tuple = ()) -> List[Tuple]:
         """
@@ -54,11 +328,26 @@ class SQLiteDB(ABC):
         :param params: Optional parameters to bind to the query.
         :return: A list of tuples containing the results.
         """
-        cursor = self.conn.execute(query, params)
-        return cursor.fetchall()
+        with self.pool.connection() as conn:
+            return conn.execute(query, params).fetchall()
+
+    def defer(self, fn: Callable, *args) -> Future:
+        """
+        Queues a write on the database's write-behind queue.
+
+        :param fn: Callable performing the write, e.g. a bound insert method.
+        :return: A Future resolved with fn's return value after commit.
+        """
+        return self.pool.writer.submit(fn, *args)
+
+    def flush(self):
+        """
+        Blocks until every deferred write has been committed.
+        """
+        self.pool.flush()
 
     def close(self):
         """
-        Closes the connection to the database.
+        Flushes deferred writes. Connections stay in the shared pool.
         """
-        self.conn.close()
\ No newline at end of file
+        self.flush()
@@ -0,0 +1,50 @@
+Feature: Answer cache
+  strategies.answer_cache.AnswerCache stores the trace of every completed run under its
+  question. A question close enough to a cached one, asked with the same strategy and
+  branch count, gets the stored run replayed, graphs included, instead of a new run.
+
+  Background:
+    Given an answer cache over a database of questions
+    And the question "How far is the moon?" near 1, 0, 0, 0 was answered by a stepwise run
+
+  Scenario: A near-duplicate question replays the run
+    When the question "How far away is the moon?" near 1, 0.05, 0, 0 is asked with the stepwise strategy
+    Then the cached run of "How far is the moon?" is found
+    And its replay sends the events "step, step, inconsistency, step, final, done"
+    And the replayed graphs are the graphs of the run
+    And the done event names the cached question
+
+  Scenario: A replay with graph deltas rebuilds the same graphs
+    When the question "How far away is the moon?" near 1, 0.05, 0, 0 is asked with the stepwise strategy
+    Then the graph deltas of its replay rebuild the graphs of the run
+
+  Scenario: A different question misses
+    When the question "How heavy is the sun?" near 0, 1, 0, 0 is asked with the stepwise strategy
+    Then no cached run is found
+    And the answer cache counts 0 hits and 1 miss
+
+  Scenario Outline: Runs of another strategy or branch count are not replayed
+    When the question "How far away is the moon?" near 1, 0.05, 0, 0 is asked with the <strategy> strategy and <branches> branches
+    Then no cached run is found
+
+    Examples:
+      | strategy    | branches |
+      | single_shot | 1        |
+      | stepwise    | 3        |
+
+  Scenario: Expired runs are not replayed
+    Given cached runs expire right away
+    When the question "How far away is the moon?" near 1, 0.05, 0, 0 is asked with the stepwise strategy
+    Then no cached run is found
+
+  Scenario: Runs stored with the whole graph of every event still replay
+    Given the question "Why is the sky blue?" near 0, 0, 1, 0 was answered by a stepwise run stored with whole graphs
+    When the question "Why is the sky blue today?" near 0, 0.05, 1, 0 is asked with the stepwise strategy
+    Then the cached run of "Why is the sky blue?" is found
+    And the replayed graphs are the graphs of the run
+    And the graph deltas of its replay rebuild the graphs of the run
+
+  Scenario: Runs of deleted questions are evicted
+    When the question "How far is the moon?" is deleted
+    And the answer cache is evicted
+    Then 0 cached runs are stored
@@ -0,0 +1,100 @@
+Feature: Branching runs
+  strategies.branches.BranchMerge merges the steps of several reasoning branches into one
+  graph rooted at the question. Branches whose strongest path gets too weak are cancelled,
+  and the answer that is the most coherent and that the other branches agree with wins.
+
+  Scenario: Steps link to their own branch and to similar steps of other branches
+    Given a branching run of 3 branches on a question near 1, 0, 0, 0
+    When these branch steps arrive
+      | branch | vector         |
+      | 1      | 1, 0.5, 0, 0   |
+      | 2      | 0, 0, 1, 0     |
+      | 1      | 0.5, 1, 0, 0   |
+      | 2      | 0, 0.2, 1, 0   |
+      | 3      | 0.5, 1, 0.1, 0 |
+    Then the merged graph has the edges
+      | from     | to       |
+      | Question | B1.Step1 |
+      | Question | B2.Step1 |
+      | Question | B1.Step2 |
+      | B1.Step1 | B1.Step2 |
+      | Question | B2.Step2 |
+      | B2.Step1 | B2.Step2 |
+      | Question | B3.Step1 |
+      | B1.Step2 | B3.Step1 |
+
+  Scenario: The answer the other branches agree with wins
+    Given a branching run of 3 branches on a question near 1, 0, 0, 0
+    When these branch steps arrive
+      | branch | vector       |
+      | 1      | 1, 0.2, 0, 0 |
+      | 2      | 1, 0.3, 0, 0 |
+      | 3      | 1, 0, 0.3, 0 |
+    And branch 1 answers near 1, 1, 0, 0
+    And branch 2 answers near 1, 0.9, 0, 0
+    And branch 3 answers near 0, 0, 0, 1
+    And the branches are merged
+    Then the run sent the events "step, step, step, final, done"
+    And the answer of branch 2 wins
+    And the answers of branches "1, 2, 3" were scored
+    And the graph deltas of the run rebuild the merged graph
+    And the trace of the run holds its events and rebuilds the merged graph
+
+  Scenario: A branch whose strongest path gets too weak is cancelled
+    Given a branching run of 2 branches with a cutoff of 0.5 after 2 steps on a question near 1, 0, 0, 0
+    When these branch steps arrive
+      | branch | vector       |
+      | 1      | 1, 0.1, 0, 0 |
+      | 2      | 0, 1, 0, 0   |
+      | 1      | 1, 0.2, 0, 0 |
+      | 2      | 0, 1, 1, 0   |
+      | 2      | 0, 0, 1, 1   |
+    And branch 2 answers near 0, 0, 0, 1
+    And branch 1 answers near 1, 0.3, 0, 0
+    And the branches are merged
+    Then the run sent the events "step, step, step, step, branch_cancelled, final, done"
+    And branch 2 was cancelled under the cutoff
+    And the answer of branch 1 wins
+    And the answers of branches "1" were scored
+    And the trace of the run holds its events and rebuilds the merged graph
+
+  Scenario: The last branch still running is not cancelled
+    Given a branching run of 2 branches with a cutoff of 0.5 after 2 steps on a question near 1, 0, 0, 0
+    When branch 1 fails
+    And these branch steps arrive
+      | branch | vector     |
+      | 2      | 0, 1, 0, 0 |
+      | 2      | 0, 0, 1, 0 |
+      | 2      | 0, 0, 0, 1 |
+    And branch 2 answers near 0, 0, 0, 1
+    And the branches are merged
+    Then the run sent the events "branch_cancelled, step, step, step, final, done"
+    And the answer of branch 2 wins
+
+  Scenario: Restarted branches keep their steps in the graph
+    Given a branching run of 2 branches on a question near 1, 0, 0, 0
+    When these branch steps arrive
+      | branch | vector       |
+      | 1      | 1, 0.2, 0, 0 |
+      | 2      | 1, 0.3, 0, 0 |
+    And branch 2 restarts
+    And these branch steps arrive
+      | branch | vector       |
+      | 2      | 1, 0.4, 0, 0 |
+    And branch 1 answers near 1, 0.5, 0, 0
+    And branch 2 answers near 1, 0.5, 0.1, 0
+    And the branches are merged
+    Then the run sent the events "step, step, branch_restarted, step, final, done"
+    And the answers of branches "1, 2" were scored
+    And the trace of the run holds its events and rebuilds the merged graph
+
+  Scenario: A run where every branch failed ends with an error
+    Given a branching run of 2 branches on a question near 1, 0, 0, 0
+    When these branch steps arrive
+      | branch | vector       |
+      | 1      | 1, 0.2, 0, 0 |
+    And branch 1 fails
+    And branch 2 fails
+    And the branches are merged
+    Then the run sent the events "step, branch_cancelled, branch_cancelled, error, done"
+    And the error says that every branch failed
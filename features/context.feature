@@ -0,0 +1,45 @@
+Feature: Context window
+  strategies.context.ContextWindow keeps the prompt of a long reasoning run within its token
+  budget by folding the older steps into one summary message after the fixed prefix.
+
+  Background:
+    Given a conversation of 10 steps of 200 characters
+    And odd steps build on the previous odd step, even steps branch off
+
+  Scenario: A prompt within the budget is sent as it is
+    Given a context window of 1000 tokens keeping 3 steps
+    When the prompt is built
+    Then no steps are folded
+    And the prompt is the whole conversation
+
+  Scenario: A budget of 0 never folds
+    Given a context window of 0 tokens keeping 3 steps
+    When the prompt is built
+    Then no steps are folded
+    And the prompt is the whole conversation
+
+  Scenario: Older steps are folded into a summary
+    Given a context window of 400 tokens keeping 3 steps
+    When the prompt is built
+    Then 7 steps are folded
+    And the prompt is within 400 tokens
+    And the prompt starts with the 3 prefix messages
+    And the prompt ends with steps 8 to 10
+    And the summary lists the titles of steps 1 to 7
+    And the summary holds the content of step 7
+    And the summary only holds the content of steps on the strongest path
+
+  Scenario: The summary stays the same until more steps are folded
+    Given a context window of 400 tokens keeping 3 steps
+    When the prompt is built
+    And the prompt is built again
+    Then no steps are folded
+    And the summary is the same as before
+
+  Scenario: A reset sends the whole conversation again
+    Given a context window of 400 tokens keeping 3 steps
+    When the prompt is built
+    And the window is reset to the prefix
+    And the prompt is built
+    Then no steps are folded
+    And the prompt is the first 3 messages
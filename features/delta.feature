@@ -0,0 +1,42 @@
+Feature: Graph deltas
+  graph.delta.GraphDelta sends each graph of the SSE stream as the nodes and edges that
+  changed since the previous one, with a full snapshot now and then so a client can resync.
+
+  Background:
+    Given a graph delta sending a snapshot every 3 updates
+
+  Scenario: The first update is a snapshot
+    When the graph with nodes "a b" and edges "a-b" is sent
+    Then update 1 is a snapshot
+    And it holds the nodes "a b" and the edges "a-b"
+
+  Scenario: Later updates only carry the changes
+    When the graph with nodes "a b" and edges "a-b" is sent
+    And the graph with nodes "a b=Renamed c" and edges "a-b b-c" is sent
+    Then update 2 is a delta
+    And it holds the nodes "b c" and the edges "b-c"
+    And it removes no nodes and no edges
+
+  Scenario: Removed nodes and edges are listed by id
+    When the graph with nodes "a b c" and edges "a-b b-c" is sent
+    And the graph with nodes "a c" and edges "" is sent
+    Then update 2 is a delta
+    And it holds no nodes and no edges
+    And it removes the nodes "b" and the edges "a-b b-c"
+
+  Scenario: Every snapshot_every updates a snapshot is sent again
+    When the graph with nodes "a" and edges "" is sent
+    And the graph with nodes "a b" and edges "a-b" is sent
+    And the graph with nodes "a b c" and edges "a-b b-c" is sent
+    And the graph with nodes "a b c d" and edges "a-b b-c c-d" is sent
+    Then update 2 is a delta
+    And update 3 is a delta
+    And update 4 is a snapshot
+    And it holds the nodes "a b c d" and the edges "a-b b-c c-d"
+
+  Scenario: A reset makes the next update a snapshot
+    When the graph with nodes "a b" and edges "a-b" is sent
+    And the delta is reset
+    And the graph with nodes "c" and edges "" is sent
+    Then update 2 is a snapshot
+    And it holds the nodes "c" and the edges ""
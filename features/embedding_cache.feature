@@ -0,0 +1,39 @@
+Feature: Embedding cache
+  chat.EmbeddingCache keeps computed embeddings in a bounded in-process LRU in front of a
+  persistent SQLite store, keyed by model, options and text. API.embed only sends the
+  model the texts it doesn't find there.
+
+  Background:
+    Given an embedding cache of 2 entries in memory and 3 rows on disk
+
+  Scenario: A stored embedding is found in memory
+    When the embedding of "alpha" is stored
+    Then "alpha" is found in memory
+
+  Scenario: The least recently used entries fall back to disk
+    When the embeddings of "alpha, beta, gamma" are stored
+    Then "beta" is found in memory
+    And "alpha" is found on disk
+    And "alpha" is found in memory
+
+  Scenario: Another process finds the entries on disk
+    When the embeddings of "alpha, beta" are stored
+    And the cache is opened again
+    Then "alpha" is found on disk
+    And "delta" is not found
+
+  Scenario: The disk keeps the newest rows
+    When the embeddings of "alpha, beta, gamma, delta, epsilon" are stored
+    And the cache is opened again
+    Then 3 embeddings are on disk
+    And "epsilon" is found on disk
+    And "alpha" is not found
+
+  Scenario: The model and its options are part of the key
+    Then the keys of "alpha" differ between models and options
+
+  Scenario: Only texts missing from the cache are sent to the model
+    When the texts "alpha, beta" are embedded
+    And the texts "beta, gamma, alpha" are embedded
+    Then the model embedded "alpha, beta" and then "gamma"
+    And the embeddings are the same as the model's
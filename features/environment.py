@@ -0,0 +1,3 @@
+# behave puts features/steps on sys.path while it loads the step modules, where steps/chat.py
+# would shadow the chat package. Importing the package first keeps it in sys.modules.
+import chat  # noqa: F401
@@ -0,0 +1,37 @@
+Feature: Corpus ingestion
+  db.ingest cuts long texts into overlapping chunks and stores them batch by batch with a
+  checkpoint, so a run that stopped halfway resumes without storing anything twice.
+
+  Scenario: A short text is one chunk
+    When the text "  A short   text.  " is chunked into 100 characters
+    Then the chunks are "A short text."
+
+  Scenario: An empty text has no chunks
+    When the text "   " is chunked into 100 characters
+    Then there are no chunks
+
+  Scenario: A long text is cut at sentence ends, with an overlap
+    Given a text of 40 numbered sentences
+    When it is chunked into 200 characters with an overlap of 30
+    Then there are several chunks of at most 200 characters
+    And every chunk but the last ends a sentence
+    And every chunk after the first starts with the end of the previous one
+    And every sentence is in a chunk
+
+  Scenario: An interrupted run resumes after its last stored batch
+    Given an input file of 6 short lines and a line of 40 numbered sentences
+    And an embedding model that fails on call 3
+    When the file is ingested in batches of 2 chunks of at most 200 characters
+    Then the ingestion fails
+    And 4 chunks are stored
+    When the embedding model works again
+    And the file is ingested in batches of 2 chunks of at most 200 characters
+    Then every chunk of the file is stored once
+    And the model only embedded the chunks that were missing
+
+  Scenario: A finished file isn't ingested again
+    Given an input file of 6 short lines and a line of 40 numbered sentences
+    When the file is ingested in batches of 2 chunks of at most 200 characters
+    And the file is ingested in batches of 2 chunks of at most 200 characters
+    Then every chunk of the file is stored once
+    And the model embedded no chunks the second time
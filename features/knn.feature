@@ -0,0 +1,69 @@
+Feature: kNN graph
+  db.knn.KnnGraphDB links every stored row to its nearest rows of all sessions, keeping
+  the strongest edges of each row. The neighbors endpoint expands rows hop by hop along
+  those edges, in both directions.
+
+  Background:
+    Given a kNN graph of 2 edges per row over the rows
+      | text | vector          |
+      | A    | 1, 0, 0         |
+      | B    | 0.966, 0.259, 0 |
+      | C    | 0.866, 0.5, 0   |
+      | D    | 0.707, 0.707, 0 |
+      | E    | 0.5, 0.866, 0   |
+      | F    | 0.259, 0.966, 0 |
+      | Z    | 0, 0, 1         |
+
+  Scenario: Each row keeps its strongest edges
+    Then the graph has 7 nodes and 14 edges
+    And the row "A" links to "B|C"
+    And the row "F" links to "D|E"
+    And the row "Z" links to "A|B"
+
+  Scenario Outline: Rows are reached hop by hop
+    When the neighborhood of "A" is expanded by <hops> hops
+    Then it reaches "<reached>"
+
+    Examples:
+      | hops | reached                          |
+      | 1    | A:0, B:1, C:1, Z:1               |
+      | 2    | A:0, B:1, C:1, Z:1, D:2          |
+      | 4    | A:0, B:1, C:1, Z:1, D:2, E:3, F:3 |
+
+  Scenario: The neighborhood holds the edges between its rows
+    When the neighborhood of "A" is expanded by 2 hops
+    Then its edges are "A-B, A-C, A-Z, B-C, B-Z, C-D"
+
+  Scenario: Weak edges are not followed
+    When the neighborhood of "A" is expanded by 4 hops along edges of at least 0.5
+    Then it reaches "A:0, B:1, C:1, D:2, E:3, F:3"
+
+  Scenario: Only the strongest edges of each row are followed
+    When the neighborhood of "A" is expanded by 2 hops along 1 edge per row
+    Then it reaches "A:0, B:1, C:2"
+    And its edges are "A-B, A-C, B-C"
+
+  Scenario: The neighborhood stops growing at its size limit
+    When the neighborhood of "A" is expanded by 4 hops up to 3 rows
+    Then it reaches "A:0, B:1, C:1"
+
+  Scenario: A deleted row leaves the graph
+    When the row "C" is deleted
+    And the neighborhood of "A" is expanded by 4 hops
+    Then the graph has 6 nodes and 9 edges
+    And the row "B" links to "A"
+    And it reaches "A:0, B:1, Z:1"
+
+  Scenario: The graph can be built again from the stored rows
+    When the graph is dropped
+    Then the graph has 0 nodes and 0 edges
+    When the missing rows are linked
+    Then the graph has 7 nodes and 14 edges
+    And the row "A" links to "B|C"
+
+  Scenario: The neighbors endpoint sends the texts and hops of the rows
+    When the neighbors of "A" are asked for with 1 hop
+    Then the neighbors are "A:0, B:1, C:1, Z:1"
+
+  Scenario: The neighbors endpoint refuses unknown rows
+    Then the neighbors of row 1000 are not found
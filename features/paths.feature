@@ -0,0 +1,50 @@
+Feature: Strongest path
+  Every step of a session is reached from the first one along the path of highest total
+  similarity, graph.paths.StrongestPath keeps it up to date as steps are added.
+
+  Scenario: The path with the highest total wins over the strongest last edge
+    Given the steps
+      | step | edges            |
+      | a    |                  |
+      | b    | a:0.3            |
+      | c    | a:0.9            |
+      | d    | b:0.7, c:0.6     |
+    Then the strongest path to d is "a, c, d"
+    And its weights are "0.9, 0.6"
+    And its average similarity is 0.75
+
+  Scenario: A later step extends the strongest path to its parent
+    Given the steps
+      | step | edges            |
+      | a    |                  |
+      | b    | a:0.3            |
+      | c    | a:0.9            |
+      | d    | b:0.7, c:0.6     |
+      | e    | b:0.95, d:0.1    |
+    Then the strongest path to e is "a, c, d, e"
+    And its weights are "0.9, 0.6, 0.1"
+    And its average similarity is 0.5333
+
+  Scenario: The first step alone
+    Given the steps
+      | step | edges |
+      | a    |       |
+    Then the strongest path to a is "a"
+    And its path has no edges
+    And its average similarity is 1.0
+
+  Scenario: A step linked to no reachable step has no path
+    Given the steps
+      | step | edges   |
+      | a    |         |
+      | b    | x:0.9   |
+    Then there is no path to b
+    And the path data of b is None
+
+  Scenario: Reset forgets every step
+    Given the steps
+      | step | edges |
+      | a    |       |
+      | b    | a:0.5 |
+    When the paths are reset
+    Then there is no path to b
@@ -0,0 +1,48 @@
+Feature: Model call scheduler
+  chat.scheduler.LLMScheduler caps the model calls running at once. Waiting calls go by
+  kind first (reasoning, then embed, then title) and sessions take turns within a kind.
+
+  Scenario: Waiting calls are served by kind
+    Given a scheduler running 1 call at a time
+    And a reasoning call of session "busy" holding its slot
+    When these calls wait
+      | kind      | session |
+      | title     | a       |
+      | embed     | a       |
+      | title     | b       |
+      | reasoning | b       |
+      | embed     | b       |
+    And the held call ends
+    Then the calls are served in the order "4, 2, 5, 1, 3"
+
+  Scenario: Sessions take turns within a kind
+    Given a scheduler running 1 call at a time
+    And a reasoning call of session "busy" holding its slot
+    When these calls wait
+      | kind      | session |
+      | reasoning | a       |
+      | reasoning | a       |
+      | reasoning | a       |
+      | reasoning | b       |
+      | reasoning | b       |
+    And the held call ends
+    Then the calls are served in the order "1, 4, 2, 5, 3"
+
+  Scenario: No more calls run at once than the cap
+    Given a scheduler running 3 calls at a time
+    When 12 embed calls of 4 sessions run on as many threads
+    Then at most 3 calls ran at once
+    And the scheduler counts 12 embed calls and none waiting or running
+
+  Scenario: A cancelled asyncio call gives its place up
+    Given a scheduler running 1 call at a time
+    And a reasoning call of session "busy" holding its slot
+    When an asyncio reasoning call of session "a" is cancelled while it waits
+    Then the scheduler counts 0 reasoning calls waiting
+    When the held call ends
+    And a reasoning call of session "b" runs
+    Then the scheduler counts 2 reasoning calls and none waiting or running
+
+  Scenario: Unknown kinds of calls are refused
+    Given a scheduler running 1 call at a time
+    Then a "chat" call is refused
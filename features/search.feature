@@ -0,0 +1,47 @@
+Feature: Hybrid search
+  db.search ranks the stored texts by BM25 over the SQLite FTS5 index, by cosine similarity
+  over the vector index, or by both fused by their ranks.
+
+  Background:
+    Given a database with the rows
+      | text                                  | vector          | question | session |
+      | How do cats hunt mice?                | 1, 0, 0, 0      | yes      | first   |
+      | Cats stalk their prey quietly.        | 0.9, 0.1, 0, 0  | no       | first   |
+      | Dogs love running in the park.        | 0, 1, 0, 0      | no       | first   |
+      | Running shoes for marathon training.  | 0, 0.9, 0.1, 0  | yes      | second  |
+      | Quantum computers use qubits.         | 0, 0, 0, 1      | no       | second  |
+
+  Scenario: Keyword search finds the rows holding the words
+    When "cats" is searched by keywords
+    Then the found texts are, in any order, "How do cats hunt mice?|Cats stalk their prey quietly."
+
+  Scenario: Keywords are stemmed
+    When "run" is searched by keywords
+    Then the found texts are, in any order, "Dogs love running in the park.|Running shoes for marathon training."
+
+  Scenario: Punctuation and FTS5 syntax in the query are taken as words
+    When the raw text cats" OR NEAR(mice* is searched by keywords
+    Then the found texts are, in any order, "How do cats hunt mice?|Cats stalk their prey quietly."
+
+  Scenario: Keyword search within a session
+    When "running" is searched by keywords in the second session
+    Then the found texts are, in any order, "Running shoes for marathon training."
+
+  Scenario: Deleted rows leave the keyword index
+    When the row "Dogs love running in the park." is deleted
+    And "running" is searched by keywords
+    Then the found texts are, in any order, "Running shoes for marathon training."
+
+  Scenario: Vector search misses a keyword match far from the query vector
+    When "quantum qubits" is searched in vector mode near 1, 0, 0, 0 for 2 results
+    Then the found texts are "How do cats hunt mice?|Cats stalk their prey quietly."
+
+  Scenario: Hybrid search fuses the keyword and vector rankings
+    When "quantum qubits" is searched in hybrid mode near 1, 0, 0, 0 for 3 results
+    Then the found texts are "Quantum computers use qubits.|How do cats hunt mice?|Cats stalk their prey quietly."
+    And the similarity of "Quantum computers use qubits." is 0
+
+  Scenario: Lexical mode ranks by keywords and reports the cosine similarity
+    When "cats prey" is searched in lexical mode near 1, 0, 0, 0 for 5 results
+    Then the found texts are "Cats stalk their prey quietly.|How do cats hunt mice?"
+    And the similarity of "How do cats hunt mice?" is 1
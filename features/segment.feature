@@ -0,0 +1,44 @@
+Feature: Vector segment
+  db.segment.VectorSegment stores the embeddings in memory-mapped files as float32, float16
+  or int8 with a per-row scale, optionally with a float32 copy for rescoring.
+
+  Scenario Outline: Vectors come back within the precision of the storage type
+    Given a <dtype> vector segment
+    When 50 random vectors of 64 dimensions are stored
+    Then every vector reads back within <tolerance> of the original
+    And the nearest stored vector of each vector is itself
+
+    Examples:
+      | dtype   | tolerance |
+      | float32 | 0         |
+      | float16 | 0.001     |
+      | int8    | 0.01      |
+
+  Scenario Outline: A quantized segment keeping full precision reads back the originals
+    Given a <dtype> vector segment keeping full precision
+    When 50 random vectors of 64 dimensions are stored
+    Then every vector reads back within 0.01 of the original
+    And every vector reads back exactly in full precision
+
+    Examples:
+      | dtype   |
+      | float16 |
+      | int8    |
+
+  Scenario: A reopened segment keeps the layout it was created with
+    Given a int8 vector segment keeping full precision
+    When 10 random vectors of 16 dimensions are stored
+    And the segment is reopened as float32
+    Then the segment stores int8 rows of 16 dimensions with full precision
+    And every vector reads back exactly in full precision
+
+  Scenario: Storing an id again supersedes its vector until the segment is compacted
+    Given a float16 vector segment
+    When 10 random vectors of 16 dimensions are stored
+    And vector 3 is stored again
+    And vector 5 is removed
+    Then the segment holds 9 vectors and 2 dead rows
+    And every vector reads back within 0.001 of the original
+    When the segment is compacted
+    Then the segment holds 9 vectors and 0 dead rows
+    And every vector reads back within 0.001 of the original
@@ -0,0 +1,54 @@
+Feature: Batched similarity search
+  db.search.search_many answers many query vectors at once, with metadata filters applied in
+  the same query on the embeddings table and an optional maximal marginal relevance rerank.
+  helpers.parse_similar_request validates the body of a /similar request.
+
+  Background:
+    Given a database with the rows
+      | text                         | vector           | question | session |
+      | Cats hunt mice at night.     | 1, 0.3, 0, 0     | yes      | first   |
+      | Cats hunt mice after dark.   | 1, 0.31, 0, 0    | no       | first   |
+      | Cats sleep most of the day.  | 0.2, 1, 0, 0     | no       | first   |
+      | Dogs fetch sticks.           | 0, 1, 0.2, 0     | no       | second  |
+      | Fish swim in schools.        | 0, 0, 1, 0       | yes      | second  |
+
+  Scenario: Every query of a batch gets its own results
+    When the vectors "0, 0, 1, 0 | 0, 1, 0.1, 0" are searched in one batch for 1 result each
+    Then the results of the batch are "Fish swim in schools. | Dogs fetch sticks."
+
+  Scenario: The nearest rows, best first
+    When the vector 1, 1, 0, 0 is searched for 2 results
+    Then the found texts are "Cats hunt mice after dark.|Cats hunt mice at night."
+
+  Scenario: Maximal marginal relevance skips the near-duplicate
+    When the vector 1, 1, 0, 0 is searched for 2 results with mmr 0.5
+    Then the found texts are "Cats hunt mice after dark.|Dogs fetch sticks."
+
+  Scenario: Only questions
+    When the vector 1, 1, 0, 0 is searched for 2 results with is_question yes
+    Then the found texts are "Cats hunt mice at night.|Fish swim in schools."
+
+  Scenario: Results under the minimum similarity are dropped
+    When the vector 0, 0, 1, 0 is searched for 5 results with min_similarity 0.5
+    Then the found texts are "Fish swim in schools."
+
+  Scenario: Only one session
+    When the vector 1, 1, 0, 0 is searched for 2 results with session second
+    Then the found texts are "Dogs fetch sticks.|Fish swim in schools."
+
+  Scenario: A stored row searched with its own vector isn't its own result
+    When the row "Cats hunt mice at night." is searched with its own vector for 1 result
+    Then the found texts are "Cats hunt mice after dark."
+
+  Scenario Outline: Invalid /similar bodies are rejected
+    When the /similar body <body> is parsed with at most 2 queries
+    Then it is rejected with "<error>"
+
+    Examples:
+      | body                             | error                                              |
+      | []                               | Expected a JSON object                             |
+      | {"texts": ["a"], "ids": [1]}     | Provide exactly one of 'texts', 'vectors' or 'ids' |
+      | {"texts": []}                    | 'texts' must be a non-empty list                   |
+      | {"texts": ["a", "b", "c"]}       | At most 2 queries per request                      |
+      | {"ids": ["1"]}                   | 'ids' must be integers                             |
+      | {"vectors": [[1, 2], [3]]}       | 'vectors' must be lists of numbers of the same length |
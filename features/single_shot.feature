@@ -0,0 +1,72 @@
+Feature: Single-shot runs
+  strategies.single_shot.SingleShotSession takes every step and the final answer from a
+  single model reply, then adds them to the graph like a stepwise run would.
+
+  Background:
+    Given a single-shot run on "Which way is north?"
+
+  Scenario: Every step of the reply becomes a step of the run
+    When the model replies
+      """
+      Here you go:
+      ```json
+      {"steps": [{"title": "Sun", "content": "The sun rises in the east."},
+                 {"title": "Shadows", "content": "At noon shadows point north."},
+                 {"title": "Compass", "content": "A compass needle points north."}],
+       "final_answer": "North is where noon shadows point."}
+      ```
+      """
+    Then the run has the steps "Sun, Shadows, Compass" numbered from 1
+    And the final answer is "North is where noon shadows point."
+    And the reply's 6 seconds are shared out between its steps
+
+  Scenario: Steps without content are dropped
+    When the model replies
+      """
+      {"steps": [{"title": "Sun", "content": "The sun rises in the east."},
+                 {"title": "Empty", "content": ""},
+                 "Not a step",
+                 {"title": "Compass", "content": "A compass needle points north."}],
+       "final_answer": "North is where the needle points."}
+      """
+    Then the run has the steps "Sun, Compass" numbered from 1
+
+  Scenario: A reply without a final answer ends with its last step
+    When the model replies
+      """
+      {"steps": [{"title": "Sun", "content": "The sun rises in the east."},
+                 {"title": "Compass", "content": "A compass needle points north."}]}
+      """
+    Then the final answer is "A compass needle points north."
+
+  Scenario: Long replies are cut to the limits of a run
+    When the model replies with 15 steps of 1000 characters under titles of 150 characters
+    Then the run has 12 steps of 700 characters under titles of 100 characters
+
+  Scenario: A reply without steps is asked for again, then taken as the answer
+    When the model replies
+      """
+      North is up.
+      """
+    Then the model is asked for the steps again
+    When the model replies
+      """
+      {"final_answer": "North is up on most maps."}
+      """
+    Then the run has no steps
+    And the final answer is "North is up on most maps."
+
+  Scenario: The steps and the answer are sent like a stepwise run's
+    When the model replies
+      """
+      {"steps": [{"title": "Sun", "content": "The sun rises in the east."},
+                 {"title": "Shadows", "content": "At noon shadows point north."},
+                 {"title": "Compass", "content": "A compass needle points north."}],
+       "final_answer": "North is where noon shadows point."}
+      """
+    And the steps and the answer are embedded and sent
+    Then the run sent the single-shot events "step, step, step, final, done"
+    And the trace of the single-shot run rebuilds its graph
+
+  Scenario: The whole reply is constrained to the single-shot schema
+    Then the single-shot run asks for replies matching the single-shot schema
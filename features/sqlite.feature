@@ -0,0 +1,39 @@
+Feature: Pooled SQLite connections
+  db.sqlite.SQLiteDB runs on one ConnectionPool per database file, in WAL mode. Queries of a
+  transaction() share one commit, and deferred writes are committed in batches by the
+  database's write-behind queue.
+
+  Background:
+    Given a notes database
+
+  Scenario: Pooled connections are in WAL mode
+    Then the journal mode is "wal"
+
+  Scenario: Concurrent inserts each get the id of their own row
+    When 8 threads insert 50 notes each
+    Then 400 notes are stored
+    And every insert returned the id of its own note
+
+  Scenario: A failed transaction stores none of its queries
+    When a transaction inserts 3 notes and fails
+    Then 0 notes are stored
+
+  Scenario: Nested transactions and other instances on the same file join the outer one
+    When a transaction inserts a note, nests a transaction inserting another and fails
+    Then 0 notes are stored
+    When a transaction inserts a note, nests a transaction inserting another and commits
+    Then 2 notes are stored
+
+  Scenario: Deferred writes are committed once flushed
+    When 200 notes are deferred
+    And the deferred writes are flushed
+    Then 200 notes are stored
+    And every deferred write resolved to the id of its own note
+
+  Scenario: A failed deferred write fails its batch, later writes go through
+    When a deferred write fails
+    And the deferred writes are flushed
+    Then the failed write's future holds its error
+    When 5 notes are deferred
+    And the deferred writes are flushed
+    Then 5 notes are stored
@@ -0,0 +1,176 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from behave import *
+
+from db.embeddings import get_db
+from db.sqlite import get_pool
+from graph.delta import GraphDelta, apply_delta
+from strategies.answer_cache import AnswerCache
+
+
+def _vector(text):
+    return np.array([float(value) for value in text.split(',')], dtype=np.float32)
+
+
+def _graph(nodes, edges):
+    return {
+        'nodes': [{'id': id, 'label': label} for id, label in nodes],
+        'edges': [{'id': f"{source}-{target}", 'source': source, 'target': target} for source, target in edges],
+    }
+
+
+# A stepwise run which threw its first two steps away: (event, graph after it)
+RUN = [
+    ({'type': 'step', 'content': 'Step 1'}, _graph([('q', 'Question'), ('s1', 'Step 1')], [('q', 's1')])),
+    ({'type': 'step', 'content': 'Step 2'},
+     _graph([('q', 'Question'), ('s1', 'Step 1'), ('s2', 'Step 2')], [('q', 's1'), ('s1', 's2')])),
+    ({'type': 'inconsistency', 'message': 'Step 2 contradicts step 1'}, None),
+    ({'type': 'step', 'content': 'Step 3'}, _graph([('q', 'Question'), ('s3', 'Step 3')], [('q', 's3')])),
+    ({'type': 'final', 'content': 'Answer'},
+     _graph([('q', 'Question'), ('s3', 'Step 3 (checked)'), ('a', 'Answer')], [('q', 's3'), ('s3', 'a')])),
+]
+GRAPHS = [graph for _, graph in RUN if graph is not None]
+
+
+def _trace(whole_graphs=False):
+    # Same as ReasoningSession.trace
+    trace = []
+    trace_delta = GraphDelta(snapshot_every=None)
+    for event, graph in RUN:
+        if graph is None:
+            trace_delta.reset()
+            trace.append(dict(event))
+        elif whole_graphs:
+            trace.append({**event, 'graph': graph})
+        else:
+            trace.append({**event, 'graph_delta': trace_delta.update(graph)})
+    return trace
+
+
+def _events(stream):
+    return [json.loads(event[len('data: '):]) for event in stream]
+
+
+@given('an answer cache over a database of questions')
+def step_impl(context):
+    context.dir = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.dir, True)
+    context.db_file = os.path.join(context.dir, 'embeddings.db')
+    context.db = get_db(context.db_file)
+    context.cache = AnswerCache(context.db_file)
+    context.questions = {}
+    context.add_cleanup(get_pool(context.db_file).close)
+
+
+def _answered(context, question, vector, whole_graphs):
+    question_id = context.db.insert_embedding(question, _vector(vector), 1)
+    context.questions[question] = question_id
+    context.cache.store(question_id, question, _trace(whole_graphs), 12.5, 'stepwise', 1)
+    context.cache.db.flush()
+
+
+@given('the question "{question}" near {vector} was answered by a stepwise run')
+def step_impl(context, question, vector):
+    _answered(context, question, vector, whole_graphs=False)
+
+
+@given('the question "{question}" near {vector} was answered by a stepwise run stored with whole graphs')
+def step_impl(context, question, vector):
+    _answered(context, question, vector, whole_graphs=True)
+
+
+@given('cached runs expire right away')
+def step_impl(context):
+    context.cache.max_age = 0
+
+
+def _ask(context, question, vector, strategy, branches):
+    # The new question is stored before the lookup, like the app does
+    question_id = context.db.insert_embedding(question, _vector(vector), 1)
+    context.hit = context.cache.lookup(context.db, _vector(vector), exclude_id=question_id,
+                                       strategy=strategy, branches=branches)
+
+
+@when('the question "{question}" near {vector} is asked with the {strategy} strategy')
+def step_impl(context, question, vector, strategy):
+    _ask(context, question, vector, strategy, 1)
+
+
+@when('the question "{question}" near {vector} is asked with the {strategy} strategy and {branches:d} branches')
+def step_impl(context, question, vector, strategy, branches):
+    _ask(context, question, vector, strategy, branches)
+
+
+@then('the cached run of "{question}" is found')
+def step_impl(context, question):
+    assert context.hit is not None, "no cached run"
+    assert context.hit['question_id'] == context.questions[question], context.hit
+    assert context.hit['question'] == question, context.hit
+    assert context.cache.threshold <= context.hit['similarity'] < 1, context.hit['similarity']
+
+
+@then('no cached run is found')
+def step_impl(context):
+    assert context.hit is None, context.hit
+
+
+@then('its replay sends the events "{types}"')
+def step_impl(context, types):
+    events = _events(context.cache.replay(context.hit, delta=False))
+    assert [event['type'] for event in events] == [name.strip() for name in types.split(',')], events
+
+
+@then('the replayed graphs are the graphs of the run')
+def step_impl(context):
+    events = _events(context.cache.replay(context.hit, delta=False))
+    assert [event['graph'] for event in events if 'graph' in event] == GRAPHS
+    assert not any('graph_delta' in event for event in events)
+
+
+@then('the graph deltas of its replay rebuild the graphs of the run')
+def step_impl(context):
+    graph, graphs = None, []
+    for event in _events(context.cache.replay(context.hit)):
+        assert 'graph' not in event, event
+        if event['type'] == 'inconsistency':
+            graph = None  # What the page does, the next delta is a snapshot anyway
+        if 'graph_delta' in event:
+            graph = apply_delta(graph, event['graph_delta'])
+            graphs.append(graph)
+    assert graphs == GRAPHS, graphs
+
+
+@then('the done event names the cached question')
+def step_impl(context):
+    done = _events(context.cache.replay(context.hit))[-1]
+    assert done['type'] == 'done', done
+    assert done['cached'] == {
+        'question': context.hit['question'],
+        'similarity': context.hit['similarity'],
+        'original_time': 12.5,
+    }, done
+
+
+@then('the answer cache counts {hits:d} hits and {misses:d} miss')
+def step_impl(context, hits, misses):
+    assert context.cache.stats() == {'hits': hits, 'misses': misses}, context.cache.stats()
+
+
+@when('the question "{question}" is deleted')
+def step_impl(context, question):
+    assert context.db.delete_embedding(context.questions[question])
+
+
+@when('the answer cache is evicted')
+def step_impl(context):
+    context.cache.evict()
+
+
+@then('{count:d} cached runs are stored')
+def step_impl(context, count):
+    stored = context.cache.db.fetch_all("SELECT COUNT(*) FROM answer_cache")[0][0]
+    assert stored == count, stored
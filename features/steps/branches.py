@@ -0,0 +1,139 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from behave import *
+
+from db.embeddings import get_db
+from db.sqlite import get_pool
+from graph.delta import apply_delta
+from graph.helpers import serialize_graph_data
+from strategies.branches import BranchMerge
+
+
+def _vector(text):
+    return np.array([float(value) for value in text.split(',')], dtype=np.float32)
+
+
+def _names(text):
+    return [name.strip() for name in text.split(',') if name.strip()]
+
+
+def _events(context, *events):
+    context.events.extend(json.loads(event[len('data: '):]) for event in events if event)
+
+
+def _start(context, branches, vector, **kwargs):
+    context.dir = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.dir, True)
+    context.db_file = os.path.join(context.dir, 'embeddings.db')
+    context.add_cleanup(get_pool(context.db_file).close)
+    context.merge = BranchMerge("Which way is north?", get_db(context.db_file, 'branches'), branches, **kwargs)
+    context.merge.add_question(_vector(vector))
+    context.steps = [0] * branches
+    context.events = []
+
+
+@given('a branching run of {branches:d} branches on a question near {vector}')
+def step_impl(context, branches, vector):
+    _start(context, branches, vector)
+
+
+@given('a branching run of {branches:d} branches with a cutoff of {cutoff:g} after {min_steps:d} steps on a question near {vector}')
+def step_impl(context, branches, cutoff, min_steps, vector):
+    _start(context, branches, vector, cutoff=cutoff, min_steps=min_steps)
+
+
+@when('these branch steps arrive')
+def step_impl(context):
+    # What the drivers do with every step: add it, then check the branch against the cutoff
+    for row in context.table:
+        branch = int(row['branch']) - 1
+        if branch in context.merge.cancelled:
+            continue
+        context.steps[branch] += 1
+        number = context.steps[branch]
+        step = {'step': number, 'node_id': f"Step{number}", 'title': f"Step {number}", 'content': f"Step {number}"}
+        _events(context, context.merge.add_step(branch, step, _vector(row['vector']), step['title']))
+        _events(context, context.merge.should_cancel(branch))
+
+
+@when('branch {branch:d} answers near {vector}')
+def step_impl(context, branch, vector):
+    context.merge.add_answer(branch - 1, f"Answer of branch {branch}", _vector(vector), f"Answer {branch}")
+
+
+@when('branch {branch:d} fails')
+def step_impl(context, branch):
+    _events(context, context.merge.cancel(branch - 1, "failed: the model went away"))
+
+
+@when('branch {branch:d} restarts')
+def step_impl(context, branch):
+    _events(context, context.merge.restart(branch - 1))
+
+
+@when('the branches are merged')
+def step_impl(context):
+    _events(context, *context.merge.finish())
+
+
+@then('the merged graph has the edges')
+def step_impl(context):
+    edges = sorted(f"{edge['from']} -> {edge['to']}" for edge in context.merge.graph_data['edges'])
+    expected = sorted(f"{row['from']} -> {row['to']}" for row in context.table)
+    assert edges == expected, edges
+
+
+@then('the run sent the events "{types}"')
+def step_impl(context, types):
+    assert [event['type'] for event in context.events] == _names(types), [event['type'] for event in context.events]
+
+
+@then('branch {branch:d} was cancelled under the cutoff')
+def step_impl(context, branch):
+    cancelled = [event for event in context.events if event['type'] == 'branch_cancelled']
+    assert [event['branch'] for event in cancelled] == [branch], cancelled
+    assert cancelled[0]['score'] < context.merge.cutoff, cancelled
+
+
+@then('the answer of branch {branch:d} wins')
+def step_impl(context, branch):
+    final = next(event for event in context.events if event['type'] == 'final')
+    assert final['branch'] == branch, final
+    assert final['content'] == f"Answer of branch {branch}", final
+    assert final['path_data']['strongest_path'][-2:] == [f"B{branch}.Final", 'Final'], final['path_data']
+
+
+@then('the answers of branches "{branches}" were scored')
+def step_impl(context, branches):
+    final = next(event for event in context.events if event['type'] == 'final')
+    assert [answer['branch'] for answer in final['answers']] == [int(branch) for branch in _names(branches)], final
+
+
+@then('the error says that every branch failed')
+def step_impl(context):
+    error = next(event for event in context.events if event['type'] == 'error')
+    assert error['message'] == 'Every reasoning branch failed or was cancelled.', error
+
+
+@then('the graph deltas of the run rebuild the merged graph')
+def step_impl(context):
+    graph = None
+    for event in context.events:
+        if 'graph_delta' in event:
+            graph = apply_delta(graph, event['graph_delta'])
+    assert graph == serialize_graph_data(context.merge.graph_data), graph
+
+
+@then('the trace of the run holds its events and rebuilds the merged graph')
+def step_impl(context):
+    trace_types = [payload['type'] for payload in context.merge.trace]
+    assert trace_types == [event['type'] for event in context.events if event['type'] not in ('done', 'error')], trace_types
+    graph = None
+    for payload in context.merge.trace:
+        if 'graph_delta' in payload:
+            graph = apply_delta(graph, payload['graph_delta'])
+    assert graph == serialize_graph_data(context.merge.graph_data), graph
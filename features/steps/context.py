@@ -0,0 +1,123 @@
+from behave import *
+
+from graph.paths import StrongestPath
+from strategies.context import ContextWindow, estimate_tokens
+
+PREFIX = [
+    {"role": "system", "content": "You explain your reasoning step by step."},
+    {"role": "user", "content": "How many r are there in strawberry?"},
+    {"role": "assistant", "content": "Thank you! I will now think step by step."},
+]
+
+
+def _content(number, length):
+    return (f"Content of step {number}. " + "filler " * length)[:length]
+
+
+@given('a conversation of {count:d} steps of {length:d} characters')
+def step_impl(context, count, length):
+    context.messages = list(PREFIX)
+    context.steps = []  # (message index, node id, number, title, content)
+    for number in range(1, count + 1):
+        content = _content(number, length)
+        context.steps.append((len(context.messages), f"step{number}", number, f"Title {number}", content))
+        context.messages.append({"role": "assistant", "content": content})
+
+
+@given('odd steps build on the previous odd step, even steps branch off')
+def step_impl(context):
+    context.paths = StrongestPath()
+    for _, node_id, number, _, _ in context.steps:
+        if number == 1:
+            context.paths.add_node(node_id)
+        elif number % 2 == 0:
+            context.paths.add_node(node_id, [(f"step{number - 1}", 0.1)])
+        else:
+            context.paths.add_node(node_id, [(f"step{number - 2}", 0.9), (f"step{number - 1}", 0.1)])
+
+
+@given('a context window of {budget:d} tokens keeping {keep_steps:d} steps')
+def step_impl(context, budget, keep_steps):
+    context.window = ContextWindow(budget=budget, keep_steps=keep_steps, prefix=len(PREFIX))
+    for step in context.steps:
+        context.window.add_step(*step)
+
+
+@when('the prompt is built')
+@when('the prompt is built again')
+def step_impl(context):
+    context.previous_summary = context.window.summary
+    context.prompt, context.folded = context.window.build(context.messages, context.paths)
+
+
+@when('the window is reset to the prefix')
+def step_impl(context):
+    context.window.reset(len(PREFIX))
+    context.messages = context.messages[:len(PREFIX)]
+
+
+@then('no steps are folded')
+def step_impl(context):
+    assert context.folded == 0, context.folded
+
+
+@then('{count:d} steps are folded')
+def step_impl(context, count):
+    assert context.folded == count, context.folded
+
+
+@then('the prompt is the whole conversation')
+def step_impl(context):
+    assert context.prompt == context.messages
+
+
+@then('the prompt is the first {count:d} messages')
+def step_impl(context, count):
+    assert context.prompt == PREFIX[:count], context.prompt
+
+
+@then('the prompt is within {budget:d} tokens')
+def step_impl(context, budget):
+    assert estimate_tokens(context.prompt) <= budget, estimate_tokens(context.prompt)
+
+
+@then('the prompt starts with the {count:d} prefix messages')
+def step_impl(context, count):
+    assert context.prompt[:count] == PREFIX[:count]
+
+
+@then('the prompt ends with steps {first:d} to {last:d}')
+def step_impl(context, first, last):
+    tail = [{"role": "assistant", "content": content} for _, _, number, _, content in context.steps
+            if first <= number <= last]
+    assert context.prompt[-len(tail):] == tail
+    # Prefix, summary, then the steps kept verbatim
+    assert len(context.prompt) == len(PREFIX) + 1 + len(tail), len(context.prompt)
+
+
+@then('the summary lists the titles of steps {first:d} to {last:d}')
+def step_impl(context, first, last):
+    summary = context.prompt[len(PREFIX)]['content']
+    for _, _, number, title, _ in context.steps:
+        assert (f"Step {number}: {title}" in summary) == (first <= number <= last), number
+
+
+@then('the summary holds the content of step {number:d}')
+def step_impl(context, number):
+    assert f"Content of step {number}." in context.prompt[len(PREFIX)]['content']
+
+
+@then('the summary only holds the content of steps on the strongest path')
+def step_impl(context):
+    summary = context.prompt[len(PREFIX)]['content']
+    path, _, _ = context.paths.path(f"step{context.folded}")
+    for _, node_id, number, _, _ in context.steps:
+        if f"Content of step {number}." in summary:
+            assert node_id in path, node_id
+
+
+@then('the summary is the same as before')
+def step_impl(context):
+    assert context.previous_summary is not None
+    assert context.window.summary == context.previous_summary
+    assert context.prompt[len(PREFIX)] == context.previous_summary
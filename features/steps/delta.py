@@ -0,0 +1,71 @@
+from behave import *
+
+from graph.delta import GraphDelta
+
+
+def _graph(nodes, edges):
+    # "a b=Label" -> nodes labelled with their id unless given, "a-b" -> an edge from a to b
+    serialized = {'nodes': [], 'edges': []}
+    for node in nodes.split():
+        id, _, label = node.partition('=')
+        serialized['nodes'].append({'id': id, 'label': label or id})
+    for edge in edges.split():
+        source, target = edge.split('-')
+        serialized['edges'].append({'id': edge, 'from': source, 'to': target, 'value': 1.0})
+    return serialized
+
+
+@given('a graph delta sending a snapshot every {snapshot_every:d} updates')
+def step_impl(context, snapshot_every):
+    context.delta = GraphDelta(snapshot_every=snapshot_every)
+    context.updates = []
+
+
+@when('the graph with nodes "{nodes}" and edges "{edges}" is sent')
+def step_impl(context, nodes, edges):
+    context.updates.append(context.delta.update(_graph(nodes, edges)))
+
+
+@when('the graph with nodes "{nodes}" and edges "" is sent')
+def step_impl(context, nodes):
+    context.updates.append(context.delta.update(_graph(nodes, '')))
+
+
+@when('the delta is reset')
+def step_impl(context):
+    context.delta.reset()
+
+
+@then('update {seq:d} is a {kind}')
+def step_impl(context, seq, kind):
+    context.update = context.updates[seq - 1]
+    assert context.update['seq'] == seq, context.update
+    assert context.update['snapshot'] == (kind == 'snapshot'), context.update
+
+
+@then('it holds the nodes "{nodes}" and the edges "{edges}"')
+def step_impl(context, nodes, edges):
+    assert sorted(node['id'] for node in context.update['nodes']) == sorted(nodes.split()), context.update
+    assert sorted(edge['id'] for edge in context.update['edges']) == sorted(edges.split()), context.update
+
+
+@then('it holds the nodes "{nodes}" and the edges ""')
+def step_impl(context, nodes):
+    assert sorted(node['id'] for node in context.update['nodes']) == sorted(nodes.split()), context.update
+    assert context.update['edges'] == [], context.update
+
+
+@then('it holds no nodes and no edges')
+def step_impl(context):
+    assert context.update['nodes'] == [] and context.update['edges'] == [], context.update
+
+
+@then('it removes the nodes "{nodes}" and the edges "{edges}"')
+def step_impl(context, nodes, edges):
+    assert sorted(context.update['removed_nodes']) == sorted(nodes.split()), context.update
+    assert sorted(context.update['removed_edges']) == sorted(edges.split()), context.update
+
+
+@then('it removes no nodes and no edges')
+def step_impl(context):
+    assert context.update['removed_nodes'] == [] and context.update['removed_edges'] == [], context.update
@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+from behave import *
+
+from chat.api import API
+from chat.embedding_cache import EmbeddingCache
+from db.sqlite import get_pool
+
+
+def _vector(text):
+    return np.random.default_rng(zlib.crc32(text.encode())).random(8, dtype=np.float32)
+
+
+def _names(text):
+    return [name.strip() for name in text.split(',')]
+
+
+class CountingAPI(API):
+    """
+    API whose model call is replaced by checksum-derived vectors, remembering what it was sent.
+    """
+
+    def __init__(self, cache):
+        super().__init__(cache=False, embedding_model='fake-embed')
+        self.cache = cache
+        self.batches = []
+
+    def _embed(self, input):
+        self.batches.append(list(input))
+        return np.stack([_vector(text) for text in input])
+
+
+def _open_cache(context):
+    context.cache = EmbeddingCache(context.db_file, max_entries=context.max_entries, max_rows=context.max_rows, evict_every=1)
+
+
+@given('an embedding cache of {max_entries:d} entries in memory and {max_rows:d} rows on disk')
+def step_impl(context, max_entries, max_rows):
+    context.dir = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.dir, True)
+    context.db_file = os.path.join(context.dir, 'embedding_cache.db')
+    context.max_entries, context.max_rows = max_entries, max_rows
+    _open_cache(context)
+    context.add_cleanup(get_pool(context.db_file).close)
+
+
+def _key(text):
+    return EmbeddingCache.key('fake-embed', {}, text)
+
+
+@when('the embedding of "{text}" is stored')
+def step_impl(context, text):
+    context.cache.put(_key(text), _vector(text))
+
+
+@when('the embeddings of "{texts}" are stored')
+def step_impl(context, texts):
+    for text in _names(texts):
+        context.cache.put(_key(text), _vector(text))
+
+
+@when('the cache is opened again')
+def step_impl(context):
+    context.cache.db.flush()
+    _open_cache(context)
+
+
+def _lookup(context, text):
+    context.cache.db.flush()
+    before = context.cache.stats()
+    embedding = context.cache.get(_key(text))
+    after = context.cache.stats()
+    if embedding is not None:
+        assert np.array_equal(embedding, _vector(text)), text
+    return {counter: after[counter] - before[counter] for counter in ('hits', 'disk_hits', 'misses')}
+
+
+@then('"{text}" is found in memory')
+def step_impl(context, text):
+    assert _lookup(context, text) == {'hits': 1, 'disk_hits': 0, 'misses': 0}
+
+
+@then('"{text}" is found on disk')
+def step_impl(context, text):
+    assert _lookup(context, text) == {'hits': 0, 'disk_hits': 1, 'misses': 0}
+
+
+@then('"{text}" is not found')
+def step_impl(context, text):
+    assert _lookup(context, text) == {'hits': 0, 'disk_hits': 0, 'misses': 1}
+
+
+@then('{count:d} embeddings are on disk')
+def step_impl(context, count):
+    assert context.cache.db.count() == count, context.cache.db.count()
+
+
+@then('the keys of "{text}" differ between models and options')
+def step_impl(context, text):
+    keys = {
+        EmbeddingCache.key('fake-embed', {}, text),
+        EmbeddingCache.key('other-embed', {}, text),
+        EmbeddingCache.key('fake-embed', {'num_ctx': 512}, text),
+    }
+    assert len(keys) == 3, keys
+    assert EmbeddingCache.key('fake-embed', None, text) == EmbeddingCache.key('fake-embed', {}, text)
+
+
+@when('the texts "{texts}" are embedded')
+def step_impl(context, texts):
+    if 'api' not in context:
+        context.api = CountingAPI(context.cache)
+        context.embedded = {}
+    texts = _names(texts)
+    context.embedded.update(zip(texts, context.api.embed(texts)))
+
+
+@then('the model embedded "{first}" and then "{second}"')
+def step_impl(context, first, second):
+    assert context.api.batches == [_names(first), _names(second)], context.api.batches
+
+
+@then("the embeddings are the same as the model's")
+def step_impl(context):
+    for text, embedding in context.embedded.items():
+        assert np.array_equal(embedding, _vector(text)), text
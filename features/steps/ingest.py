@@ -0,0 +1,163 @@
+import os
+import shutil
+import tempfile
+import zlib
+from collections import Counter
+
+import numpy as np
+from behave import *
+
+from db.embeddings import get_db
+from db.ingest import chunk_text, ingest, read_chunks
+
+
+class FakeEmbeddingAPI:
+    """
+    Stands in for chat.API: the vector of a text is derived from its checksum, and the
+    call number fail_on raises like a lost connection to the model would.
+    """
+
+    embedding_model = 'fake-embed'
+
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.calls = 0
+        self.embedded = []
+
+    def embed(self, texts):
+        self.calls += 1
+        if self.calls == self.fail_on:
+            raise ConnectionError("the model went away")
+        self.embedded.extend(texts)
+        return np.stack([np.random.default_rng(zlib.crc32(text.encode())).random(8, dtype=np.float32)
+                         for text in texts])
+
+
+def _sentences(count):
+    return " ".join(f"This is sentence number {number} of the text." for number in range(1, count + 1))
+
+
+@when('the text "{text}" is chunked into {size:d} characters')
+def step_impl(context, text, size):
+    context.chunks = chunk_text(text, size)
+
+
+@then('the chunks are "{chunks}"')
+def step_impl(context, chunks):
+    assert context.chunks == chunks.split('|'), context.chunks
+
+
+@then('there are no chunks')
+def step_impl(context):
+    assert context.chunks == [], context.chunks
+
+
+@given('a text of {count:d} numbered sentences')
+def step_impl(context, count):
+    context.long_text = _sentences(count)
+
+
+@when('it is chunked into {size:d} characters with an overlap of {overlap:d}')
+def step_impl(context, size, overlap):
+    context.size, context.overlap = size, overlap
+    context.chunks = chunk_text(context.long_text, size, overlap)
+
+
+@then('there are several chunks of at most {size:d} characters')
+def step_impl(context, size):
+    assert len(context.chunks) > 1, context.chunks
+    assert all(len(chunk) <= size for chunk in context.chunks), [len(chunk) for chunk in context.chunks]
+
+
+@then('every chunk but the last ends a sentence')
+def step_impl(context):
+    assert all(chunk.endswith('.') for chunk in context.chunks[:-1]), context.chunks
+
+
+@then('every chunk after the first starts with the end of the previous one')
+def step_impl(context):
+    for previous, chunk in zip(context.chunks, context.chunks[1:]):
+        first_word = chunk.split()[0]
+        assert first_word in previous[-context.overlap - len(first_word):], (previous, chunk)
+        # The overlap is whole words, no more than asked for plus the word it backs up to
+        shared = next(n for n in range(len(chunk), 0, -1) if previous.endswith(chunk[:n]))
+        assert 0 < shared <= context.overlap + len(first_word), (previous, chunk)
+
+
+@then('every sentence is in a chunk')
+def step_impl(context):
+    for sentence in context.long_text.split(". "):
+        sentence = sentence.rstrip('.')
+        assert any(sentence in chunk for chunk in context.chunks), sentence
+
+
+@given('an input file of {lines:d} short lines and a line of {count:d} numbered sentences')
+def step_impl(context, lines, count):
+    context.dir = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.dir, True)
+    context.db_file = os.path.join(context.dir, 'embeddings.db')
+    context.file = os.path.join(context.dir, 'corpus.txt')
+    with open(context.file, 'w') as f:
+        for line in range(1, lines // 2 + 1):
+            f.write(f"Short line {line}.\n")
+        f.write(_sentences(count) + "\n")
+        for line in range(lines // 2 + 1, lines + 1):
+            f.write(f"Short line {line}.\n")
+    context.api = FakeEmbeddingAPI()
+
+
+@given('an embedding model that fails on call {call:d}')
+def step_impl(context, call):
+    context.api = FakeEmbeddingAPI(fail_on=call)
+
+
+@when('the embedding model works again')
+def step_impl(context):
+    context.failed_api = context.api
+    context.api = FakeEmbeddingAPI()
+
+
+@when('the file is ingested in batches of {batch_size:d} chunks of at most {size:d} characters')
+def step_impl(context, batch_size, size):
+    context.chunk_size = size
+    context.api.embedded = []
+    try:
+        context.totals = ingest([context.file], context.db_file, batch_size=batch_size, workers=1,
+                                chunk_size=size, overlap=30, api=context.api)
+        context.error = None
+    except ConnectionError as e:
+        context.error = e
+
+
+@then('the ingestion fails')
+def step_impl(context):
+    assert context.error is not None
+
+
+def _stored(context):
+    return [text for text, in get_db(context.db_file).fetch_all("SELECT text FROM embeddings")]
+
+
+@then('{count:d} chunks are stored')
+def step_impl(context, count):
+    context.stored_before = _stored(context)
+    assert len(context.stored_before) == count, context.stored_before
+
+
+@then('every chunk of the file is stored once')
+def step_impl(context):
+    expected = Counter(chunk.text for chunk in read_chunks(context.file, chunk_size=context.chunk_size, overlap=30))
+    assert Counter(_stored(context)) == expected, Counter(_stored(context)) - expected
+    assert all(count == 1 for count in expected.values())
+
+
+@then('the model only embedded the chunks that were missing')
+def step_impl(context):
+    stored_before = set(context.stored_before)
+    assert not stored_before & set(context.api.embedded), stored_before & set(context.api.embedded)
+    assert len(context.api.embedded) == len(_stored(context)) - len(stored_before), context.api.embedded
+
+
+@then('the model embedded no chunks the second time')
+def step_impl(context):
+    assert context.api.embedded == [], context.api.embedded
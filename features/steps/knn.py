@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from behave import *
+
+from db.embeddings import get_db
+from db.knn import get_knn_graph
+from db.sqlite import get_pool
+from server import NeighborsRequest, RequestError, neighbors_payload
+
+
+def _vector(text):
+    return np.array([float(value) for value in text.split(',')], dtype=np.float32)
+
+
+def _hops(text):
+    return {name.strip(): int(hop) for name, hop in (item.split(':') for item in text.split(','))}
+
+
+@given('a kNN graph of {k:d} edges per row over the rows')
+def step_impl(context, k):
+    context.dir = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.dir, True)
+    context.db_file = os.path.join(context.dir, 'embeddings.db')
+    context.db = get_db(context.db_file)
+    context.add_cleanup(get_pool(context.db_file).close)
+    get_knn_graph(context.db_file).k = k
+    context.ids = {row['text']: context.db.insert_embedding(row['text'], _vector(row['vector']), 0)
+                   for row in context.table}
+    context.names = {id: text for text, id in context.ids.items()}
+
+
+@then('the graph has {nodes:d} nodes and {edges:d} edges')
+def step_impl(context, nodes, edges):
+    assert context.db.graph.stats() == {'nodes': nodes, 'edges': edges}, context.db.graph.stats()
+
+
+@then('the row "{text}" links to "{texts}"')
+def step_impl(context, text, texts):
+    linked = context.db.graph.fetch_all("SELECT dst FROM edges WHERE src = ?", (context.ids[text],))
+    assert sorted(context.names[dst] for dst, in linked) == texts.split('|'), linked
+
+
+def _expand(context, text, hops, **kwargs):
+    context.hop_of, context.edges = context.db.graph.neighborhood([context.ids[text]], hops=hops, **kwargs)
+
+
+@when('the neighborhood of "{text}" is expanded by {hops:d} hops')
+def step_impl(context, text, hops):
+    _expand(context, text, hops)
+
+
+@when('the neighborhood of "{text}" is expanded by {hops:d} hops along edges of at least {min_weight:g}')
+def step_impl(context, text, hops, min_weight):
+    _expand(context, text, hops, min_weight=min_weight)
+
+
+@when('the neighborhood of "{text}" is expanded by {hops:d} hops along {per_node:d} edge per row')
+def step_impl(context, text, hops, per_node):
+    _expand(context, text, hops, per_node=per_node)
+
+
+@when('the neighborhood of "{text}" is expanded by {hops:d} hops up to {max_nodes:d} rows')
+def step_impl(context, text, hops, max_nodes):
+    _expand(context, text, hops, max_nodes=max_nodes)
+
+
+@then('it reaches "{reached}"')
+def step_impl(context, reached):
+    hop_of = {context.names[id]: hop for id, hop in context.hop_of.items()}
+    assert hop_of == _hops(reached), hop_of
+
+
+@then('its edges are "{edges}"')
+def step_impl(context, edges):
+    found = sorted(f"{context.names[a]}-{context.names[b]}" for a, b, _ in context.edges)
+    assert found == [edge.strip() for edge in edges.split(',')], found
+
+
+@when('the graph is dropped')
+def step_impl(context):
+    context.db.graph.reset()
+
+
+@when('the missing rows are linked')
+def step_impl(context):
+    assert context.db.graph.link_missing(context.db) == len(context.ids)
+
+
+def _neighbors_request(ids, hops):
+    return NeighborsRequest(ids=ids, text=None, hops=hops, min_weight=0.0, per_node=None, max_nodes=200, seeds=3)
+
+
+@when('the neighbors of "{text}" are asked for with {hops:d} hop')
+def step_impl(context, text, hops):
+    context.payload = neighbors_payload(context.db, _neighbors_request([context.ids[text]], hops))
+
+
+@then('the neighbors are "{reached}"')
+def step_impl(context, reached):
+    nodes = {node['text']: node['hop'] for node in context.payload['nodes']}
+    assert nodes == _hops(reached), context.payload
+    texts = {context.names[node['id']] for node in context.payload['nodes']}
+    assert texts == set(nodes), context.payload
+    for edge in context.payload['edges']:
+        assert edge['from'] < edge['to'] and edge['value'] >= 0, edge
+
+
+@then('the neighbors of row {id:d} are not found')
+def step_impl(context, id):
+    try:
+        neighbors_payload(context.db, _neighbors_request([id], 1))
+    except RequestError as e:
+        assert e.status == 404, e.status
+        return
+    raise AssertionError(f"row {id} has neighbors")
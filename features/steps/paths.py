@@ -0,0 +1,56 @@
+from behave import *
+
+from graph.paths import StrongestPath
+
+
+def _names(text):
+    return [name.strip() for name in text.split(',') if name.strip()]
+
+
+@given('the steps')
+def step_impl(context):
+    context.paths = StrongestPath()
+    for row in context.table:
+        edges = []
+        for edge in _names(row['edges']):
+            parent, weight = edge.split(':')
+            edges.append((parent, float(weight)))
+        context.paths.add_node(row['step'], edges)
+
+
+@when('the paths are reset')
+def step_impl(context):
+    context.paths.reset()
+
+
+@then('the strongest path to {step} is "{path}"')
+def step_impl(context, step, path):
+    context.path, context.weights, context.avg_similarity = context.paths.path(step)
+    assert context.path == _names(path), context.path
+
+
+@then('its weights are "{weights}"')
+def step_impl(context, weights):
+    expected = [float(weight) for weight in _names(weights)]
+    assert len(context.weights) == len(expected), context.weights
+    assert all(abs(a - b) < 1e-9 for a, b in zip(context.weights, expected)), context.weights
+
+
+@then('its average similarity is {avg_similarity:g}')
+def step_impl(context, avg_similarity):
+    assert abs(context.avg_similarity - avg_similarity) < 1e-4, context.avg_similarity
+
+
+@then('there is no path to {step}')
+def step_impl(context, step):
+    assert context.paths.path(step) == (None, None, None)
+
+
+@then('the path data of {step} is None')
+def step_impl(context, step):
+    assert context.paths.path_data(step) is None
+
+
+@then('its path has no edges')
+def step_impl(context):
+    assert context.weights == [], context.weights
@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import time
+
+from behave import *
+
+from chat.scheduler import LLMScheduler
+
+
+def _wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def _start(context, target):
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    context.threads.append(thread)
+
+
+@given('a scheduler running {count:d} {calls} at a time')
+def step_impl(context, count, calls):
+    context.scheduler = LLMScheduler(max_concurrent=count)
+    context.threads = []
+    context.served = []
+
+
+@given('a reasoning call of session "{session}" holding its slot')
+def step_impl(context, session):
+    context.end_held = threading.Event()
+
+    def hold():
+        with context.scheduler.slot('reasoning', session):
+            context.end_held.wait()
+
+    _start(context, hold)
+    _wait_until(lambda: context.scheduler.stats()['running'] == 1)
+    context.add_cleanup(context.end_held.set)
+
+
+@when('these calls wait')
+def step_impl(context):
+    for number, row in enumerate(context.table, start=1):
+        def call(number=number, kind=row['kind'], session=row['session']):
+            with context.scheduler.slot(kind, session):
+                context.served.append(number)
+
+        waiting = context.scheduler.stats()['kinds'][row['kind']]['waiting']
+        _start(context, call)
+        # One at a time, so they're queued in the order of the table
+        _wait_until(lambda kind=row['kind']: context.scheduler.stats()['kinds'][kind]['waiting'] == waiting + 1)
+
+
+@when('the held call ends')
+def step_impl(context):
+    context.end_held.set()
+    for thread in context.threads:
+        thread.join(5)
+
+
+@then('the calls are served in the order "{order}"')
+def step_impl(context, order):
+    assert context.served == [int(number) for number in order.split(',')], context.served
+
+
+@when('{count:d} embed calls of {sessions:d} sessions run on as many threads')
+def step_impl(context, count, sessions):
+    lock = threading.Lock()
+    context.running = context.most_running = 0
+
+    def call(session):
+        with context.scheduler.slot('embed', session):
+            with lock:
+                context.running += 1
+                context.most_running = max(context.most_running, context.running)
+            time.sleep(0.01)
+            with lock:
+                context.running -= 1
+
+    for number in range(count):
+        _start(context, lambda session=f"session {number % sessions}": call(session))
+    for thread in context.threads:
+        thread.join(5)
+
+
+@then('at most {count:d} calls ran at once')
+def step_impl(context, count):
+    assert 0 < context.most_running <= count, context.most_running
+
+
+@then('the scheduler counts {count:d} {kind} calls and none waiting or running')
+def step_impl(context, count, kind):
+    stats = context.scheduler.stats()
+    assert stats['kinds'][kind]['calls'] == count, stats
+    assert stats['kinds'][kind]['waiting'] == stats['kinds'][kind]['running'] == stats['running'] == 0, stats
+
+
+@when('an asyncio reasoning call of session "{session}" is cancelled while it waits')
+def step_impl(context, session):
+    async def call():
+        async with context.scheduler.aslot('reasoning', session):
+            context.served.append(session)
+
+    async def cancel():
+        task = asyncio.ensure_future(call())
+        while context.scheduler.stats()['kinds']['reasoning']['waiting'] == 0:
+            await asyncio.sleep(0.001)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(cancel())
+
+
+@when('a {kind} call of session "{session}" runs')
+def step_impl(context, kind, session):
+    def call():
+        with context.scheduler.slot(kind, session):
+            context.served.append(session)
+
+    _start(context, call)
+    context.threads[-1].join(5)
+    assert context.served == [session], "the call got no slot"
+
+
+@then('the scheduler counts {count:d} {kind} calls waiting')
+def step_impl(context, count, kind):
+    assert context.scheduler.stats()['kinds'][kind]['waiting'] == count, context.scheduler.stats()
+
+
+@then('a "{kind}" call is refused')
+def step_impl(context, kind):
+    try:
+        with context.scheduler.slot(kind):
+            pass
+    except ValueError:
+        return
+    raise AssertionError(f"a {kind} call was let through")
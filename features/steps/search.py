@@ -0,0 +1,140 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from behave import *
+
+from db.embeddings import get_db
+from db.search import hybrid_search, lexical_search, search_many
+from db.sqlite import get_pool
+from helpers import parse_similar_request
+
+
+def _vector(text):
+    return np.array([float(value) for value in text.split(',')], dtype=np.float32)
+
+
+def _texts(text):
+    return text.split('|') if text else []
+
+
+@given('a database with the rows')
+def step_impl(context):
+    context.dir = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.dir, True)
+    context.db_file = os.path.join(context.dir, 'embeddings.db')
+    context.sessions = {}
+    context.ids = {}
+    for row in context.table:
+        session_id = context.sessions.setdefault(row['session'], f"session-{row['session']}")
+        db = get_db(context.db_file, session_id)
+        context.ids[row['text']] = db.insert_embedding(row['text'], _vector(row['vector']), row['question'] == 'yes')
+    context.db = get_db(context.db_file)
+    context.add_cleanup(get_pool(context.db_file).close)
+
+
+def _search_keywords(context, text, session=None):
+    session_id = context.sessions[session] if session else None
+    found = lexical_search(context.db, text, top_k=10, session_id=session_id)
+    texts = context.db.get_texts([id for id, _ in found])
+    context.found = [(texts[id][0], None) for id, _ in found]
+
+
+@when('"{text}" is searched by keywords')
+def step_impl(context, text):
+    _search_keywords(context, text)
+
+
+@when('the raw text {text} is searched by keywords')
+def step_impl(context, text):
+    _search_keywords(context, text)
+
+
+@when('"{text}" is searched by keywords in the {session} session')
+def step_impl(context, text, session):
+    _search_keywords(context, text, session)
+
+
+@when('the row "{text}" is deleted')
+def step_impl(context, text):
+    assert context.db.delete_embedding(context.ids[text])
+
+
+@when('"{text}" is searched in {mode} mode near {vector} for {top_k:d} results')
+def step_impl(context, text, mode, vector, top_k):
+    found = hybrid_search(context.db, text, _vector(vector), top_k=top_k, mode=mode)
+    context.found = [(found_text, similarity) for _, found_text, similarity, _ in found]
+
+
+@then('the found texts are "{texts}"')
+def step_impl(context, texts):
+    assert [text for text, _ in context.found] == _texts(texts), context.found
+
+
+@then('the found texts are, in any order, "{texts}"')
+def step_impl(context, texts):
+    assert sorted(text for text, _ in context.found) == sorted(_texts(texts)), context.found
+
+
+@then('the similarity of "{text}" is {similarity:g}')
+def step_impl(context, text, similarity):
+    found = dict(context.found)
+    assert abs(found[text] - similarity) < 1e-6, found
+
+
+def _batch(vectors):
+    return np.stack([_vector(vector) for vector in vectors.split('|')])
+
+
+@when('the vectors "{vectors}" are searched in one batch for {top_k:d} result each')
+def step_impl(context, vectors, top_k):
+    context.batch = search_many(context.db, _batch(vectors), top_k=top_k)
+
+
+@then('the results of the batch are "{texts}"')
+def step_impl(context, texts):
+    found = [" / ".join(text for _, text, _, _ in results) for results in context.batch]
+    assert found == [text.strip() for text in texts.split('|')], found
+
+
+def _search_many(context, vector, top_k, **options):
+    found, = search_many(context.db, vector, top_k=top_k, **options)
+    context.found = [(text, similarity) for _, text, similarity, _ in found]
+
+
+@when('the vector {vector} is searched for {top_k:d} results')
+def step_impl(context, vector, top_k):
+    _search_many(context, _vector(vector), top_k)
+
+
+@when('the vector {vector} is searched for {top_k:d} results with {option} {value}')
+def step_impl(context, vector, top_k, option, value):
+    if option == 'session':
+        options = {'session_id': context.sessions[value]}
+    elif option == 'is_question':
+        options = {'is_question': value == 'yes'}
+    else:
+        options = {option: float(value)}
+    _search_many(context, _vector(vector), top_k, **options)
+
+
+@when('the row "{text}" is searched with its own vector for {top_k:d} result')
+def step_impl(context, text, top_k):
+    id = context.ids[text]
+    _search_many(context, context.db.segment.get_many([id], full_precision=True), top_k, exclude_ids=[id])
+
+
+@when('the /similar body {body} is parsed with at most {max_batch:d} queries')
+def step_impl(context, body, max_batch):
+    try:
+        context.parsed = parse_similar_request(json.loads(body), max_batch)
+        context.error = None
+    except ValueError as e:
+        context.error = e
+
+
+@then('it is rejected with "{message}"')
+def step_impl(context, message):
+    assert str(context.error) == message, context.error
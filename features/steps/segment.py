@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from behave import *
+
+from db.segment import VectorSegment
+
+
+def _open_segment(context, dtype, full_precision=False):
+    context.segment = VectorSegment(os.path.join(context.dir, 'test.vectors'), dtype=dtype, full_precision=full_precision)
+    context.add_cleanup(context.segment.close)
+
+
+@given('a {dtype} vector segment')
+def step_impl(context, dtype):
+    context.dir = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.dir, True)
+    _open_segment(context, dtype)
+
+
+@given('a {dtype} vector segment keeping full precision')
+def step_impl(context, dtype):
+    context.dir = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.dir, True)
+    _open_segment(context, dtype, full_precision=True)
+
+
+@when('{count:d} random vectors of {dim:d} dimensions are stored')
+def step_impl(context, count, dim):
+    context.rng = np.random.default_rng(0)
+    context.vectors = {id: context.rng.standard_normal(dim, dtype=np.float32) for id in range(1, count + 1)}
+    context.segment.append_many(list(context.vectors), list(context.vectors.values()))
+
+
+@when('vector {id:d} is stored again')
+def step_impl(context, id):
+    context.vectors[id] = context.rng.standard_normal(context.segment.dim, dtype=np.float32)
+    context.segment.append(id, context.vectors[id])
+
+
+@when('vector {id:d} is removed')
+def step_impl(context, id):
+    del context.vectors[id]
+    context.segment.remove(id)
+
+
+@when('the segment is reopened as {dtype}')
+def step_impl(context, dtype):
+    context.segment.close()
+    _open_segment(context, dtype)
+
+
+@when('the segment is compacted')
+def step_impl(context):
+    context.segment.compact()
+
+
+@then('every vector reads back within {tolerance:g} of the original')
+def step_impl(context, tolerance):
+    ids = list(context.vectors)
+    decoded = context.segment.get_many(ids)
+    for id, vector in zip(ids, decoded):
+        # Relative to the largest component, int8 rows are scaled by it
+        error = np.abs(vector - context.vectors[id]).max() / np.abs(context.vectors[id]).max()
+        assert error <= tolerance, (id, error)
+
+
+@then('every vector reads back exactly in full precision')
+def step_impl(context):
+    ids = list(context.vectors)
+    decoded = context.segment.get_many(ids, full_precision=True)
+    assert all(np.array_equal(vector, context.vectors[id]) for id, vector in zip(ids, decoded))
+
+
+@then('the nearest stored vector of each vector is itself')
+def step_impl(context):
+    for id, vector in context.vectors.items():
+        (nearest, similarity), = context.segment.scan(vector, top_k=1)
+        assert nearest == id and similarity > 0.99, (id, nearest, similarity)
+
+
+@then('the segment stores {dtype} rows of {dim:d} dimensions with full precision')
+def step_impl(context, dtype, dim):
+    assert context.segment.dtype == np.dtype(dtype), context.segment.dtype
+    assert context.segment.dim == dim, context.segment.dim
+    assert context.segment.full_precision
+
+
+@then('the segment holds {count:d} vectors and {dead:d} dead rows')
+def step_impl(context, count, dead):
+    assert len(context.segment) == count, len(context.segment)
+    assert context.segment.dead_rows == dead, context.segment.dead_rows
@@ -0,0 +1,117 @@
+import json
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+from behave import *
+
+from db.embeddings import get_db
+from db.sqlite import get_pool
+from graph.delta import apply_delta
+from graph.helpers import serialize_graph_data
+from strategies.single_shot import SINGLE_SHOT_SCHEMA, SingleShotSession
+
+
+def _vector(text):
+    return np.random.default_rng(zlib.crc32(text.encode())).random(8, dtype=np.float32)
+
+
+def _names(text):
+    return [name.strip() for name in text.split(',') if name.strip()]
+
+
+def _reply(context, reply):
+    context.session_steps = context.session.accept_reply(reply, 6.0)
+
+
+@given('a single-shot run on "{question}"')
+def step_impl(context, question):
+    context.dir = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.dir, True)
+    context.db_file = os.path.join(context.dir, 'embeddings.db')
+    context.add_cleanup(get_pool(context.db_file).close)
+    context.session = SingleShotSession(question, get_db(context.db_file, 'single-shot'))
+    context.events = []
+
+
+@when('the model replies')
+def step_impl(context):
+    _reply(context, context.text)
+
+
+@when('the model replies with {count:d} steps of {length:d} characters under titles of {title_length:d} characters')
+def step_impl(context, count, length, title_length):
+    _reply(context, json.dumps({
+        'steps': [{'title': f"{number}" * title_length, 'content': f"{number}" * length} for number in range(count)],
+        'final_answer': "North",
+    }))
+
+
+@then('the run has the steps "{titles}" numbered from 1')
+def step_impl(context, titles):
+    steps = context.session_steps
+    assert [step['title'] for step in steps] == _names(titles), steps
+    assert [step['step'] for step in steps] == list(range(1, len(steps) + 1)), steps
+    assert [step['node_id'] for step in steps] == [f"Step{step['step']}" for step in steps], steps
+
+
+@then('the run has {count:d} steps of {length:d} characters under titles of {title_length:d} characters')
+def step_impl(context, count, length, title_length):
+    steps = context.session_steps
+    assert len(steps) == count, len(steps)
+    assert all(len(step['content']) == length and len(step['title']) == title_length for step in steps), steps
+
+
+@then('the run has no steps')
+def step_impl(context):
+    assert context.session_steps == [], context.session_steps
+
+
+@then('the final answer is "{answer}"')
+def step_impl(context, answer):
+    assert context.session.final_answer == answer, context.session.final_answer
+
+
+@then("the reply's {seconds:g} seconds are shared out between its steps")
+def step_impl(context, seconds):
+    assert abs(context.session.total_thinking_time - seconds) < 1e-9, context.session.total_thinking_time
+    times = [thinking_time for _, _, thinking_time in context.session.steps]
+    assert len(set(times)) == 1, times
+
+
+@then('the model is asked for the steps again')
+def step_impl(context):
+    assert context.session_steps is None, context.session_steps
+    message = context.session.messages[-1]
+    assert message['role'] == 'user' and "'steps' array" in message['content'], message
+
+
+@when('the steps and the answer are embedded and sent')
+def step_impl(context):
+    session = context.session
+    for step in context.session_steps:
+        context.events.append(session.emit_step(step, _vector(step['content']), step['title']))
+    context.events.extend(session.finish(_vector(session.final_answer), "North"))
+    context.events = [json.loads(event[len('data: '):]) for event in context.events]
+
+
+@then('the run sent the single-shot events "{types}"')
+def step_impl(context, types):
+    assert [event['type'] for event in context.events] == _names(types), context.events
+
+
+@then('the trace of the single-shot run rebuilds its graph')
+def step_impl(context):
+    graph = None
+    for payload in context.session.trace:
+        graph = apply_delta(graph, payload['graph_delta'])
+    assert graph == serialize_graph_data(context.session.graph_data), graph
+    assert [payload['type'] for payload in context.session.trace] == ['step', 'step', 'step', 'final']
+
+
+@then('the single-shot run asks for replies matching the single-shot schema')
+def step_impl(context):
+    assert context.session.format == SINGLE_SHOT_SCHEMA, context.session.format
+    assert SingleShotSession("Which way is north?", context.session.conn, format='json').format == 'json'
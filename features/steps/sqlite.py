@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from behave import *
+
+from db.sqlite import SQLiteDB, get_pool
+
+
+class NotesDB(SQLiteDB):
+    def _create_table(self):
+        self.execute("CREATE TABLE IF NOT EXISTS notes (id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL)")
+
+    def insert(self, text):
+        return self.execute("INSERT INTO notes (text) VALUES (?)", (text,))
+
+    def fail(self):
+        raise RuntimeError("the write failed")
+
+    def texts(self):
+        return dict(self.fetch_all("SELECT id, text FROM notes"))
+
+
+@given('a notes database')
+def step_impl(context):
+    context.dir = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.dir, True)
+    context.db_file = os.path.join(context.dir, 'notes.db')
+    context.db = NotesDB(context.db_file)
+    # Stops the write-behind thread, before the directory is removed
+    context.add_cleanup(get_pool(context.db_file).close)
+
+
+@then('the journal mode is "{mode}"')
+def step_impl(context, mode):
+    assert context.db.fetch_one("PRAGMA journal_mode") == (mode,), context.db.fetch_one("PRAGMA journal_mode")
+
+
+@when('{threads:d} threads insert {count:d} notes each')
+def step_impl(context, threads, count):
+    context.inserted = {}
+    lock = threading.Lock()
+
+    def insert(thread):
+        # A NotesDB per thread, like a session per request
+        db = NotesDB(context.db_file)
+        for number in range(count):
+            text = f"note {number} of thread {thread}"
+            result = db.insert(text)
+            with lock:
+                context.inserted[text] = result.lastrowid
+
+    workers = [threading.Thread(target=insert, args=(thread,)) for thread in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+@then('{count:d} notes are stored')
+def step_impl(context, count):
+    assert len(context.db.texts()) == count, len(context.db.texts())
+
+
+@then('every insert returned the id of its own note')
+def step_impl(context):
+    texts = context.db.texts()
+    wrong = {text: id for text, id in context.inserted.items() if texts.get(id) != text}
+    assert not wrong, wrong
+
+
+@when('a transaction inserts {count:d} notes and fails')
+def step_impl(context, count):
+    try:
+        with context.db.transaction():
+            for number in range(count):
+                context.db.insert(f"note {number}")
+            context.db.fail()
+    except RuntimeError:
+        pass
+
+
+@when('a transaction inserts a note, nests a transaction inserting another and {outcome}')
+def step_impl(context, outcome):
+    other = NotesDB(context.db_file)
+    try:
+        with context.db.transaction():
+            context.db.insert("outer note")
+            with other.transaction():
+                other.insert("inner note")
+            if outcome == 'fails':
+                context.db.fail()
+    except RuntimeError:
+        pass
+
+
+@when('{count:d} notes are deferred')
+def step_impl(context, count):
+    context.deferred = {f"deferred note {number}": context.db.defer(context.db.insert, f"deferred note {number}")
+                        for number in range(count)}
+
+
+@when('a deferred write fails')
+def step_impl(context):
+    context.failed_write = context.db.defer(context.db.fail)
+
+
+@when('the deferred writes are flushed')
+def step_impl(context):
+    context.db.flush()
+
+
+@then('every deferred write resolved to the id of its own note')
+def step_impl(context):
+    texts = context.db.texts()
+    assert all(future.done() for future in context.deferred.values())
+    wrong = {text: future.result().lastrowid for text, future in context.deferred.items()
+             if texts.get(future.result().lastrowid) != text}
+    assert not wrong, wrong
+
+
+@then("the failed write's future holds its error")
+def step_impl(context):
+    assert isinstance(context.failed_write.exception(timeout=0), RuntimeError), context.failed_write.exception(timeout=0)
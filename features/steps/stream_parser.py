@@ -0,0 +1,55 @@
+import json
+
+from behave import *
+
+from helpers import StepStreamParser, parse_json_object
+
+
+@given('a step stream parser')
+def step_impl(context):
+    context.parser = StepStreamParser()
+
+
+@when("the text '{chunk}' streams in")
+def step_impl(context, chunk):
+    context.parser.feed(chunk)
+
+
+@when('this reply streams in chunks of {size:d} characters')
+def step_impl(context, size):
+    context.reply = context.text
+    for start in range(0, len(context.reply), size):
+        context.parser.feed(context.reply[start:start + size])
+
+
+@then('the streamed "{key}" is "{value}"')
+def step_impl(context, key, value):
+    assert context.parser.fields.get(key) == value, context.parser.fields
+
+
+@then('the streamed step is complete')
+def step_impl(context):
+    assert context.parser.complete
+
+
+@then('the streamed step is not complete')
+def step_impl(context):
+    assert not context.parser.complete
+
+
+@then('the streamed fields are the string fields of the reply')
+def step_impl(context):
+    reply = context.reply
+    step = json.loads(reply[reply.index('{'):reply.rindex('}') + 1])
+    expected = {key: value for key, value in step.items() if isinstance(value, str)}
+    assert context.parser.fields == expected, context.parser.fields
+
+
+@when("the reply '{reply}' is parsed")
+def step_impl(context, reply):
+    context.parsed = parse_json_object(reply)
+
+
+@then('the parsed step has the title "{title}" and the content "{content}"')
+def step_impl(context, title, content):
+    assert context.parsed == {'title': title, 'content': content}, context.parsed
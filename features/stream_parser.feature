@@ -0,0 +1,47 @@
+Feature: Streamed step parser
+  helpers.StepStreamParser reads a step's JSON object as its tokens arrive, so the string
+  fields of the step can be shown before the reply is complete.
+
+  Scenario: The content shows while it's generated
+    Given a step stream parser
+    When the text '```json {"title": "Shadows", "content": "At noon' streams in
+    Then the streamed "title" is "Shadows"
+    And the streamed "content" is "At noon"
+    And the streamed step is not complete
+    When the text ' shadows point north.", "next_action": "contin' streams in
+    Then the streamed "content" is "At noon shadows point north."
+    And the streamed "next_action" is "contin"
+    When the text 'ue"}' streams in
+    Then the streamed "next_action" is "continue"
+    And the streamed step is complete
+
+  Scenario Outline: The fields are the same however the reply is chunked
+    Given a step stream parser
+    When this reply streams in chunks of <size> characters
+      """
+      Here is the step:
+      ```json
+      {"title": "Shadows \"at noon\"", "content": "Line one\nLine two\tand caf\u00e9 \\o/",
+       "details": {"title": "not a field"}, "sources": ["sun", "compass"], "confidence": 0.9,
+       "next_action": "continue"}
+      ```
+      """
+    Then the streamed fields are the string fields of the reply
+    And the streamed step is complete
+
+    Examples:
+      | size |
+      | 1    |
+      | 2    |
+      | 5    |
+      | 1000 |
+
+  Scenario: Text after the step is ignored
+    Given a step stream parser
+    When the text '{"title": "Shadows", "content": "At noon"} {"title": "Compass"}' streams in
+    Then the streamed "title" is "Shadows"
+    And the streamed step is complete
+
+  Scenario: A reply cut off inside its step still gives the fields received
+    When the reply '{"title": "Shadows", "content": "At noon shad' is parsed
+    Then the parsed step has the title "Shadows" and the content "At noon shad"
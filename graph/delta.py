@@ -0,0 +1,82 @@
+from typing import Dict, Optional
+
+
+class GraphDelta:
+    """
+    Turns successive serialized graphs into delta updates for the SSE stream.
+
+    Each update carries a sequence number and only the nodes and edges that were added,
+    changed or removed since the previous update. Every `snapshot_every` updates (and
+    after a reset) a full snapshot is sent instead, so a client that missed an update
+    can resynchronize.
+    """
+
+    def __init__(self, snapshot_every: Optional[int] = 10):
+        """
+        :param snapshot_every: Number of updates between two full snapshots, None to only
+            send one on the first update and after a reset.
+        """
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        self._nodes: Dict[str, dict] = {}
+        self._edges: Dict[str, dict] = {}
+        self._force_snapshot = True
+
+    def update(self, serialized_graph_data) -> dict:
+        """
+        :param serialized_graph_data: The current graph, as returned by serialize_graph_data.
+        :return: The 'graph_delta' payload bringing the client from the previous update to this graph.
+        """
+        nodes = {node['id']: dict(node) for node in serialized_graph_data['nodes']}
+        edges = {edge['id']: dict(edge) for edge in serialized_graph_data['edges']}
+        self.seq += 1
+
+        if self._force_snapshot or (self.snapshot_every and (self.seq - 1) % self.snapshot_every == 0):
+            delta = {
+                'seq': self.seq,
+                'snapshot': True,
+                'nodes': list(nodes.values()),
+                'edges': list(edges.values()),
+            }
+        else:
+            delta = {
+                'seq': self.seq,
+                'snapshot': False,
+                'nodes': [node for id, node in nodes.items() if self._nodes.get(id) != node],
+                'edges': [edge for id, edge in edges.items() if self._edges.get(id) != edge],
+                'removed_nodes': [id for id in self._nodes if id not in nodes],
+                'removed_edges': [id for id in self._edges if id not in edges],
+            }
+
+        self._nodes, self._edges = nodes, edges
+        self._force_snapshot = False
+        return delta
+
+    def reset(self):
+        """
+        Makes the next update a full snapshot, e.g. after the graph was cleared.
+        """
+        self._nodes, self._edges = {}, {}
+        self._force_snapshot = True
+
+
+def apply_delta(serialized_graph_data: Optional[dict], delta: dict) -> dict:
+    """
+    The other end of GraphDelta.update: brings a graph up to date with a 'graph_delta' payload.
+
+    :param serialized_graph_data: The graph of the previous update, None before the first snapshot.
+    :param delta: The next payload of GraphDelta.update.
+    :return: The new graph, serialized_graph_data is left as it was.
+    """
+    if delta['snapshot'] or serialized_graph_data is None:
+        nodes, edges = {}, {}
+    else:
+        nodes = {node['id']: node for node in serialized_graph_data['nodes']}
+        edges = {edge['id']: edge for edge in serialized_graph_data['edges']}
+    for id in delta.get('removed_nodes', []):
+        nodes.pop(id, None)
+    for id in delta.get('removed_edges', []):
+        edges.pop(id, None)
+    nodes.update((node['id'], node) for node in delta['nodes'])
+    edges.update((edge['id'], edge) for edge in delta['edges'])
+    return {'nodes': list(nodes.values()), 'edges': list(edges.values())}
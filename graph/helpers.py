@@ -1,59 +1,39 @@
-import networkx as nx
-import heapq
+from graph.paths import StrongestPath
 
-def dijkstra(graph: nx.Graph, start, end):
-    queue = [(0, start, [])]
-    visited = set()
-    
-    while queue:
-        (cost, node, path) = heapq.heappop(queue)
-        if node not in visited:
-            visited.add(node)
-            path = path + [node]
-            
-            if node == end:
-                path_length = len(path) - 1
-                if path_length == 0:  # Handle the case when there's only one node
-                    return 1.0, path  # Return perfect similarity for single node
-                return -cost / path_length, path  # Return average similarity
-            
-            for neighbor in graph.neighbors(node):
-                if neighbor not in visited:
-                    edge_weight = graph[node][neighbor]['weight']
-                    new_cost = cost - edge_weight  # Accumulate total similarity
-                    heapq.heappush(queue, (new_cost, neighbor, path))
-    
-    return None, None
 
 def calculate_strongest_path(graph_data, current_step):
-    G = nx.Graph()
-    for node in graph_data['nodes']:
-        G.add_node(node['id'])
+    """
+    One-off strongest path from Step1 to Step{current_step} over a serialized step graph.
+    Edges are oriented from the earlier to the later node (in node list order); the
+    reasoning loop keeps a graph.paths.StrongestPath up to date instead of calling this.
+    """
+    order = {node['id']: i for i, node in enumerate(graph_data['nodes'])}
+    parents = {node_id: [] for node_id in order}
     for edge in graph_data['edges']:
-        G.add_edge(edge['from'], edge['to'], weight=edge['value'])
-    
+        a, b = edge['from'], edge['to']
+        if a not in order or b not in order or a == b:
+            continue
+        earlier, later = (a, b) if order[a] < order[b] else (b, a)
+        parents[later].append((earlier, edge['value']))
+
     start_node = 'Step1'
     end_node = f'Step{current_step}'
-    
-
-    try:
-        avg_similarity, path = dijkstra(G, start_node, end_node)
-        if path:
-            if len(path) == 1:  # Handle the case when there's only one node
-                return path, [], 1.0
-            path_edges = list(zip(path[:-1], path[1:]))
-            path_weights = [G[u][v]['weight'] for u, v in path_edges]
-            return path, path_weights, avg_similarity
-        else:
-            return None, None, None
-    except nx.NetworkXNoPath:
+    if start_node not in order or end_node not in order:
         return None, None, None
 
+    paths = StrongestPath()
+    for node_id in sorted(order, key=order.get):
+        if order[node_id] < order[start_node]:
+            continue
+        paths.add_node(node_id, parents[node_id])
+    return paths.path(end_node)
+
 def serialize_graph_data(graph_data):
     serialized = {
         'nodes': graph_data['nodes'],
         'edges': [
             {
+                'id': f"{edge['from']}-{edge['to']}",  # Stable id so clients can update edges in place
                 'from': edge['from'],
                 'to': edge['to'],
                 'value': float(edge['value']),  # Convert float32 to regular float
@@ -0,0 +1,78 @@
+from typing import Dict, Iterable, Optional, Tuple
+
+
+class StrongestPath:
+    """
+    Incremental strongest path from the first step of a session to every later step.
+
+    Step edges always go from an earlier step to a later one, so the step graph is a DAG
+    and the strongest (highest total similarity) path to a new step extends the strongest
+    path to one of its parents. Adding a step with k parent edges therefore costs O(k),
+    and each node only keeps its best total, length and predecessor.
+    """
+
+    def __init__(self):
+        self.root: Optional[str] = None
+        # node -> (total similarity, number of edges, parent, weight of the edge from parent)
+        self._best: Dict[str, Tuple[float, int, Optional[str], float]] = {}
+
+    def add_node(self, node_id: str, edges: Iterable[Tuple[str, float]] = ()):
+        """
+        Adds a step and its edges to earlier steps.
+
+        :param node_id: Id of the new step.
+        :param edges: (earlier node id, similarity) pairs.
+        """
+        if self.root is None:
+            self.root = node_id
+            self._best[node_id] = (0.0, 0, None, 0.0)
+        best = None
+        for parent, weight in edges:
+            reached = self._best.get(parent)
+            if reached is None:
+                continue  # parent isn't reachable from the root
+            candidate = (reached[0] + float(weight), reached[1] + 1, parent, float(weight))
+            if best is None or candidate[0] > best[0]:
+                best = candidate
+        if best is not None and node_id != self.root:
+            self._best[node_id] = best
+
+    def path(self, node_id: str) -> Tuple[Optional[list], Optional[list], Optional[float]]:
+        """
+        :param node_id: Id of a step.
+        :return: (path, path_weights, avg_similarity) of the strongest path from the root,
+            or (None, None, None) if the step can't be reached.
+        """
+        best = self._best.get(node_id)
+        if best is None:
+            return None, None, None
+        total, length, _, _ = best
+        if length == 0:  # Handle the case when there's only one node
+            return [node_id], [], 1.0
+        path, weights = [node_id], []
+        while best[2] is not None:
+            weights.append(best[3])
+            path.append(best[2])
+            best = self._best[best[2]]
+        path.reverse()
+        weights.reverse()
+        return path, weights, total / length
+
+    def path_data(self, node_id: str) -> Optional[dict]:
+        """
+        :param node_id: Id of a step.
+        :return: The 'path_data' payload of a step event, None if the step can't be reached.
+        """
+        strongest_path, path_weights, avg_similarity = self.path(node_id)
+        return {
+            'strongest_path': strongest_path,
+            'path_weights': path_weights,
+            'avg_similarity': avg_similarity
+        } if strongest_path is not None else None
+
+    def reset(self):
+        """
+        Forgets every step.
+        """
+        self.root = None
+        self._best = {}
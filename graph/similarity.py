@@ -0,0 +1,90 @@
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+
+class StepSimilarity:
+    """
+    Cosine similarities between the steps of one reasoning session.
+
+    Embeddings are normalized once and stored in a preallocated matrix that doubles when
+    full, so adding a step costs a single matrix-vector product against the earlier steps.
+    The resulting similarity row is kept for later top-k, node sizing and path lookups.
+    """
+
+    def __init__(self, vector_size: Optional[int] = None, capacity: int = 32):
+        """
+        :param vector_size: Dimension of the embeddings, taken from the first step if omitted.
+        :param capacity: Number of rows to preallocate.
+        """
+        self.vector_size = vector_size
+        self._capacity = capacity
+        self._matrix: Optional[np.ndarray] = None
+        self._rows: Dict[int, np.ndarray] = {}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, embedding) -> int:
+        """
+        Adds a step embedding and computes its similarities to every earlier step.
+
+        :param embedding: The step embedding.
+        :return: The row index of the new step.
+        """
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        if self._matrix is None:
+            self.vector_size = self.vector_size or len(vector)
+            self._matrix = np.zeros((self._capacity, self.vector_size), dtype=np.float32)
+        elif self._count == len(self._matrix):
+            grown = np.zeros((2 * len(self._matrix), self.vector_size), dtype=np.float32)
+            grown[:self._count] = self._matrix
+            self._matrix = grown
+
+        norm = np.linalg.norm(vector)
+        row = self._count
+        self._matrix[row] = vector / norm if norm else vector
+        self._rows[row] = self._matrix[:row] @ self._matrix[row]
+        self._count += 1
+        return row
+
+    def similarities(self, row: int) -> np.ndarray:
+        """
+        :param row: Row index of a step.
+        :return: Cosine similarities of the step to every earlier step.
+        """
+        return self._rows[row]
+
+    def similarity(self, a: int, b: int) -> float:
+        """
+        :return: Cosine similarity between two steps.
+        """
+        if a == b:
+            return 1.0
+        a, b = max(a, b), min(a, b)
+        return float(self._rows[a][b])
+
+    def top_k(self, row: int, k: int = 2) -> List[Tuple[int, float]]:
+        """
+        Finds the earlier steps most similar to the given one.
+
+        :param row: Row index of a step.
+        :param k: Number of steps to return.
+        :return: A list of (row, similarity) tuples, most similar first.
+        """
+        similarities = self._rows[row]
+        if len(similarities) == 0:
+            return []
+        if k < len(similarities):
+            candidates = np.argpartition(similarities, -k)[-k:]
+        else:
+            candidates = np.arange(len(similarities))
+        candidates = candidates[np.argsort(similarities[candidates])[::-1]]
+        return [(int(i), float(similarities[i])) for i in candidates]
+
+    def reset(self):
+        """
+        Forgets every step, keeping the allocated matrix.
+        """
+        self._rows = {}
+        self._count = 0
@@ -1,22 +1,117 @@
 
 import re
 import json
+import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
 
-def extract_json(text):
-    text = re.sub(r'```(?:json)?\s*', '', text)
-    text = text.strip()
-    json_objects = re.findall(r'\{[^{}]*\}', text)
-    
-    if json_objects:
+try:
+    import orjson
+except ImportError:  # optional, speeds up SSE serialization
+    orjson = None
+
+def sse_event(payload, event: str = None) -> str:
+    """
+    Formats a payload as a server-sent event, using orjson when it's installed.
+
+    :param payload: The event's data.
+    :param event: Event name, unnamed events are the ones EventSource.onmessage receives.
+    """
+    if orjson is not None:
+        data = orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+    else:
+        data = json.dumps(payload)
+    if event:
+        return f"event: {event}\ndata: {data}\n\n"
+    return f"data: {data}\n\n"
+
+def parse_similar_request(body, max_batch: int = 1000):
+    """
+    Validates the JSON body of a /similar request.
+
+    :param body: The decoded body, with exactly one of 'texts', 'vectors' or 'ids' and the
+        optional 'top_k', 'session', 'is_question', 'created_after', 'created_before',
+        'min_similarity' and 'mmr'.
+    :param max_batch: Maximum number of queries in one request.
+    :return: (kind, queries, options), options being keyword arguments of db.search.search_many.
+    :raises ValueError: With a message for the client if the body is invalid.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Expected a JSON object")
+    kinds = [kind for kind in ('texts', 'vectors', 'ids') if kind in body]
+    if len(kinds) != 1:
+        raise ValueError("Provide exactly one of 'texts', 'vectors' or 'ids'")
+    kind = kinds[0]
+    queries = body[kind]
+    if not isinstance(queries, list) or not queries:
+        raise ValueError(f"'{kind}' must be a non-empty list")
+    if len(queries) > max_batch:
+        raise ValueError(f"At most {max_batch} queries per request")
+    if kind == 'texts' and not all(isinstance(text, str) and text for text in queries):
+        raise ValueError("'texts' must be non-empty strings")
+    if kind == 'ids' and not all(isinstance(id, int) for id in queries):
+        raise ValueError("'ids' must be integers")
+    if kind == 'vectors':
         try:
-            return json.loads(json_objects[-1])
+            queries = np.asarray(queries, dtype=np.float32)
+        except (TypeError, ValueError):
+            raise ValueError("'vectors' must be lists of numbers of the same length")
+        if queries.ndim != 2:
+            raise ValueError("'vectors' must be lists of numbers of the same length")
+
+    options = {'top_k': body.get('top_k', 5), 'session_id': body.get('session')}
+    if not isinstance(options['top_k'], int) or not 1 <= options['top_k'] <= 100:
+        raise ValueError("'top_k' must be an integer between 1 and 100")
+    if body.get('is_question') is not None:
+        options['is_question'] = bool(body['is_question'])
+    for name in ('created_after', 'created_before', 'min_similarity', 'mmr'):
+        if body.get(name) is not None:
+            if not isinstance(body[name], (int, float)):
+                raise ValueError(f"'{name}' must be a number")
+            options[name] = float(body[name])
+    if 'mmr' in options and not 0 <= options['mmr'] <= 1:
+        raise ValueError("'mmr' must be between 0 and 1")
+    return kind, queries, options
+
+def parse_json_object(text):
+    """
+    Finds the JSON object in a model reply. Code fences and text around the object are
+    ignored and nested braces are fine; when the reply holds several objects, the last one
+    with step keys wins. A reply cut off inside its object (e.g. at the token limit) gives
+    the string fields received so far.
+
+    :param text: The model's reply.
+    :return: The object as a dict, None if there's none.
+    """
+    text = re.sub(r'```(?:json)?', '', text)
+    decoder = json.JSONDecoder()
+    objects = []
+    start = text.find('{')
+    while start != -1:
+        try:
+            value, end = decoder.raw_decode(text, start)
         except json.JSONDecodeError:
-            pass
-    
+            start = text.find('{', start + 1)
+            continue
+        if isinstance(value, dict):
+            objects.append(value)
+        start = text.find('{', end)
+    step = next((o for o in reversed(objects) if {'title', 'content', 'next_action'} & o.keys()), None)
+    if step is not None:
+        return step
+
+    # No complete step object, maybe a truncated one
+    fields = StepStreamParser().feed(text)
+    if 'content' in fields:
+        return dict(fields)
+    return objects[-1] if objects else None
+
+def extract_json(text):
+    json_object = parse_json_object(text)
+    if json_object is not None:
+        return json_object
     return {
         "title": "Parsing Error",
-        "content": text,
+        "content": text.strip(),
         "next_action": "continue"
     }
 
@@ -24,10 +119,88 @@ def calculate_similarity(embedding1, embedding2):
     return cosine_similarity([embedding1], [embedding2])[0][0]
 
 def calculate_top_similarities(embeddings, current_step, top_k=2):
-    similarities = []
-    for i in range(min(current_step, len(embeddings))):
-        if i < len(embeddings) and current_step < len(embeddings):
-            similarity = float(calculate_similarity(embeddings[current_step], embeddings[i]))
-            similarities.append((i, similarity))
-    similarities.sort(key=lambda x: x[1], reverse=True)
-    return similarities[:top_k]
\ No newline at end of file
+    # One-off helper, the reasoning loop keeps a graph.similarity.StepSimilarity instead
+    if current_step >= len(embeddings):
+        return []
+    matrix = np.asarray(embeddings[:current_step + 1], dtype=np.float32).reshape(current_step + 1, -1)
+    norms = np.linalg.norm(matrix, axis=1)
+    matrix = matrix / np.where(norms == 0, 1.0, norms)[:, None]
+    similarities = matrix[:current_step] @ matrix[current_step]
+    order = np.argsort(similarities)[::-1][:top_k]
+    return [(int(i), float(similarities[i])) for i in order]
+
+class StepStreamParser:
+    """
+    Incremental parser for a step's JSON object as its tokens arrive.
+
+    Text before the first '{' (e.g. a code fence) is skipped. String values of the
+    top-level keys are exposed in `fields` while they are still being generated, so
+    a partially received 'content' can be shown right away.
+    """
+
+    _ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self):
+        self.fields = {}
+        self.complete = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = None  # Pending escape sequence, without the backslash
+        self._string = ""
+        self._key = None  # Top-level key whose value comes next
+        self._expect_key = False
+
+    def feed(self, text: str) -> dict:
+        """
+        Consumes the next chunk of generated text.
+
+        :param text: The new tokens.
+        :return: The fields recognized so far.
+        """
+        for char in text:
+            if self.complete:
+                break
+            if self._in_string:
+                self._feed_string(char)
+            elif char == '{':
+                self._depth += 1
+                self._expect_key = self._depth == 1
+            elif char == '}':
+                self._depth -= 1
+                self.complete = self._depth == 0
+            elif char in '[]' and self._depth >= 1:
+                # Strings and commas inside an array aren't keys or fields of the step
+                self._depth += 1 if char == '[' else -1
+            elif char == '"' and self._depth >= 1:
+                self._in_string = True
+                self._string = ""
+            elif char == ',' and self._depth == 1:
+                self._expect_key = True
+                self._key = None
+        return self.fields
+
+    def _feed_string(self, char):
+        if self._escape is not None:
+            self._escape += char
+            if self._escape[0] == 'u':
+                if len(self._escape) < 5:
+                    return
+                try:
+                    char = chr(int(self._escape[1:], 16))
+                except ValueError:
+                    char = ''
+            else:
+                char = self._ESCAPES.get(self._escape, self._escape)
+            self._escape = None
+        elif char == '\\':
+            self._escape = ""
+            return
+        elif char == '"':
+            self._in_string = False
+            if self._depth == 1 and self._expect_key:
+                self._key = self._string
+                self._expect_key = False
+            return
+        self._string += char
+        if self._depth == 1 and not self._expect_key and self._key is not None:
+            self.fields[self._key] = self._string
@@ -0,0 +1,272 @@
+# Request parsing, validation and payloads shared by the Flask app (app.py) and the ASGI app
+# (asgi.py), they only add the framework glue: routes, model calls and threads
+import os
+import logging
+from typing import List, NamedTuple, Optional
+
+from db.embeddings import EmbeddingDB, get_db
+from db.search import MODES
+from strategies.answer_cache import get_answer_cache
+from strategies.branches import BRANCH_CUTOFF, MAX_BRANCHES
+from strategies.registry import DEFAULT_STRATEGY, STRATEGIES, Strategy, get_strategy
+from tracing import get_tracer, process_metrics
+
+logger = logging.getLogger(__name__)
+
+DB_FILE = 'embeddings.db'
+
+
+class RequestError(ValueError):
+    """
+    An invalid request, the message is for the client.
+    """
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class QueryRequest(NamedTuple):
+    query: str
+    scope: str
+    stream: bool
+    delta: bool
+    use_cache: bool
+    retrieval: str
+    branches: int
+    branch_cutoff: float
+    strategy: Strategy
+
+
+class SearchRequest(NamedTuple):
+    text: str
+    mode: str
+    session_id: Optional[str]
+    top_k: int
+
+
+class NeighborsRequest(NamedTuple):
+    ids: List[int]
+    text: Optional[str]
+    hops: int
+    min_weight: float
+    per_node: Optional[int]
+    max_nodes: int
+    seeds: int
+
+
+def configure(config):
+    """
+    Sets the defaults of the settings both apps read.
+
+    :param config: The app's config.
+    """
+    # Retention policy for the embeddings corpus, applied in the background every RETENTION_INTERVAL seconds
+    config.setdefault('RETENTION_MAX_AGE', 30 * 24 * 3600)  # seconds
+    config.setdefault('RETENTION_MAX_ROWS', 100_000)
+    config.setdefault('RETENTION_INTERVAL', float(os.environ.get('RETENTION_INTERVAL', 60)))
+    # How related items are found: 'hybrid' (BM25 + vectors), 'prefilter', 'vector' or 'lexical', see db.search
+    config.setdefault('RETRIEVAL_MODE', os.environ.get('RETRIEVAL_MODE', 'hybrid'))
+    # Queries accepted in one /similar request
+    config.setdefault('SIMILAR_MAX_BATCH', 1000)
+
+
+def apply_retention(config):
+    """
+    One pass of the retention policies, on the retention thread.
+
+    :param config: The app's config.
+    """
+    evicted = get_db(DB_FILE).evict(config['RETENTION_MAX_AGE'], config['RETENTION_MAX_ROWS'])
+    if evicted:
+        logger.debug(f"evicted {evicted} embeddings")
+    get_answer_cache(DB_FILE).evict()
+
+
+def _flag(value) -> bool:
+    return value.lower() not in ('0', 'false', 'no')
+
+
+def _number(value, kind):
+    # Left as it is when it isn't one, the range checks reject it
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def parse_query_request(values, retrieval: str, query_string: bool = False) -> QueryRequest:
+    """
+    Validates the parameters of a /query request.
+
+    :param values: The JSON body of a POST, or the query string arguments of a GET.
+    :param retrieval: Retrieval mode of requests that don't pick one.
+    :param query_string: values are query string arguments, strings to convert.
+    :raises RequestError: If the request is invalid.
+    """
+    if not isinstance(values, dict) and not query_string:
+        raise RequestError("Expected a JSON object")
+    params = {
+        'query': values.get('query'),
+        'scope': values.get('scope', 'all'),
+        'stream': values.get('stream', True),
+        'delta': values.get('delta', True),
+        'use_cache': values.get('cache', True),
+        'retrieval': values.get('retrieval', retrieval),
+        'branches': values.get('branches', 1),
+        'branch_cutoff': values.get('branch_cutoff', BRANCH_CUTOFF),
+        'strategy': values.get('strategy', DEFAULT_STRATEGY),
+    }
+    if query_string:
+        for name in ('stream', 'delta', 'use_cache'):
+            params[name] = _flag(params[name]) if isinstance(params[name], str) else params[name]
+        params['branches'] = _number(params['branches'], int)
+        params['branch_cutoff'] = _number(params['branch_cutoff'], float)
+
+    if not params['query']:
+        raise RequestError("No query provided")
+    if params['scope'] not in ('all', 'session'):
+        raise RequestError("scope must be 'all' or 'session'")
+    if params['retrieval'] not in MODES:
+        raise RequestError(f"retrieval must be one of {', '.join(MODES)}")
+    branches = params['branches']
+    if not isinstance(branches, int) or isinstance(branches, bool) or not 1 <= branches <= MAX_BRANCHES:
+        raise RequestError(f"branches must be an integer between 1 and {MAX_BRANCHES}")
+    branch_cutoff = params['branch_cutoff']
+    if not isinstance(branch_cutoff, (int, float)) or isinstance(branch_cutoff, bool) or not 0 <= branch_cutoff <= 1:
+        raise RequestError("branch_cutoff must be a number between 0 and 1")
+    try:
+        params['strategy'] = get_strategy(params['strategy'])
+    except ValueError as e:
+        raise RequestError(str(e))
+    if branches > 1 and not params['strategy'].branching:
+        raise RequestError(f"the {params['strategy'].name} strategy doesn't take branches")
+    return QueryRequest(**params)
+
+
+def check_embedding_model(emb_db: EmbeddingDB, embedding_model: str):
+    """
+    :param emb_db: The session's database.
+    :param embedding_model: Model the question will be embedded with.
+    :raises RequestError: If the database holds embeddings of another model.
+    """
+    if not emb_db.check_embedding_model(embedding_model):
+        raise RequestError(f"The database holds embeddings of {emb_db.embedding_model}, not {embedding_model}. "
+                           f"Run python -m db.reembed --model {embedding_model} first.", 503)
+
+
+def strategies_payload() -> dict:
+    """
+    :return: The strategies /query takes, see strategies.registry.
+    """
+    return {'default': DEFAULT_STRATEGY, 'strategies': [
+        {'name': strategy.name, 'description': strategy.description, 'branching': strategy.branching}
+        for strategy in STRATEGIES.values()
+    ]}
+
+
+def parse_search_request(args, mode: str) -> SearchRequest:
+    """
+    Validates the query string of a /search request.
+
+    :param args: The query string arguments.
+    :param mode: Retrieval mode of requests that don't pick one.
+    :raises RequestError: If the request is invalid.
+    """
+    text = args.get('q')
+    mode = args.get('mode', mode)
+    if not text:
+        raise RequestError("No query provided")
+    if mode not in MODES:
+        raise RequestError(f"mode must be one of {', '.join(MODES)}")
+    top_k = max(1, min(args.get('top_k', 5, type=int), 100))
+    return SearchRequest(text, mode, args.get('session'), top_k)
+
+
+def items_payload(items) -> List[dict]:
+    """
+    :param items: Rows of db.search, (id, text, similarity, is_question).
+    """
+    return [
+        {'id': id, 'text': text, 'similarity': similarity, 'is_question': is_question}
+        for id, text, similarity, is_question in items
+    ]
+
+
+def similar_queries(emb_db: EmbeddingDB, kind: str, queries):
+    """
+    Turns the queries of a /similar request into vectors for db.search.search_many.
+
+    :param emb_db: The database searched.
+    :param kind: 'texts' (embedded already), 'vectors' or 'ids', see helpers.parse_similar_request.
+    :param queries: The query vectors, or the ids of stored rows.
+    :return: (vectors, exclude_ids)
+    :raises RequestError: If an id isn't stored or the vectors don't have the index's size.
+    """
+    if kind == 'ids':
+        # A stored row is searched with its own vector and left out of its results
+        unknown = [id for id in queries if id not in emb_db.segment]
+        if unknown:
+            raise RequestError(f"Unknown ids: {unknown[:20]}", 404)
+        return emb_db.segment.get_many(queries, full_precision=True), queries
+    if kind == 'vectors' and queries.shape[1] != emb_db.index.vector_size:
+        raise RequestError(f"'vectors' must have {emb_db.index.vector_size} dimensions")
+    return queries, None
+
+
+def parse_neighbors_request(args) -> NeighborsRequest:
+    """
+    Validates the query string of a /neighbors request.
+
+    :param args: The query string arguments.
+    :raises RequestError: If the request is invalid.
+    """
+    ids = args.getlist('id', type=int)
+    text = args.get('q')
+    if not ids and not text:
+        raise RequestError("No id or query provided")
+    return NeighborsRequest(
+        ids=ids,
+        text=text,
+        hops=max(1, min(args.get('hops', 2, type=int), 4)),
+        min_weight=args.get('min_weight', 0.0, type=float),
+        per_node=args.get('per_node', type=int),
+        max_nodes=max(1, min(args.get('max_nodes', 200, type=int), 1000)),
+        seeds=max(1, min(args.get('seeds', 3, type=int), 20)),
+    )
+
+
+def neighbors_payload(emb_db: EmbeddingDB, params: NeighborsRequest, query_embedding=None) -> dict:
+    """
+    Neighborhood of stored rows in the kNN graph of every session, read from the stored edges.
+
+    :param emb_db: The database searched.
+    :param params: The request.
+    :param query_embedding: Embedding of params.text, the rows closest to it are the seeds when there are no ids.
+    :raises RequestError: If none of the ids is stored.
+    """
+    ids = params.ids or [id for id, _ in emb_db.index.query(query_embedding, params.seeds)]
+    hop_of, edges = emb_db.graph.neighborhood(ids, hops=params.hops, min_weight=params.min_weight,
+                                              per_node=params.per_node, max_nodes=params.max_nodes)
+    texts = emb_db.get_texts(list(hop_of))
+    if not any(id in texts for id in ids):
+        raise RequestError(f"Unknown ids: {ids[:20]}", 404)
+    return {
+        'nodes': [{'id': id, 'text': texts[id][0], 'is_question': texts[id][1], 'hop': hop}
+                  for id, hop in hop_of.items() if id in texts],
+        'edges': [{'from': a, 'to': b, 'value': weight} for a, b, weight in edges if a in texts and b in texts],
+    }
+
+
+def render_metrics(extra=()) -> str:
+    """
+    Prometheus text format: stage timings, token counts, scheduler and cache counters.
+
+    :param extra: More metrics of the app, in the format of Tracer.render.
+    """
+    answer_cache = get_answer_cache(DB_FILE).stats()
+    return get_tracer().render(process_metrics() + [
+        ('answer_cache_lookups_total', 'counter', "Answer cache lookups by result.",
+         [({'result': 'hit'}, answer_cache['hits']), ({'result': 'miss'}, answer_cache['misses'])]),
+        *extra,
+    ])
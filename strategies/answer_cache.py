@@ -0,0 +1,161 @@
+import json
+import os
+import threading
+import time
+import logging
+from typing import Dict, Iterator, List, Optional
+
+from db.answer_cache import AnswerCacheDB
+from db.embeddings import EmbeddingDB
+from graph.delta import GraphDelta, apply_delta
+from helpers import sse_event
+
+logger = logging.getLogger(__name__)
+
+
+class AnswerCache:
+    """
+    Semantic cache of completed reasoning runs.
+
+    A run's trace (its step, inconsistency and final events, with the path data and graph
+    changes of each) is stored under its question, with the strategy and branch count that
+    produced it. A new question close enough to a cached one, by cosine similarity of the
+    question embeddings, asked with the same strategy and branch count, gets the stored
+    trace replayed instead of a new run.
+    """
+
+    def __init__(self, db_file: str, threshold: float = 0.95, max_age: Optional[float] = 7 * 24 * 3600,
+                 max_rows: Optional[int] = 10_000, candidates: int = 16):
+        """
+        :param db_file: Database holding the question embeddings, the traces are stored next to them.
+        :param threshold: Minimum similarity between two questions for a replay.
+        :param max_age: Seconds a trace stays valid, None to keep traces regardless of age.
+        :param max_rows: Maximum number of stored traces, oldest are evicted first.
+        :param candidates: Number of nearest rows looked at for a cached question.
+        """
+        self.threshold = threshold
+        self.max_age = max_age
+        self.max_rows = max_rows
+        self.candidates = candidates
+        self.db = AnswerCacheDB(db_file)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, conn: EmbeddingDB, query_embedding, exclude_id: Optional[int] = None,
+               strategy: str = 'stepwise', branches: int = 1) -> Optional[dict]:
+        """
+        Finds the cached question closest to a new one.
+
+        :param conn: Database holding the question embeddings.
+        :param query_embedding: Embedding of the new question.
+        :param exclude_id: Row of the new question itself, it must not match its own (absent) trace.
+        :param strategy: Strategy the new question is asked with, only its traces are replayed.
+        :param branches: Branch count the new question is asked with, likewise.
+        :return: A dict with 'question_id', 'question', 'similarity', 'trace' and 'total_time', or None.
+        """
+        # Step rows and uncached questions come back from the index too, the join drops them
+        similar = {
+            id: similarity for id, similarity in conn.index.query(query_embedding, self.candidates)
+            if similarity >= self.threshold and id != exclude_id
+        }
+        min_created_at = time.time() - self.max_age if self.max_age is not None else 0
+        rows = self.db.get_many(list(similar), strategy, branches, min_created_at)
+        if not rows:
+            self.misses += 1
+            return None
+        question_id, question, trace, total_time, _ = max(rows, key=lambda row: similar[row[0]])
+        self.hits += 1
+        self.db.defer(self.db.hit, question_id)
+        return {
+            'question_id': question_id,
+            'question': question,
+            'similarity': similar[question_id],
+            'trace': json.loads(trace),
+            'total_time': total_time,
+        }
+
+    def store(self, question_id: int, question: str, trace: List[dict], total_time: float,
+              strategy: str = 'stepwise', branches: int = 1):
+        """
+        Queues a completed run for storage.
+
+        :param question_id: Row of the question in the 'embeddings' table.
+        :param question: The question's text.
+        :param trace: The run's events, see ReasoningSession.trace.
+        :param total_time: Seconds the run took.
+        :param strategy: Name of the strategy of the run.
+        :param branches: Number of branches of the run.
+        """
+        self.db.defer(self.db.put, question_id, question, json.dumps(trace), total_time, strategy, branches)
+
+    def replay(self, hit: dict, delta: bool = True) -> Iterator[str]:
+        """
+        Yields the SSE events of a cached run, like the run itself would have.
+
+        :param hit: A result of lookup.
+        :param delta: Send graph changes as 'graph_delta' instead of the whole graph in every event.
+        """
+        start_time = time.time()
+        graph_delta = GraphDelta()
+        graph = None
+        for payload in hit['trace']:
+            payload = dict(payload)
+            if 'graph_delta' in payload:
+                # Traces hold the changes since the previous graph, rebuild the whole one
+                graph = apply_delta(graph, payload.pop('graph_delta'))
+            elif 'graph' in payload:
+                graph = payload.pop('graph')  # Stored before traces held deltas
+            else:
+                if payload['type'] == 'inconsistency':
+                    graph_delta.reset()
+                yield sse_event(payload)
+                continue
+            if delta:
+                payload['graph_delta'] = graph_delta.update(graph)
+            else:
+                payload['graph'] = graph
+            yield sse_event(payload)
+        yield sse_event({
+            'type': 'done',
+            'total_time': time.time() - start_time,
+            'cached': {
+                'question': hit['question'],
+                'similarity': hit['similarity'],
+                'original_time': hit['total_time'],
+            },
+        })
+
+    def evict(self) -> int:
+        """
+        Applies the TTL and size limits.
+
+        :return: The number of deleted traces.
+        """
+        return self.db.evict(self.max_age, self.max_rows)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: Hit/miss counters.
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+_caches: Dict[str, AnswerCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_answer_cache(db_file: str) -> AnswerCache:
+    """
+    Returns the answer cache of a database file. Its limits come from ANSWER_CACHE_THRESHOLD
+    (default 0.95), ANSWER_CACHE_TTL (seconds, default 7 days) and ANSWER_CACHE_SIZE (default 10000).
+    """
+    with _caches_lock:
+        cache = _caches.get(db_file)
+        if cache is None:
+            cache = _caches[db_file] = AnswerCache(
+                db_file,
+                threshold=float(os.environ.get('ANSWER_CACHE_THRESHOLD', 0.95)),
+                max_age=float(os.environ.get('ANSWER_CACHE_TTL', 7 * 24 * 3600)),
+                max_rows=int(os.environ.get('ANSWER_CACHE_SIZE', 10_000)),
+            )
+        return cache
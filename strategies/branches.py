@@ -0,0 +1,407 @@
+# Several reasoning branches run side by side and merged into one step graph
+import asyncio
+import os
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from chat.api import API, AsyncAPI
+from chat.get_short_title import get_short_title
+from db.embeddings import EmbeddingDB
+from graph.delta import GraphDelta
+from graph.helpers import serialize_graph_data
+from graph.paths import StrongestPath
+from graph.similarity import StepSimilarity
+from helpers import sse_event
+from strategies.answer_cache import get_answer_cache
+from strategies.session import ReasoningSession
+from tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+MAX_BRANCHES = 8
+# Branches a branching run starts with, and how many of them generate at the same time
+BRANCHES = int(os.environ.get('BRANCHES', 3))
+BRANCH_WORKERS = int(os.environ.get('BRANCH_WORKERS', 3))
+# Branches whose strongest path averages a lower similarity are cancelled, 0 keeps every branch
+BRANCH_CUTOFF = float(os.environ.get('BRANCH_CUTOFF', 0))
+# Steps a branch takes before the cutoff applies to it
+BRANCH_MIN_STEPS = 3
+# Steps of different branches at least this similar are linked in the graph
+CROSS_EDGE_THRESHOLD = 0.8
+
+QUESTION_NODE = 'Question'
+FINAL_NODE = 'Final'
+
+
+class BranchMerge:
+    """
+    The merged step graph of a branching run.
+
+    Every branch is a ReasoningSession of its own (conversation, retries, context window),
+    driven by a worker. Their steps arrive here in whatever order the workers produce them
+    and become nodes of one graph rooted at the question: each step is linked to its two
+    most similar predecessors in its own branch (or the question), and to the most similar
+    step of every other branch when they're at least CROSS_EDGE_THRESHOLD similar. Edges
+    always point from an earlier to a later node, so the strongest paths stay incremental
+    and may cross between branches.
+
+    When every branch is done, the answer whose strongest path is the most coherent and
+    which agrees the most with the other branches' answers wins.
+
+    Like ReasoningSession it does no I/O, the drivers below feed it.
+    """
+
+    def __init__(self, prompt: str, conn: EmbeddingDB, branches: int, delta: bool = True,
+                 cutoff: float = BRANCH_CUTOFF, min_steps: int = BRANCH_MIN_STEPS):
+        """
+        :param prompt: The user's question.
+        :param conn: Database the steps are recorded in.
+        :param branches: Number of branches.
+        :param delta: Send graph changes as 'graph_delta' instead of the whole graph in every event.
+        :param cutoff: Strongest-path similarity under which a branch is cancelled, 0 to keep every branch.
+        :param min_steps: Steps a branch takes before the cutoff applies to it.
+        """
+        self.prompt = prompt
+        self.conn = conn
+        self.delta = delta
+        self.cutoff = cutoff
+        self.min_steps = min_steps
+        self.sessions = [ReasoningSession(prompt, conn, delta=delta) for _ in range(branches)]
+
+        self.similarity = StepSimilarity()
+        self.row_branch: List[Optional[int]] = []  # Branch of every similarity row, None for the question
+        self.row_node: List[str] = []
+        self.node_count = [0] * branches  # Steps in the graph, per branch
+        self.last_node: List[Optional[str]] = [None] * branches
+        self.answers: Dict[int, dict] = {}  # Final answer of every branch that finished
+        self.cancelled = set()
+
+        self.graph_data = {'nodes': [], 'edges': []}
+        self.paths = StrongestPath()
+        self.graph_delta = GraphDelta()
+        self.trace = []  # For the answer cache, like ReasoningSession.trace
+        self.trace_delta = GraphDelta(snapshot_every=None)
+        self.tracer = get_tracer()
+        self.session_id = conn.session_id
+        self.start_time = time.time()
+
+    def add_question(self, embedding):
+        """
+        Adds the root node every branch starts from.
+        """
+        self._add_node(None, QUESTION_NODE, f"Question: {self.prompt[:40]}", embedding)
+
+    def add_step(self, branch: int, step: dict, embedding, short_title: str) -> str:
+        """
+        :param branch: Index of the branch.
+        :param step: The step returned by the branch's accept_step.
+        :param embedding: Embedding of the step's content.
+        :param short_title: Node label.
+        :return: The 'step' event, with the branch it belongs to.
+        """
+        node_id = f"B{branch + 1}.{step['node_id']}"
+        path_data = self._add_node(branch, node_id, f"B{branch + 1} Step {step['step']}: {short_title}", embedding)
+        self.conn.insert_embedding_deferred(step['content'], embedding, False)
+        self.node_count[branch] += 1
+        self.last_node[branch] = node_id
+        self.tracer.count('branch_steps', self.session_id)
+        event = {'type': 'step', 'branch': branch + 1, 'step': step['step'], 'title': step['title'],
+                 'content': step['content'], 'path_data': path_data}
+        return self._event(event)
+
+    def should_cancel(self, branch: int) -> Optional[str]:
+        """
+        Checks a branch against the cutoff after its latest step. The last branch still
+        running is never cancelled.
+
+        :return: The 'branch_cancelled' event if the branch should stop, None otherwise.
+        """
+        if not self.cutoff or branch in self.cancelled or self.node_count[branch] < self.min_steps:
+            return None
+        running = [b for b in range(len(self.sessions)) if b not in self.cancelled and b not in self.answers]
+        if running == [branch]:
+            return None
+        _, _, score = self.paths.path(self.last_node[branch])
+        if score is None or score >= self.cutoff:
+            return None
+        return self.cancel(branch, f"strongest path similarity {score:.3f} is under {self.cutoff}", score)
+
+    def cancel(self, branch: int, reason: str, score: Optional[float] = None) -> str:
+        """
+        :return: The 'branch_cancelled' event.
+        """
+        self.cancelled.add(branch)
+        self.tracer.count('branches_cancelled', self.session_id)
+        logger.debug(f"cancelled branch {branch + 1}: {reason}")
+        payload = {'type': 'branch_cancelled', 'branch': branch + 1, 'reason': reason, 'score': score}
+        self.trace.append(payload)
+        return sse_event(payload)
+
+    def restart(self, branch: int) -> str:
+        """
+        :return: The event of a branch whose evaluation disagreed with its answer and started over.
+        """
+        # The branch's earlier steps stay in the merged graph, the other branches may build on them
+        payload = {'type': 'branch_restarted', 'branch': branch + 1, 'message': 'Inconsistency detected. Restarting the branch.'}
+        self.trace.append(payload)
+        return sse_event(payload)
+
+    def add_answer(self, branch: int, content: str, embedding, short_title: str):
+        """
+        Adds a branch's final answer to the graph. Answers of cancelled branches are dropped.
+        """
+        if branch in self.cancelled:
+            return
+        node_id = f"B{branch + 1}.Final"
+        self._add_node(branch, node_id, f"B{branch + 1} Answer: {short_title}", embedding)
+        self.conn.insert_embedding_deferred(content, embedding, False)
+        self.answers[branch] = {'node': node_id, 'row': len(self.row_node) - 1, 'content': content, 'title': short_title}
+
+    def finish(self) -> List[str]:
+        """
+        Picks the answer and adds it to the graph.
+
+        :return: The 'final' and 'done' events, or 'error' and 'done' when no branch answered.
+        """
+        scores = {}
+        for branch, answer in self.answers.items():
+            _, _, coherence = self.paths.path(answer['node'])
+            # Self-consistency: how much the other branches' answers agree with this one
+            others = [self.similarity.similarity(answer['row'], other['row']) for b, other in self.answers.items() if b != branch]
+            agreement = float(np.mean(others)) if others else 0.0
+            scores[branch] = {'coherence': coherence or 0.0, 'agreement': agreement}
+        total_time = time.time() - self.start_time  # Wall clock, the branches' model time overlaps
+        if not scores:
+            logger.warning(f"{self.session_id}: every reasoning branch failed or was cancelled")
+            summary = self.tracer.session_summary(self.session_id, pop=True) if self.session_id else None
+            return [sse_event({'type': 'error', 'message': 'Every reasoning branch failed or was cancelled.'}),
+                    sse_event({'type': 'done', 'total_time': total_time, 'summary': summary})]
+        best = max(scores, key=lambda b: scores[b]['coherence'] + scores[b]['agreement'])
+        answer = self.answers[best]
+
+        self.graph_data['nodes'].append({'id': FINAL_NODE, 'label': f"Final Answer: {answer['title']}"})
+        edge_weight = max(scores[best]['agreement'], 1e-6)
+        self._add_edge(answer['node'], FINAL_NODE, edge_weight)
+        self.paths.add_node(FINAL_NODE, [(answer['node'], edge_weight)])
+        event = {
+            'type': 'final',
+            'content': answer['content'],
+            'branch': best + 1,
+            'answers': [{'branch': b + 1, 'content': self.answers[b]['content'], **s} for b, s in sorted(scores.items())],
+            'path_data': self.paths.path_data(FINAL_NODE),
+        }
+        summary = self.tracer.session_summary(self.session_id, pop=True) if self.session_id else None
+        return [self._event(event), sse_event({'type': 'done', 'total_time': total_time, 'summary': summary})]
+
+    def _add_node(self, branch: Optional[int], node_id: str, label: str, embedding) -> Optional[dict]:
+        with self.tracer.span('similarity', self.session_id):
+            row = self.similarity.add(embedding)
+            similarities = self.similarity.similarities(row)
+        self.row_branch.append(branch)
+        self.row_node.append(node_id)
+
+        parents = []
+        if row > 0:
+            own = [r for r in range(row) if self.row_branch[r] in (branch, None)]
+            own.sort(key=lambda r: similarities[r], reverse=True)
+            parents = [(self.row_node[r], float(similarities[r])) for r in own[:2]]
+            for other in range(len(self.sessions)):
+                rows = [r for r in range(row) if self.row_branch[r] == other and other != branch]
+                if rows:
+                    r = max(rows, key=lambda r: similarities[r])
+                    if similarities[r] >= CROSS_EDGE_THRESHOLD:
+                        parents.append((self.row_node[r], float(similarities[r])))
+        self.graph_data['nodes'].append({'id': node_id, 'label': label})
+        for parent, weight in parents:
+            self._add_edge(parent, node_id, weight)
+        # Sized by average similarity like the single-branch graph
+        self.graph_data['nodes'][-1]['value'] = float(np.mean([w for _, w in parents])) * 30 + 10 if parents else 20
+
+        with self.tracer.span('path', self.session_id):
+            self.paths.add_node(node_id, parents)
+            return self.paths.path_data(node_id)
+
+    def _add_edge(self, a: str, b: str, weight: float):
+        self.graph_data['edges'].append({'from': a, 'to': b, 'value': weight, 'length': 300 * (1 - weight)})
+
+    def _event(self, event: dict) -> str:
+        with self.tracer.span('serialize', self.session_id):
+            serialized_graph_data = serialize_graph_data(self.graph_data)
+            self.trace.append({**event, 'graph_delta': self.trace_delta.update(serialized_graph_data)})
+            if self.delta:
+                return sse_event({**event, 'graph_delta': self.graph_delta.update(serialized_graph_data)})
+            return sse_event({**event, 'graph': serialized_graph_data})
+
+
+def generate_branching_response(prompt, conn: EmbeddingDB, branches: int = BRANCHES, workers: int = BRANCH_WORKERS,
+                                cutoff: float = BRANCH_CUTOFF, delta: bool = True, question_id: int = None,
+                                strategy: str = 'stepwise'):
+    """
+    Runs several reasoning branches on a thread pool and yields the SSE events of their
+    merged graph. Steps arrive whole, without 'partial' events.
+
+    :param prompt: The user's question.
+    :param conn: Database the steps are recorded in.
+    :param branches: Number of branches.
+    :param workers: Branches generating at the same time, the others wait for a free worker.
+    :param cutoff: Strongest-path similarity under which a branch is cancelled, 0 to keep every branch.
+    :param delta: Send graph changes as 'graph_delta' instead of the whole graph in every event.
+    :param question_id: Row of the question in conn, the completed run is stored in the answer cache under it.
+    :param strategy: Name of the strategy running the branches, the run is cached for it.
+    """
+    api = API(session=conn.session_id)
+    merge = BranchMerge(prompt, conn, branches, delta=delta, cutoff=cutoff)
+    merge.add_question(api.embed(prompt))
+    results = queue.Queue()
+    stop = [threading.Event() for _ in range(branches)]
+
+    def run_branch(branch):
+        # Sequential within a branch; the scheduler interleaves the branches' model calls
+        session = merge.sessions[branch]
+        try:
+            while session.running and not stop[branch].is_set():
+                start_time = time.time()
+                response = api.chat(messages=session.prompt_messages(), format=session.format)
+                step = session.accept_step(response['message']['content'], time.time() - start_time)
+                if step is None:
+                    continue
+                embedding = api.embed(step['content'])
+                short_title = get_short_title(step['content'], session=conn.session_id) if session.needs_short_title(step['title']) else step['title'][:20]
+                evaluate = session.advance(step)
+                results.put(('step', branch, (step, embedding, short_title)))
+                if evaluate and not stop[branch].is_set():
+                    start_time = time.time()
+                    response = api.chat(messages=session.prompt_messages(), format=session.format)
+                    if session.evaluate(response['message']['content'], time.time() - start_time):
+                        results.put(('restart', branch, None))
+            if stop[branch].is_set():
+                results.put(('stopped', branch, None))
+                return
+            if session.request_final_answer():
+                start_time = time.time()
+                response = api.chat(messages=session.prompt_messages(), format=session.format)
+                session.accept_final_answer(response['message']['content'], time.time() - start_time)
+            embedding = api.embed(session.final_answer)
+            results.put(('answer', branch, (session.final_answer, embedding, get_short_title(session.final_answer, session=conn.session_id))))
+        except Exception as e:
+            logger.exception(f"branch {branch + 1} failed")
+            results.put(('failed', branch, e))
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(workers, branches)), thread_name_prefix="branch")
+    try:
+        for branch in range(branches):
+            executor.submit(run_branch, branch)
+        running = branches
+        while running:
+            kind, branch, data = results.get()
+            if kind in ('stopped', 'failed', 'answer'):
+                running -= 1
+                if kind == 'answer':
+                    merge.add_answer(branch, *data)
+                elif kind == 'failed' and branch not in merge.cancelled:
+                    yield merge.cancel(branch, f"failed: {data}")
+            elif branch in merge.cancelled:
+                continue  # Produced before the branch saw it was cancelled
+            elif kind == 'restart':
+                yield merge.restart(branch)
+            else:
+                yield merge.add_step(branch, *data)
+                cancelled = merge.should_cancel(branch)
+                if cancelled:
+                    stop[branch].set()
+                    yield cancelled
+    finally:
+        for event in stop:
+            event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+    yield from merge.finish()
+    if question_id is not None and merge.answers:
+        get_answer_cache(conn.db_file).store(question_id, prompt, merge.trace, time.time() - merge.start_time,
+                                             strategy=strategy, branches=branches)
+
+
+async def agenerate_branching_response(prompt, conn: EmbeddingDB, branches: int = BRANCHES, workers: int = BRANCH_WORKERS,
+                                       cutoff: float = BRANCH_CUTOFF, delta: bool = True, question_id: int = None,
+                                       strategy: str = 'stepwise'):
+    """
+    asyncio version of generate_branching_response, for the ASGI app. Branches are tasks,
+    a cancelled branch's model call is abandoned right away.
+    """
+    api = AsyncAPI(session=conn.session_id)
+    merge = BranchMerge(prompt, conn, branches, delta=delta, cutoff=cutoff)
+    merge.add_question(await api.embed(prompt))
+    results = asyncio.Queue()
+    slots = asyncio.Semaphore(max(1, workers))
+
+    def title(content):
+        return asyncio.to_thread(get_short_title, content, session=conn.session_id)
+
+    async def run_branch(branch):
+        session = merge.sessions[branch]
+        try:
+            async with slots:
+                while session.running:
+                    start_time = time.time()
+                    response = await api.chat(messages=session.prompt_messages(), format=session.format)
+                    step = session.accept_step(response['message']['content'], time.time() - start_time)
+                    if step is None:
+                        continue
+                    if session.needs_short_title(step['title']):
+                        embedding, short_title = await asyncio.gather(api.embed(step['content']), title(step['content']))
+                    else:
+                        embedding, short_title = await api.embed(step['content']), step['title'][:20]
+                    evaluate = session.advance(step)
+                    results.put_nowait(('step', branch, (step, embedding, short_title)))
+                    if evaluate:
+                        start_time = time.time()
+                        response = await api.chat(messages=session.prompt_messages(), format=session.format)
+                        if session.evaluate(response['message']['content'], time.time() - start_time):
+                            results.put_nowait(('restart', branch, None))
+                if session.request_final_answer():
+                    start_time = time.time()
+                    response = await api.chat(messages=session.prompt_messages(), format=session.format)
+                    session.accept_final_answer(response['message']['content'], time.time() - start_time)
+                embedding, short_title = await asyncio.gather(api.embed(session.final_answer), title(session.final_answer))
+            results.put_nowait(('answer', branch, (session.final_answer, embedding, short_title)))
+        except asyncio.CancelledError:
+            results.put_nowait(('stopped', branch, None))
+            raise
+        except Exception as e:
+            logger.exception(f"branch {branch + 1} failed")
+            results.put_nowait(('failed', branch, e))
+
+    tasks = [asyncio.ensure_future(run_branch(branch)) for branch in range(branches)]
+    try:
+        running = branches
+        while running:
+            kind, branch, data = await results.get()
+            if kind in ('stopped', 'failed', 'answer'):
+                running -= 1
+                if kind == 'answer':
+                    merge.add_answer(branch, *data)
+                elif kind == 'failed' and branch not in merge.cancelled:
+                    yield merge.cancel(branch, f"failed: {data}")
+            elif branch in merge.cancelled:
+                continue
+            elif kind == 'restart':
+                yield merge.restart(branch)
+            else:
+                yield merge.add_step(branch, *data)
+                cancelled = merge.should_cancel(branch)
+                if cancelled:
+                    tasks[branch].cancel()
+                    yield cancelled
+    finally:
+        for task in tasks:
+            task.cancel()
+    for event in merge.finish():
+        yield event
+    if question_id is not None and merge.answers:
+        get_answer_cache(conn.db_file).store(question_id, prompt, merge.trace, time.time() - merge.start_time,
+                                             strategy=strategy, branches=branches)
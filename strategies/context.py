@@ -0,0 +1,122 @@
+# Keeps the prompt of a long reasoning run within a token budget
+import os
+import logging
+from typing import List, Optional, Tuple
+
+from graph.paths import StrongestPath
+
+logger = logging.getLogger(__name__)
+
+# Estimated prompt size above which older steps are folded, 0 to always send everything.
+# Ollama's default context is 2048 tokens, it silently drops the start of longer prompts.
+CONTEXT_TOKENS = int(os.environ.get('CONTEXT_TOKENS', 2048))
+# Latest steps always sent as they were generated
+CONTEXT_KEEP_STEPS = int(os.environ.get('CONTEXT_KEEP_STEPS', 4))
+
+CHARS_PER_TOKEN = 4  # Rough average for English text with llama tokenizers
+MESSAGE_OVERHEAD = 4  # Role and separator tokens of the chat template
+
+
+def estimate_tokens(messages: List[dict]) -> int:
+    """
+    :return: Approximate number of prompt tokens of a list of chat messages.
+    """
+    return sum(len(message['content']) // CHARS_PER_TOKEN + MESSAGE_OVERHEAD for message in messages)
+
+
+class ContextWindow:
+    """
+    Builds the prompt of every model call of a session from its full conversation.
+
+    The first messages (system prompt, question and the assistant's opener) are sent
+    unchanged as a stable prefix, so the model server can reuse their KV cache from call to
+    call. Once the prompt would exceed the token budget, all steps but the last keep_steps
+    are folded into one summary message after the prefix: the titles of the folded steps,
+    and the content of the folded steps on the strongest path to the last of them. The
+    summary only changes when more steps are folded, in between the prompt grows by
+    appending and everything up to the newest message stays reusable.
+    """
+
+    def __init__(self, budget: Optional[int] = None, keep_steps: Optional[int] = None, prefix: int = 3):
+        """
+        :param budget: Prompt size in estimated tokens, defaults to CONTEXT_TOKENS. 0 disables folding.
+        :param keep_steps: Latest steps always sent verbatim, defaults to CONTEXT_KEEP_STEPS.
+        :param prefix: Number of leading messages that are never folded.
+        """
+        self.budget = CONTEXT_TOKENS if budget is None else budget
+        self.keep_steps = max(1, CONTEXT_KEEP_STEPS if keep_steps is None else keep_steps)
+        self.prefix = prefix
+        # (message index, node id, step number, title, content) of every step in the conversation
+        self.steps: List[Tuple[int, str, int, str, str]] = []
+        self.folded = 0  # Steps replaced by the summary
+        self.summary: Optional[dict] = None
+
+    def add_step(self, index: int, node_id: str, number: int, title: str, content: str):
+        """
+        :param index: Position of the step's assistant message in the conversation.
+        :param node_id: Graph node of the step.
+        :param number: Step number shown to the user.
+        """
+        self.steps.append((index, node_id, number, title, content))
+
+    def reset(self, prefix: int):
+        """
+        Forgets every step, when the conversation restarts from its first prefix messages.
+        """
+        self.prefix = prefix
+        self.steps = []
+        self.folded = 0
+        self.summary = None
+
+    def build(self, messages: List[dict], paths: StrongestPath) -> Tuple[List[dict], int]:
+        """
+        :param messages: The full conversation.
+        :param paths: Strongest paths of the session's steps, the summary follows them.
+        :return: (the messages to send, number of steps newly folded by this call).
+        """
+        prompt = self._prompt(messages, self.folded, self.summary)
+        if not self.budget or estimate_tokens(prompt) <= self.budget or len(self.steps) <= self.keep_steps:
+            return prompt, 0
+
+        # Fold in one go down to keep_steps, so the next few prompts share this summary
+        folded = max(self.folded, len(self.steps) - self.keep_steps)
+        while True:
+            summary = self._summary(folded, paths, self.budget - estimate_tokens(self._prompt(messages, folded, None)))
+            prompt = self._prompt(messages, folded, summary)
+            if estimate_tokens(prompt) <= self.budget or folded >= len(self.steps) - 1:
+                break
+            folded += 1  # The latest steps alone are over budget, give up verbatim ones down to one
+        newly_folded = folded - self.folded
+        logger.debug(f"folded steps {self.folded + 1}-{folded}, prompt ~{estimate_tokens(prompt)} tokens")
+        self.folded, self.summary = folded, summary
+        return prompt, newly_folded
+
+    def _prompt(self, messages: List[dict], folded: int, summary: Optional[dict]) -> List[dict]:
+        if not folded:
+            return list(messages)
+        # Messages between folded steps (retry requests and the like) go with them
+        tail = messages[self.steps[folded][0]:] if folded < len(self.steps) else messages[self.steps[-1][0] + 1:]
+        return [*messages[:self.prefix], *([summary] if summary else []), *tail]
+
+    def _summary(self, folded: int, paths: StrongestPath, room: int) -> dict:
+        steps = self.steps[:folded]
+        header = f"To save space, your steps {steps[0][2]} to {steps[-1][2]} are summarized here. Their titles, in order:"
+        titles = "\n".join(f"Step {number}: {title}" for _, _, number, title, _ in steps)
+        room -= estimate_tokens([{'content': f"{header}\n{titles}\n"}])
+
+        # Content of the strongest line of reasoning through the folded steps, latest first while it fits
+        path, _, _ = paths.path(steps[-1][1])
+        on_path = set(path or [])
+        details = []
+        for _, node_id, number, _, content in reversed(steps):
+            if node_id not in on_path:
+                continue
+            detail = f"Step {number}: {content}"
+            if len(detail) // CHARS_PER_TOKEN >= room:
+                break
+            room -= len(detail) // CHARS_PER_TOKEN + 1
+            details.append(detail)
+        text = f"{header}\n{titles}"
+        if details:
+            text += "\n\nThe steps your reasoning mainly builds on:\n" + "\n".join(reversed(details))
+        return {"role": "user", "content": text}
@@ -0,0 +1,184 @@
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, Iterator
+
+_END = object()
+
+
+class StepPipeline:
+    """
+    Runs the per-step side work of the reasoning loop (embedding, titling) on a thread
+    pool, so it overlaps with the next chat call instead of delaying it.
+
+    At most max_in_flight side tasks run or wait at a time; submitting more blocks the
+    caller until one finishes. Chat calls get their own worker and aren't counted.
+    """
+
+    def __init__(self, max_in_flight: int = 4):
+        """
+        :param max_in_flight: Maximum number of pending side tasks.
+        """
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight + 1, thread_name_prefix="step-pipeline")
+
+    def chat(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Starts a chat call in the background.
+
+        :return: A Future resolved with the call's result.
+        """
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def stream(self, fn: Callable, *args, **kwargs) -> Iterator:
+        """
+        Starts consuming the iterator returned by a streaming chat call in the background.
+        Items are buffered until the returned iterator is read, so the call is already
+        running while the caller finishes other work.
+
+        :return: An iterator over the call's items, re-raising its error if it fails.
+        """
+        items = queue.Queue()
+
+        def produce():
+            try:
+                for item in fn(*args, **kwargs):
+                    if self._closed:
+                        break  # Nobody is reading anymore, let the call go
+                    items.put((item, None))
+            except BaseException as e:
+                items.put((_END, e))
+            else:
+                items.put((_END, None))
+
+        self._executor.submit(produce)
+
+        def consume():
+            while True:
+                item, error = items.get()
+                if item is _END:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+
+        return consume()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Starts a side task, waiting for a free slot if max_in_flight tasks are pending.
+
+        :return: A Future resolved with the task's result.
+        """
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self):
+        """
+        Stops the pipeline, dropping tasks that haven't started.
+        """
+        self._closed = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+class AsyncStepPipeline:
+    """
+    asyncio counterpart of StepPipeline: side tasks and chat calls run as tasks on the
+    event loop, so one process can drive many reasoning streams without a thread each.
+    """
+
+    def __init__(self, max_in_flight: int = 4):
+        """
+        :param max_in_flight: Maximum number of pending side tasks.
+        """
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tasks = set()
+
+    def chat(self, fn: Callable[..., Awaitable], *args, **kwargs) -> asyncio.Task:
+        """
+        Starts a chat call in the background.
+
+        :return: A task resolved with the call's result.
+        """
+        return self._track(asyncio.ensure_future(fn(*args, **kwargs)))
+
+    def stream(self, fn: Callable[..., Awaitable[AsyncIterator]], *args, **kwargs) -> AsyncIterator:
+        """
+        Starts consuming the async iterator returned by a streaming chat call in the
+        background, buffering items until the returned iterator is read.
+
+        :return: An async iterator over the call's items, re-raising its error if it fails.
+        """
+        items = asyncio.Queue()
+
+        async def produce():
+            try:
+                async for item in await fn(*args, **kwargs):
+                    items.put_nowait((item, None))
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                items.put_nowait((_END, e))
+            else:
+                items.put_nowait((_END, None))
+
+        self._track(asyncio.ensure_future(produce()))
+
+        async def consume():
+            while True:
+                item, error = await items.get()
+                if item is _END:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+
+        return consume()
+
+    async def submit(self, fn: Callable[..., Awaitable], *args, **kwargs) -> asyncio.Task:
+        """
+        Starts a side task, waiting for a free slot if max_in_flight tasks are pending.
+
+        :return: A task resolved with the side task's result.
+        """
+        await self._slots.acquire()
+        try:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+        except BaseException:
+            self._slots.release()
+            raise
+        task.add_done_callback(lambda _: self._slots.release())
+        return self._track(task)
+
+    def shutdown(self):
+        """
+        Cancels every task that is still running.
+        """
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+    def _track(self, task: asyncio.Task) -> asyncio.Task:
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.shutdown()
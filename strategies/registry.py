@@ -0,0 +1,107 @@
+# Reasoning strategies that /query can be asked to use
+import os
+import logging
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, Iterator
+
+from db.embeddings import EmbeddingDB
+from strategies.branches import BRANCH_CUTOFF, agenerate_branching_response, generate_branching_response
+from strategies.old import agenerate_response, generate_response
+from strategies.single_shot import agenerate_single_shot_response, generate_single_shot_response
+
+logger = logging.getLogger(__name__)
+
+
+class Strategy(ABC):
+    """
+    A way of answering a question with a stream of SSE events: 'step' and 'final' events
+    carrying the graph, then 'done'. generate drives it with threads for the Flask app,
+    agenerate with asyncio for the ASGI app. Strategies record their rows in the session's
+    database and store the finished run in the answer cache under question_id.
+    """
+
+    name = ''
+    description = ''
+    branching = False  # Takes branches > 1
+
+    @abstractmethod
+    def generate(self, prompt: str, conn: EmbeddingDB, stream: bool = True, delta: bool = True,
+                 question_id: int = None, branches: int = 1, branch_cutoff: float = BRANCH_CUTOFF) -> Iterator[str]:
+        """
+        :param prompt: The user's question.
+        :param conn: Database the steps are recorded in.
+        :param stream: Emit 'partial' events while a step is being generated, if the strategy can.
+        :param delta: Send graph changes as 'graph_delta' instead of the whole graph in every event.
+        :param question_id: Row of the question in conn.
+        :param branches: Reasoning branches, only for strategies with branching set.
+        :param branch_cutoff: See strategies.branches.
+        :return: The SSE events.
+        """
+
+    @abstractmethod
+    def agenerate(self, prompt: str, conn: EmbeddingDB, stream: bool = True, delta: bool = True,
+                  question_id: int = None, branches: int = 1, branch_cutoff: float = BRANCH_CUTOFF) -> AsyncIterator[str]:
+        """
+        asyncio version of generate.
+        """
+
+
+class StepwiseStrategy(Strategy):
+    name = 'stepwise'
+    description = "One model call per step, then an evaluation of the final answer; several branches with branches > 1"
+    branching = True
+
+    def generate(self, prompt, conn, stream=True, delta=True, question_id=None, branches=1, branch_cutoff=BRANCH_CUTOFF):
+        if branches > 1:
+            return generate_branching_response(prompt, conn, branches=branches, cutoff=branch_cutoff,
+                                               delta=delta, question_id=question_id, strategy=self.name)
+        return generate_response(prompt, conn, stream=stream, delta=delta, question_id=question_id)
+
+    def agenerate(self, prompt, conn, stream=True, delta=True, question_id=None, branches=1, branch_cutoff=BRANCH_CUTOFF):
+        if branches > 1:
+            return agenerate_branching_response(prompt, conn, branches=branches, cutoff=branch_cutoff,
+                                                delta=delta, question_id=question_id, strategy=self.name)
+        return agenerate_response(prompt, conn, stream=stream, delta=delta, question_id=question_id)
+
+
+class SingleShotStrategy(Strategy):
+    name = 'single_shot'
+    description = "Every step and the answer in one model call, embedded in one batch"
+
+    def generate(self, prompt, conn, stream=True, delta=True, question_id=None, branches=1, branch_cutoff=BRANCH_CUTOFF):
+        return generate_single_shot_response(prompt, conn, stream=stream, delta=delta, question_id=question_id)
+
+    def agenerate(self, prompt, conn, stream=True, delta=True, question_id=None, branches=1, branch_cutoff=BRANCH_CUTOFF):
+        return agenerate_single_shot_response(prompt, conn, stream=stream, delta=delta, question_id=question_id)
+
+
+STRATEGIES: Dict[str, Strategy] = {}
+
+
+def register(strategy: Strategy) -> Strategy:
+    """
+    Makes a strategy selectable by its name, replacing any strategy of the same name.
+
+    :param strategy: The strategy.
+    :return: The strategy.
+    """
+    STRATEGIES[strategy.name] = strategy
+    return strategy
+
+
+def get_strategy(name: str) -> Strategy:
+    """
+    :param name: Name of a registered strategy.
+    :return: The strategy.
+    :raises ValueError: If no strategy has that name.
+    """
+    if name not in STRATEGIES:
+        raise ValueError(f"strategy must be one of {', '.join(STRATEGIES)}")
+    return STRATEGIES[name]
+
+
+register(StepwiseStrategy())
+register(SingleShotStrategy())
+
+# Strategy of the queries that don't name one
+DEFAULT_STRATEGY = get_strategy(os.environ.get('STRATEGY', StepwiseStrategy.name)).name
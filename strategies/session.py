@@ -0,0 +1,447 @@
+import json
+import os
+import logging
+from typing import List, Optional
+
+from db.embeddings import EmbeddingDB
+from graph.delta import GraphDelta
+from graph.helpers import serialize_graph_data
+from graph.paths import StrongestPath
+from graph.similarity import StepSimilarity
+from strategies.context import ContextWindow
+from helpers import extract_json, parse_json_object, sse_event
+from tracing import get_tracer
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = """You are an expert AI assistant that explains your reasoning step by step. For each step, provide a title that describes what you're doing in that step, along with the content. Decide if you need another step or if you're ready to give the final answer. Respond in JSON format with 'title', 'content', and 'next_action' (either 'continue' or 'final_answer') keys. USE AS MANY REASONING STEPS AS POSSIBLE. AT LEAST 3. BE AWARE OF YOUR LIMITATIONS AS AN LLM AND WHAT YOU CAN AND CANNOT DO. IN YOUR REASONING, INCLUDE EXPLORATION OF ALTERNATIVE ANSWERS. CONSIDER YOU MAY BE WRONG, AND IF YOU ARE WRONG IN YOUR REASONING, WHERE IT WOULD BE. FULLY TEST ALL OTHER POSSIBILITIES. YOU CAN BE WRONG. WHEN YOU SAY YOU ARE RE-EXAMINING, ACTUALLY RE-EXAMINE, AND USE ANOTHER APPROACH TO DO SO. DO NOT JUST SAY YOU ARE RE-EXAMINING. USE AT LEAST 3 METHODS TO DERIVE THE ANSWER. USE BEST PRACTICES."""
+
+# Longest step content accepted, longer steps are sent back to the model
+MAX_CONTENT_LENGTH = 700
+MAX_TITLE_LENGTH = 100
+
+# Constrains every reasoning reply to a step object, with the length limit enforced while decoding
+STEP_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string", "maxLength": MAX_TITLE_LENGTH},
+        "content": {"type": "string", "maxLength": MAX_CONTENT_LENGTH},
+        "next_action": {"type": "string", "enum": ["continue", "final_answer"]},
+    },
+    "required": ["title", "content", "next_action"],
+}
+
+
+def step_format(setting: str):
+    """
+    :param setting: 'schema' for replies matching STEP_SCHEMA (needs Ollama 0.5+), 'json' for
+        any JSON object, 'off' for free text.
+    :return: The format argument of API.chat for the reasoning calls.
+    """
+    formats = {'schema': STEP_SCHEMA, 'json': 'json', 'off': ''}
+    if setting not in formats:
+        raise ValueError(f"STEP_FORMAT must be one of {', '.join(formats)}, not {setting!r}")
+    return formats[setting]
+
+
+STEP_FORMAT = step_format(os.environ.get('STEP_FORMAT', 'schema'))
+
+
+class ReasoningSession:
+    """
+    State of one step-by-step reasoning run: the conversation, the steps and their graph.
+
+    The session does no I/O of its own. A driver (threaded or asyncio) makes the model
+    calls, hands the results to the session and yields the SSE events it returns, so the
+    same loop logic serves both the Flask and the ASGI app. Other strategies reuse its
+    graph, embedding and event plumbing (add_step, emit_step, finish) with their own calls.
+    """
+
+    max_steps = 20  # Set a maximum number of steps to prevent infinite loops, retries count too
+    max_retries = 2  # Retries of a single step before its reply is taken as it is
+
+    def __init__(self, prompt: str, conn: EmbeddingDB, delta: bool = True, format=None, context: Optional[ContextWindow] = None):
+        """
+        :param prompt: The user's question.
+        :param conn: Database the steps are recorded in.
+        :param delta: Send graph changes as 'graph_delta' instead of the whole graph in every event.
+        :param format: format argument of the reasoning calls, defaults to the STEP_FORMAT setting.
+        :param context: Builds the prompts from the conversation, defaults to the CONTEXT_TOKENS budget.
+        """
+        self.prompt = prompt
+        self.conn = conn
+        self.delta = delta
+        self.format = STEP_FORMAT if format is None else format
+        self.messages = [{
+            "role": "system",
+            "content": SYSTEM_PROMPT
+        }, {
+            "role": "user",
+            "content": prompt
+        }, {
+            "role": "assistant",
+            "content": "Thank you! I will now think step by step following my instructions, starting at the beginning after decomposing the problem."
+        }]
+
+        # Full conversation in messages, what the model gets is built from it by prompt_messages
+        self.context = context or ContextWindow(prefix=len(self.messages))
+
+        self.steps = []
+        self.step_count = 1
+        self.total_thinking_time = 0
+        self.thinking_time = 0  # Of the last model call
+        self.final_answer = None  # Initialize final_answer
+        self.finished = False  # Set once the evaluation agreed with the final answer
+        self.retries = 0  # Replies sent back to the model, over the whole run
+        self.step_retries = 0  # Of the step being generated
+
+        self.graph_data = {
+            'nodes': [],
+            'edges': []
+        }
+        self.similarity = StepSimilarity()  # Normalized step embeddings and their pairwise similarities
+        self.node_ids = []  # Graph node id of every step, in order
+        self.edge_dict = {}  # New dictionary to keep track of edges
+        self.paths = StrongestPath()  # Strongest path to every step, updated as steps arrive
+        self.graph_delta = GraphDelta()
+        # Payloads of the step, inconsistency and final events with the graph changes since the
+        # previous one, for the answer cache. A full graph per event would grow quadratically.
+        self.trace = []
+        self.trace_delta = GraphDelta(snapshot_every=None)
+        self.tracer = get_tracer()
+        self.session_id = conn.session_id
+
+    def prompt_messages(self) -> List[dict]:
+        """
+        :return: The messages of the next model call, older steps folded to fit the context budget.
+        """
+        messages, folded = self.context.build(self.messages, self.paths)
+        if folded:
+            self.tracer.count('context_folds', self.session_id)
+            self.tracer.count('context_folded_steps', self.session_id, folded)
+        return messages
+
+    @property
+    def running(self) -> bool:
+        """
+        :return: True while the loop should ask for another step.
+        """
+        return not self.finished and self.step_count + self.retries < self.max_steps
+
+    def graph_payload(self, serialized_graph_data) -> dict:
+        if self.delta:
+            return {'graph_delta': self.graph_delta.update(serialized_graph_data)}
+        return {'graph': serialized_graph_data}
+
+    def partial_event(self, fields: dict) -> str:
+        """
+        :param fields: Fields parsed so far from the step being generated.
+        :return: The 'partial' event of the current step.
+        """
+        return sse_event({'type': 'partial', 'step': self.step_count, 'title': fields.get('title', ''), 'content': fields['content']})
+
+    def accept_step(self, step_data: str, thinking_time: float) -> Optional[dict]:
+        """
+        Parses a generated step and adds it to the conversation.
+
+        :param step_data: The model's reply.
+        :param thinking_time: Seconds the reply took.
+        :return: The step, or None if it was rejected and the model was asked to retry.
+        """
+        self.thinking_time = thinking_time
+        logger.info(f"thinking_time {thinking_time}")
+        logger.debug(step_data)
+
+        step_json = parse_json_object(step_data)
+        logger.debug(step_json)
+        if step_json is None or 'content' not in step_json:
+            self.tracer.count('step_parse_failures', self.session_id)
+            if self._retry("Your last response wasn't a valid step. Respond with a single JSON object with 'title', 'content' and 'next_action' keys.", 'unparseable'):
+                return None
+            step_json = extract_json(step_data) if step_json is None else {**step_json, 'content': 'No content'}
+        title = str(step_json.get('title', ''))
+        content = step_json['content'] if isinstance(step_json['content'], str) else json.dumps(step_json['content'])
+        next_action = step_json.get('next_action', 'continue')
+
+        if len(content) > MAX_CONTENT_LENGTH:
+            logger.debug(f"{self.session_id}: step {self.step_count} content exceeded {MAX_CONTENT_LENGTH} characters, retrying")
+            if self._retry("Your last response was too long. Please provide a more concise version of your last step.", 'too_long'):
+                return None
+            content = content[:MAX_CONTENT_LENGTH]  # Out of retries, keep the step cut short
+        # If we reach here, the step is valid and under the length limit
+        return self.add_step(title, content, next_action, thinking_time, {**step_json, 'title': title, 'content': content})
+
+    def add_step(self, title: str, content: str, next_action: str, thinking_time: float,
+                 step_json: Optional[dict] = None) -> dict:
+        """
+        Adds a valid step to the conversation, numbered with the current step count.
+
+        :param thinking_time: Seconds the model spent on the step.
+        :param step_json: The step as the model sent it, defaults to its three fields.
+        :return: The step, to be passed to emit_step once its embedding is known.
+        """
+        self.step_retries = 0
+        self.tracer.count('steps', self.session_id)
+        self.total_thinking_time += thinking_time
+
+        # Generate a unique node ID
+        node_id = self._next_node_id()
+
+        step_json = step_json or {'title': title, 'content': content, 'next_action': next_action}
+        self.steps.append((f"Step {self.step_count}: {title}", content, thinking_time))
+        self.messages.append({"role": "assistant", "content": json.dumps(step_json)})
+        self.context.add_step(len(self.messages) - 1, node_id, self.step_count, title, content)
+        return {
+            'step': self.step_count,
+            'node_id': node_id,
+            'title': title,
+            'content': content,
+            'next_action': next_action,
+        }
+
+    def _retry(self, message: str, reason: str) -> bool:
+        """
+        Asks the model to generate the current step again, unless the step is out of retries.
+
+        :return: True if the model was asked again.
+        """
+        if self.step_retries >= self.max_retries or self.step_count + self.retries + 1 >= self.max_steps:
+            self.tracer.count('step_retries_exhausted', self.session_id)
+            return False
+        self.step_retries += 1
+        self.retries += 1
+        self.tracer.count(f'step_retries_{reason}', self.session_id)
+        self.messages.append({"role": "user", "content": message})
+        return True
+
+    @staticmethod
+    def needs_short_title(title: str) -> bool:
+        # Generate a short title only if the original title is empty or too long
+        return not title or len(title) > 20
+
+    def advance(self, step: dict) -> bool:
+        """
+        Decides what follows an accepted step.
+
+        :return: True if the final answer needs an evaluation call, see evaluate.
+        """
+        if step['next_action'] == 'final_answer' and self.step_count <= 5:
+            logger.debug(f"{self.session_id}: final answer requested after {self.step_count - 1} steps, continuing")
+            self.messages.append({
+                "role": "user",
+                "content": f"You've only provided {self.step_count - 1} steps of 5. Can you look for possible error or alternatives to your answer. Continue your reasoning."
+            })
+            return False
+        elif step['next_action'] == 'final_answer' or 'boxed' in step['content'].lower():
+            if not self.final_answer:
+                self.final_answer = step['content']  # Set final_answer if not already set
+
+            # Add last evaluation step
+            self.messages.append({
+                "role": "user",
+                "content": f"Let's do a final evaluation. The original question was: '{self.prompt}'. Based on your reasoning, is your final answer correct and complete? If not, what might be missing or incorrect?"
+            })
+            return True
+
+        self.step_count += 1  # Increment step count only for valid steps
+        return False
+
+    def evaluate(self, evaluation_data: str, thinking_time: float) -> Optional[str]:
+        """
+        Checks the model's evaluation of its final answer.
+
+        :param evaluation_data: The model's reply to the evaluation prompt.
+        :param thinking_time: Seconds the reply took.
+        :return: An 'inconsistency' event if the reasoning restarts, None if the loop is finished.
+        """
+        self.thinking_time = thinking_time
+        self.total_thinking_time += thinking_time
+
+        evaluation_json = parse_json_object(evaluation_data)
+        if evaluation_json is None:
+            self.tracer.count('evaluation_parse_failures', self.session_id)
+            evaluation_json = extract_json(evaluation_data)
+        evaluation_content = evaluation_json.get('content', 'No evaluation content')
+
+        # Check if the evaluation suggests a different answer
+        if check_consistency(self.final_answer, evaluation_content):
+            self.finished = True  # Exit the loop if consistent
+            return None
+
+        logger.warning(f"{self.session_id}: inconsistency detected, restarting the reasoning process")
+        self.trace.append({'type': 'inconsistency', 'message': 'Inconsistency detected. Restarting the reasoning process.'})
+        self.messages = self.messages[:2]  # Reset messages to initial state
+        self.context.reset(len(self.messages))
+        self.step_count += 1  # Increment step count instead of resetting
+        self.final_answer = None  # Reset final_answer
+        self.graph_data = {'nodes': [], 'edges': []}  # Reset graph data
+        self.similarity.reset()
+        self.paths.reset()
+        self.graph_delta.reset()
+        self.trace_delta.reset()
+        self.node_ids = []
+        self.edge_dict = {}
+        return sse_event({'type': 'inconsistency', 'message': 'Inconsistency detected. Restarting the reasoning process.'})
+
+    def emit_step(self, step: dict, embedding, short_title: str) -> str:
+        """
+        Records a step with its embedding and adds it to the graph.
+
+        :param step: The step returned by accept_step.
+        :param embedding: Embedding of the step's content.
+        :param short_title: Node label, the step's own title if it's short enough.
+        :return: The 'step' event.
+        """
+        node_id = step['node_id']
+        logger.debug(f"embedding {embedding}")
+        with self.tracer.span('similarity', self.session_id):
+            row = self.similarity.add(embedding)
+            top_similarities = self.similarity.top_k(row, k=2) if row > 0 else []
+        self.conn.insert_embedding_deferred(step['content'], embedding, False)
+
+        # Add node for this step
+        self.graph_data['nodes'].append({
+            'id': node_id,
+            'label': f"Step {step['step']}: {short_title}"
+        })
+
+        with self.tracer.span('path', self.session_id):
+            self.paths.add_node(node_id, [(self.node_ids[prev_row], step_similarity) for prev_row, step_similarity in top_similarities])
+            path_data = self.paths.path_data(node_id)
+        if row > 0:
+            # Clear previous edges for the current step
+            self.edge_dict = {k: v for k, v in self.edge_dict.items() if v['to'] != node_id}
+
+            for prev_row, step_similarity in top_similarities:
+                prev_node_id = self.node_ids[prev_row]
+                edge_key = f"{prev_node_id}-{node_id}"
+                self.edge_dict[edge_key] = {
+                    'from': prev_node_id,
+                    'to': node_id,
+                    'value': step_similarity,
+                    'length': 300 * (1 - step_similarity)
+                }
+
+        # Update graph_data['edges'] with the current edge_dict
+        self.graph_data['edges'] = list(self.edge_dict.values())
+        # Scale node sizes based on average similarity
+        connected_similarities = [edge['value'] for edge in self.edge_dict.values() if edge['from'] == node_id or edge['to'] == node_id]
+        if connected_similarities:
+            avg_similarity = sum(connected_similarities) / len(connected_similarities)
+            self.graph_data['nodes'][-1]['value'] = avg_similarity * 30 + 10  # Scale to 10-40 range
+        else:
+            self.graph_data['nodes'][-1]['value'] = 20  # Set a default size if no connections
+
+        logger.debug(f"yield step #{step['step']}: {step['title']}")
+        event = {'type': 'step', 'step': step['step'], 'title': step['title'], 'content': step['content'], 'path_data': path_data}
+        with self.tracer.span('serialize', self.session_id):
+            serialized_graph_data = serialize_graph_data(self.graph_data)
+            self.trace.append({**event, 'graph_delta': self.trace_delta.update(serialized_graph_data)})
+            return sse_event({**event, **self.graph_payload(serialized_graph_data)})
+
+    def request_final_answer(self) -> bool:
+        """
+        :return: True if the loop ended without a final answer, after asking the model for one.
+        """
+        if self.final_answer:
+            return False
+        self.messages.append({"role": "user", "content": "Please provide the final answer based on your reasoning above."})
+        return True
+
+    def accept_final_answer(self, final_data: str, thinking_time: float):
+        """
+        :param final_data: The model's reply to request_final_answer's prompt.
+        :param thinking_time: Seconds the reply took.
+        """
+        self.thinking_time = thinking_time
+        self.total_thinking_time += thinking_time
+        final_json = parse_json_object(final_data)
+        if final_json is None:
+            self.tracer.count('final_parse_failures', self.session_id)
+            final_json = {}
+        self.final_answer = final_json.get('content', final_data)
+
+    def finish(self, final_embedding, final_title: str) -> List[str]:
+        """
+        Adds the final answer to the graph.
+
+        :param final_embedding: Embedding of the final answer.
+        :param final_title: Node label of the final answer.
+        :return: The 'final' and 'done' events.
+        """
+        with self.tracer.span('similarity', self.session_id):
+            final_row = self.similarity.add(final_embedding)
+            top_similarities = self.similarity.top_k(final_row, k=2)
+        self.conn.insert_embedding_deferred(self.final_answer, final_embedding, False)
+
+        # Add final answer node to the graph
+        final_node_id = self._next_node_id()
+
+        self.graph_data['nodes'].append({
+            'id': final_node_id,
+            'label': f"Final Answer: {final_title}"
+        })
+
+        # Connect the final answer to its most similar steps
+        with self.tracer.span('path', self.session_id):
+            self.paths.add_node(final_node_id, [(self.node_ids[prev_row], step_similarity) for prev_row, step_similarity in top_similarities])
+            path_data = self.paths.path_data(final_node_id)
+
+        for prev_row, step_similarity in top_similarities:
+            prev_node_id = self.node_ids[prev_row]
+            edge_key = f"{final_node_id}-{prev_node_id}"
+            self.edge_dict[edge_key] = {
+                'from': final_node_id,
+                'to': prev_node_id,
+                'value': step_similarity,
+                'length': 300 * (1 - step_similarity)
+            }
+
+        self.graph_data['edges'] = list(self.edge_dict.values())
+
+        logger.debug(f'yield final: {self.final_answer}')
+        event = {'type': 'final', 'content': self.final_answer, 'path_data': path_data}
+        with self.tracer.span('serialize', self.session_id):
+            serialized_graph_data = serialize_graph_data(self.graph_data)
+            self.trace.append({**event, 'graph_delta': self.trace_delta.update(serialized_graph_data)})
+            events = [sse_event({**event, **self.graph_payload(serialized_graph_data)})]
+
+        self.steps.append(("Final Answer", self.final_answer, self.thinking_time))
+        logger.debug(f'done in {self.total_thinking_time} s')
+        # Stage timings and token counts of this run, the model calls are done by now
+        summary = self.tracer.session_summary(self.session_id, pop=True) if self.session_id else None
+        events.append(sse_event({'type': 'done', 'total_time': self.total_thinking_time, 'summary': summary}))
+        return events
+
+    def _next_node_id(self) -> str:
+        node_id = f"Step{self.step_count}"
+        while node_id in self.node_ids:
+            self.step_count += 1
+            node_id = f"Step{self.step_count}"
+        self.node_ids.append(node_id)
+        return node_id
+
+
+def check_consistency(final_answer, evaluation):
+    #messages = [
+    #    {"role": "system", "content": "You are a consistency checker. Compare the final answer and the evaluation, and determine if they are consistent or if the evaluation suggests a significantly different answer."},
+    #    {"role": "user", "content": f"Final answer: {final_answer}\n\nEvaluation: {evaluation}\n\nAre these consistent? Respond with ONLY 'consistent' or 'inconsistent'."}
+    #]
+    #
+    #for attempt in range(5):  # Try up to 5 times
+    #    response = ""
+    #    for chunk in stream_api_call(messages, 50):
+    #        response += chunk
+    #
+    #    response = response.strip().lower()
+    #    print(f"check_consistency response (attempt {attempt + 1}):", response)
+    #
+    #    if response.startswith("consistent") or response.startswith("inconsistent"):
+    #        return response.startswith("consistent")
+    #
+    #    # If we reach here, the response was invalid, so we'll try again
+    #    messages.append({"role": "user", "content": "Please respond with 'consistent' or 'inconsistent' at the beginning."})
+    #
+    ## If we've tried 5 times and still haven't got a valid response, default to inconsistent
+    #print("Failed to get a valid consistency check after 5 attempts. Defaulting to inconsistent.")
+    #return False
+    return True
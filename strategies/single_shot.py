@@ -0,0 +1,181 @@
+# Every reasoning step in one model call, embedded in one batch
+import asyncio
+import json
+import time
+import logging
+from concurrent.futures import Future
+from typing import List, Optional
+
+from chat.api import API, AsyncAPI
+from chat.get_short_title import get_short_title
+from db.embeddings import EmbeddingDB
+from helpers import parse_json_object
+from strategies.answer_cache import get_answer_cache
+from strategies.pipeline import StepPipeline
+from strategies.session import MAX_CONTENT_LENGTH, MAX_TITLE_LENGTH, ReasoningSession
+
+logger = logging.getLogger(__name__)
+
+MIN_STEPS = 3
+MAX_STEPS = 12
+
+SINGLE_SHOT_PROMPT = f"""You are an expert AI assistant that explains your reasoning step by step. Work through the whole problem in one response: give between {MIN_STEPS} and {MAX_STEPS} steps, each with a title that describes what you're doing in that step and its content, then your final answer. BE AWARE OF YOUR LIMITATIONS AS AN LLM AND WHAT YOU CAN AND CANNOT DO. IN YOUR REASONING, INCLUDE EXPLORATION OF ALTERNATIVE ANSWERS. CONSIDER YOU MAY BE WRONG, AND IF YOU ARE WRONG IN YOUR REASONING, WHERE IT WOULD BE. USE AT LEAST 2 METHODS TO DERIVE THE ANSWER. Keep each step under {MAX_CONTENT_LENGTH} characters. Respond in JSON format with a 'steps' array of objects with 'title' and 'content' keys, and a 'final_answer' key."""
+
+# The whole reply in one object, step count and lengths enforced while decoding
+SINGLE_SHOT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "steps": {
+            "type": "array",
+            "minItems": MIN_STEPS,
+            "maxItems": MAX_STEPS,
+            "items": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string", "maxLength": MAX_TITLE_LENGTH},
+                    "content": {"type": "string", "maxLength": MAX_CONTENT_LENGTH},
+                },
+                "required": ["title", "content"],
+            },
+        },
+        "final_answer": {"type": "string"},
+    },
+    "required": ["steps", "final_answer"],
+}
+
+
+class SingleShotSession(ReasoningSession):
+    """
+    A reasoning run answered by a single model call: the reply holds every step and the
+    final answer, the steps' embeddings are then computed in one batch. One round trip
+    instead of one per step plus the evaluation, at the cost of no streaming, no per-step
+    retries and no re-examination of the answer.
+
+    Like ReasoningSession it does no I/O, the drivers below make the calls.
+    """
+
+    max_retries = 1  # A reply without steps is asked for once more, then taken as the answer
+
+    def __init__(self, prompt: str, conn: EmbeddingDB, delta: bool = True, format=None):
+        """
+        :param prompt: The user's question.
+        :param conn: Database the steps are recorded in.
+        :param delta: Send graph changes as 'graph_delta' instead of the whole graph in every event.
+        :param format: format argument of the call, defaults to the STEP_FORMAT setting applied to the whole reply.
+        """
+        super().__init__(prompt, conn, delta=delta, format=format)
+        if format is None and isinstance(self.format, dict):
+            self.format = SINGLE_SHOT_SCHEMA
+        self.messages = [
+            {"role": "system", "content": SINGLE_SHOT_PROMPT},
+            {"role": "user", "content": prompt},
+        ]
+        self.context.reset(len(self.messages))
+
+    def accept_reply(self, reply: str, thinking_time: float) -> Optional[List[dict]]:
+        """
+        Parses the model's reply into steps and the final answer.
+
+        :param reply: The model's reply.
+        :param thinking_time: Seconds the reply took.
+        :return: The steps, to be passed to emit_step, or None if the model was asked again.
+        """
+        self.thinking_time = thinking_time
+        data = parse_json_object(reply) or {}
+        items = data.get('steps') if isinstance(data.get('steps'), list) else []
+        items = [item for item in items if isinstance(item, dict) and item.get('content')][:MAX_STEPS]
+        if not items:
+            self.tracer.count('step_parse_failures', self.session_id)
+            if self._retry("Your last response had no steps. Respond with a single JSON object with a 'steps' array "
+                           "of objects with 'title' and 'content' keys, and a 'final_answer' key.", 'unparseable'):
+                return None
+            self.total_thinking_time += thinking_time
+            self.final_answer = str(data.get('final_answer') or reply.strip() or 'No answer')
+            return []
+
+        steps = []
+        for item in items:
+            content = item['content'] if isinstance(item['content'], str) else json.dumps(item['content'])
+            if len(content) > MAX_CONTENT_LENGTH:
+                self.tracer.count('step_truncated', self.session_id)
+                content = content[:MAX_CONTENT_LENGTH]
+            title = str(item.get('title', ''))[:MAX_TITLE_LENGTH]
+            # The reply's time is shared out between its steps
+            steps.append(self.add_step(title, content, 'continue', thinking_time / len(items)))
+            self.step_count += 1
+        final_answer = data.get('final_answer')
+        self.final_answer = final_answer if isinstance(final_answer, str) and final_answer else steps[-1]['content']
+        return steps
+
+
+def generate_single_shot_response(prompt, conn: EmbeddingDB, stream: bool = True, delta: bool = True, question_id: int = None):
+    """
+    Asks the model for every step at once and yields the same events as generate_response.
+
+    :param prompt: The user's question.
+    :param conn: Database the steps are recorded in.
+    :param stream: Unused, the steps can only be shown once the whole reply is in.
+    :param delta: Send graph changes as 'graph_delta' instead of the whole graph in every event.
+    :param question_id: Row of the question in conn, the completed run is stored in the answer cache under it.
+    """
+    api = API(session=conn.session_id)
+    session = SingleShotSession(prompt, conn, delta=delta)
+    steps = None
+    while steps is None:
+        start_time = time.time()
+        response = api.chat(messages=session.prompt_messages(), format=session.format)
+        steps = session.accept_reply(response['message']['content'], time.time() - start_time)
+
+    # One embedding call for every step and the answer, titled side by side
+    pipeline = StepPipeline()
+    try:
+        embeddings = pipeline.submit(api.embed, [step['content'] for step in steps] + [session.final_answer])
+        titles = [
+            pipeline.submit(get_short_title, step['content'], session=conn.session_id)
+            if session.needs_short_title(step['title']) else step['title'][:20]
+            for step in steps
+        ]
+        final_title = pipeline.submit(get_short_title, session.final_answer, session=conn.session_id)
+        embeddings = embeddings.result()
+        titles = [title.result() if isinstance(title, Future) else title for title in titles]
+        final_title = final_title.result()
+    finally:
+        pipeline.shutdown()
+    for step, embedding, title in zip(steps, embeddings, titles):
+        yield session.emit_step(step, embedding, title)
+    yield from session.finish(embeddings[-1], final_title)
+    if question_id is not None:
+        get_answer_cache(conn.db_file).store(question_id, prompt, session.trace, session.total_thinking_time,
+                                             strategy='single_shot')
+
+
+async def agenerate_single_shot_response(prompt, conn: EmbeddingDB, stream: bool = True, delta: bool = True, question_id: int = None):
+    """
+    asyncio version of generate_single_shot_response, for the ASGI app.
+    """
+    api = AsyncAPI(session=conn.session_id)
+    session = SingleShotSession(prompt, conn, delta=delta)
+    steps = None
+    while steps is None:
+        start_time = time.time()
+        response = await api.chat(messages=session.prompt_messages(), format=session.format)
+        steps = session.accept_reply(response['message']['content'], time.time() - start_time)
+
+    async def title(step):
+        if not session.needs_short_title(step['title']):
+            return step['title'][:20]
+        # Local titles are cheap, but the model fallback blocks
+        return await asyncio.to_thread(get_short_title, step['content'], session=conn.session_id)
+
+    embeddings, final_title, *titles = await asyncio.gather(
+        api.embed([step['content'] for step in steps] + [session.final_answer]),
+        asyncio.to_thread(get_short_title, session.final_answer, session=conn.session_id),
+        *[title(step) for step in steps],
+    )
+    for step, embedding, short_title in zip(steps, embeddings, titles):
+        yield session.emit_step(step, embedding, short_title)
+    for event in session.finish(embeddings[-1], final_title):
+        yield event
+    if question_id is not None:
+        get_answer_cache(conn.db_file).store(question_id, prompt, session.trace, session.total_thinking_time,
+                                             strategy='single_shot')
@@ -0,0 +1,245 @@
+# Lightweight tracing: stage timings, model token counts and per-session summaries
+import threading
+import time
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the span duration histogram, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PREFIX = 'lkg'
+
+# (labels, value) pairs of one metric, or a single unlabelled value
+Samples = Union[float, Iterable[Tuple[Mapping[str, str], float]]]
+
+
+class _Histogram:
+    __slots__ = ('buckets', 'count', 'sum')
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+class Tracer:
+    """
+    Process-wide timing spans and model token counts.
+
+    Spans are aggregated into one histogram per name, nothing is kept per call. Spans and
+    token counts that name a session are also summed per session, for the summary of its
+    'done' event; the summaries of the last max_sessions sessions are kept.
+    """
+
+    def __init__(self, max_sessions: int = 1024):
+        """
+        :param max_sessions: Sessions whose summaries are kept until they're collected.
+        """
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._spans: Dict[str, _Histogram] = {}
+        self._tokens: Dict[str, Dict[str, float]] = {}
+        self._counters: Dict[str, int] = {}
+        self._sessions: "OrderedDict[str, dict]" = OrderedDict()
+
+    @contextmanager
+    def span(self, name: str, session: Optional[str] = None):
+        """
+        Times the block as one span.
+
+        :param name: Stage name, e.g. 'chat', 'embed' or 'db_write'.
+        :param session: Session the work is done for, None if it isn't attributable.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, session)
+
+    def observe(self, name: str, seconds: float, session: Optional[str] = None):
+        """
+        Records a span measured elsewhere.
+        """
+        with self._lock:
+            histogram = self._spans.get(name)
+            if histogram is None:
+                histogram = self._spans[name] = _Histogram()
+            histogram.observe(seconds)
+            if session is not None:
+                spans = self._session(session)['spans']
+                stats = spans.setdefault(name, {'count': 0, 'time_s': 0.0})
+                stats['count'] += 1
+                stats['time_s'] += seconds
+
+    def count(self, name: str, session: Optional[str] = None, n: int = 1):
+        """
+        Counts an event, e.g. a step that failed to parse.
+
+        :param name: Event name.
+        :param session: Session the event happened in.
+        :param n: Number of events.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+            if session is not None:
+                counters = self._session(session)['counters']
+                counters[name] = counters.get(name, 0) + n
+
+    def record_response(self, kind: str, response: Optional[Mapping], session: Optional[str] = None):
+        """
+        Adds the token counts of an ollama response (or the last chunk of a stream).
+
+        :param kind: Kind of call, see chat.scheduler.
+        :param response: The response, its missing counts are taken as 0.
+        :param session: Session the call was made for.
+        """
+        if not response:
+            return
+        prompt = response.get('prompt_eval_count') or 0
+        completion = response.get('eval_count') or 0
+        eval_seconds = (response.get('eval_duration') or 0) / 1e9
+        with self._lock:
+            totals = [self._tokens.setdefault(kind, {'calls': 0, 'prompt': 0, 'completion': 0, 'eval_s': 0.0})]
+            if session is not None:
+                totals.append(self._session(session)['tokens'].setdefault(
+                    kind, {'calls': 0, 'prompt': 0, 'completion': 0, 'eval_s': 0.0}))
+            for counts in totals:
+                counts['calls'] += 1
+                counts['prompt'] += prompt
+                counts['completion'] += completion
+                counts['eval_s'] += eval_seconds
+
+    def session_summary(self, session: str, pop: bool = False) -> dict:
+        """
+        :param session: The session.
+        :param pop: Forget the session afterwards.
+        :return: Per span name its count and seconds, per kind of model call its token counts
+            and tokens/s, the totals over every kind and the event counts.
+        """
+        with self._lock:
+            data = self._sessions.pop(session, None) if pop else self._sessions.get(session)
+            if data is None:
+                data = {'spans': {}, 'tokens': {}, 'counters': {}}
+            spans = {name: dict(stats) for name, stats in data['spans'].items()}
+            tokens = {kind: dict(counts) for kind, counts in data['tokens'].items()}
+            counters = dict(data['counters'])
+        for counts in tokens.values():
+            counts['tokens_per_s'] = counts['completion'] / counts['eval_s'] if counts['eval_s'] else None
+        prompt = sum(counts['prompt'] for counts in tokens.values())
+        completion = sum(counts['completion'] for counts in tokens.values())
+        eval_seconds = sum(counts['eval_s'] for counts in tokens.values())
+        return {
+            'spans': spans,
+            'tokens': tokens,
+            'prompt_tokens': prompt,
+            'completion_tokens': completion,
+            'tokens_per_s': completion / eval_seconds if eval_seconds else None,
+            'events': counters,
+        }
+
+    def _session(self, session: str) -> dict:
+        # Caller holds the lock
+        data = self._sessions.get(session)
+        if data is None:
+            data = self._sessions[session] = {'spans': {}, 'tokens': {}, 'counters': {}}
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return data
+
+    def render(self, extra: Iterable[Tuple[str, str, str, Samples]] = ()) -> str:
+        """
+        Formats every span histogram and token counter in the Prometheus text format.
+
+        :param extra: More metrics to include, as (name, type, help, samples) tuples, the
+            name without the common prefix.
+        """
+        with self._lock:
+            spans = {name: (list(h.buckets), h.count, h.sum) for name, h in self._spans.items()}
+            tokens = {kind: dict(counts) for kind, counts in self._tokens.items()}
+            counters = dict(self._counters)
+
+        lines = [f"# HELP {PREFIX}_span_seconds Duration of the pipeline stages.", f"# TYPE {PREFIX}_span_seconds histogram"]
+        for name, (buckets, count, total) in sorted(spans.items()):
+            for bound, value in zip(BUCKETS, buckets):
+                lines.append(f'{PREFIX}_span_seconds_bucket{{span="{name}",le="{bound}"}} {value}')
+            lines.append(f'{PREFIX}_span_seconds_bucket{{span="{name}",le="+Inf"}} {count}')
+            lines.append(f'{PREFIX}_span_seconds_sum{{span="{name}"}} {total}')
+            lines.append(f'{PREFIX}_span_seconds_count{{span="{name}"}} {count}')
+
+        metrics = [
+            ('llm_calls_total', 'counter', "Model calls that reported token counts.",
+             [({'kind': kind}, counts['calls']) for kind, counts in tokens.items()]),
+            ('llm_tokens_total', 'counter', "Tokens processed by the model.",
+             [({'kind': kind, 'type': type}, counts[type]) for kind, counts in tokens.items() for type in ('prompt', 'completion')]),
+            ('llm_eval_seconds_total', 'counter', "Seconds the model spent generating tokens.",
+             [({'kind': kind}, counts['eval_s']) for kind, counts in tokens.items()]),
+            ('llm_tokens_per_second', 'gauge', "Generated tokens per second of generation time, since start.",
+             [({'kind': kind}, counts['completion'] / counts['eval_s']) for kind, counts in tokens.items() if counts['eval_s']]),
+            ('events_total', 'counter', "Counted events, e.g. parsed and retried steps.",
+             [({'event': name}, value) for name, value in sorted(counters.items())]),
+        ]
+        for name, type, help, samples in [*metrics, *extra]:
+            lines.extend(_format(name, type, help, samples))
+        return "\n".join(lines) + "\n"
+
+
+def _format(name: str, type: str, help: str, samples: Samples) -> List[str]:
+    name = f"{PREFIX}_{name}"
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    if isinstance(samples, (int, float)):
+        samples = [({}, samples)]
+    for labels, value in samples:
+        label_text = ",".join(f'{key}="{_escape(str(label))}"' for key, label in labels.items())
+        lines.append(f"{name}{{{label_text}}} {float(value)}" if label_text else f"{name} {float(value)}")
+    return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def process_metrics() -> List[Tuple[str, str, str, Samples]]:
+    """
+    Scheduler, embedding cache and titler counters of this process, as extra metrics for render.
+    """
+    # Imported here, the chat package imports this module
+    from chat.embedding_cache import get_embedding_cache
+    from chat.get_short_title import title_stats
+    from chat.scheduler import get_scheduler
+
+    scheduler = get_scheduler().stats()
+    kinds = scheduler['kinds']
+    cache = get_embedding_cache().stats()
+    return [
+        ('scheduler_max_concurrent', 'gauge', "Model calls allowed at once.", scheduler['max_concurrent']),
+        ('scheduler_running', 'gauge', "Model calls running.", [({'kind': k}, s['running']) for k, s in kinds.items()]),
+        ('scheduler_waiting', 'gauge', "Model calls waiting for a slot.", [({'kind': k}, s['waiting']) for k, s in kinds.items()]),
+        ('scheduler_calls_total', 'counter', "Model calls started.", [({'kind': k}, s['calls']) for k, s in kinds.items()]),
+        ('scheduler_wait_seconds_total', 'counter', "Seconds model calls waited for a slot.",
+         [({'kind': k}, s['wait_total']) for k, s in kinds.items()]),
+        ('scheduler_wait_seconds_max', 'gauge', "Longest wait for a slot.", [({'kind': k}, s['wait_max']) for k, s in kinds.items()]),
+        ('embedding_cache_lookups_total', 'counter', "Embedding cache lookups by result.",
+         [({'result': result}, cache[result]) for result in ('hits', 'disk_hits', 'misses')]),
+        ('embedding_cache_entries', 'gauge', "Embeddings held in memory.", cache['entries']),
+        ('titles_total', 'counter', "Node titles by source.", [({'source': k}, v) for k, v in title_stats().items()]),
+    ]
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """
+    Returns the process-wide tracer.
+    """
+    return _tracer